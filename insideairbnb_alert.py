@@ -9,116 +9,162 @@ Created on Sat Dec  7 07:21:04 2019
 This file contains additional tools used to create custom alerts for our work 
 scraping the InsideAirBnb website. This file relies on the custom functions defined
 in the 'insideairbnb_tools.py' file.
+
+Alerts can be sent straight away with `send_alert_email()`, or handed to an
+`AlertDispatcher`, which sends them from a background thread: the new files
+found within a few minutes of each other are coalesced into a single digest,
+and each digest is delivered to a list of sinks (an SMTP server, a webhook, a
+local file), retrying with exponential backoff when delivery fails. The SMTP
+sink keeps its connection open between digests, and its host, port and SSL
+settings can point it at a local debugging server, e.g.
+`python -m aiosmtpd -n -l localhost:8025`, for testing.
 """
+import json
+import os
+import queue
+import smtplib
+import sqlite3
+import ssl
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
 import pandas as pd
 
+from insideairbnb_connection import connect, default_db_path
+from insideairbnb_db import create_table_indexes, table_columns
+
+
+# The email parameters must be set here. For a local test server, use e.g.
+# {'host': 'localhost', 'port': 8025, 'use_ssl': False, 'username': None}.
+SMTP_SETTINGS = {'host': 'smtp.gmail.com',
+                 'port': 465,
+                 'use_ssl': True,
+                 'starttls': False,
+                 'username': 'sender@email.com',
+                 'password': 'PASSWORD',
+                 'sender': 'sender@email.com',
+                 'recipients': ['receiver@email.com']}
+DIGEST_WINDOW = 300
+RETRIES = 3
+BACKOFF = 1.0
+
         
 # =============================================================================
-# The following function uses the df returned from `extract_file_url` in the 
-# 'insideairbnb_tools.py' file and checks it against the 'source_info' table in our 
-# database to see if the file already exists in our database. The default of this 
-# funtion is to return a logical, True/False if the file already exists. Changing 
-# the default argument of this function, 'send_email' to True will cause the function
-# to send an email alert with the results if True. 
+# The following function compares the df returned from `extract_file_url` in the
+# 'insideairbnb_tools.py' file with the 'source_info' table in our database, and
+# returns the files of the import list that are not in the database yet. The
+# comparison is done by SQLITE: the urls of the import list are written to a
+# temporary table, and anti-joined with the indexed 'source_url' and 'city'
+# columns of 'source_info', so only the new files are ever read into pandas.
+# Temporary tables can be written on a read-only connection too, but indexes
+# cannot be created there; the ingest creates them when it records a snapshot.
+# =============================================================================
+
+def find_new_files(import_list_df, conn):
+    """Returns a dataframe with the 'country', 'city' and 'source_url' of the
+    files of the import list that are not in the 'source_info' table of the
+    database `conn`, and a 'new_city' column that is 1 for the files of cities
+    that are not in the database at all.
+    """
+    from insideairbnb_tools import split_source_url
+    import_split = split_source_url(import_list_df)
+
+    conn.execute("create temp table if not exists candidate_files (country text, city text, source_url text)")
+    conn.execute("delete from temp.candidate_files")
+    conn.executemany("insert into temp.candidate_files values (?, ?, ?)",
+                     import_split[['country', 'city', 'source_url']].itertuples(index=False))
+
+    if not table_columns(conn, 'source_info'):
+        query = "select country, city, source_url, 1 as new_city from temp.candidate_files"
+    else:
+        try:
+            create_table_indexes(conn, 'source_info')
+        except sqlite3.OperationalError as e:
+            if 'readonly' not in str(e):
+                raise
+        query = """select c.country, c.city, c.source_url,
+                          not exists (select 1 from source_info s where s.city = c.city) as new_city
+                   from temp.candidate_files c
+                   where not exists (select 1 from source_info s where s.source_url = c.source_url)"""
+    new_files = pd.read_sql_query(query + " order by country, source_url", conn)
+    conn.execute("delete from temp.candidate_files")
+    conn.commit()
+
+    return new_files
+
+
+# =============================================================================
+# The following function checks the import list for new files with
+# `find_new_files()`. The default of this funtion is to return a logical,
+# True/False if the import list contains new files. Changing the default
+# argument of this function, 'send_email' to True will cause the function to
+# send an email alert with the results if True; if an `AlertDispatcher` is
+# given, the alert is queued with it instead, and the function returns at once.
+# An open connection to the database can be passed as `conn`; otherwise the
+# local database is opened read-only, so the check can run during an ingest.
 # 
-# The email parameters must be set manually in the `send_alert_email()` function below.
+# The email parameters must be set in `SMTP_SETTINGS` above.
 # =============================================================================
 
-def check_import_list_for_new(import_list_df, send_email=False):
+def check_import_list_for_new(import_list_df, send_email=False, conn=None, dispatcher=None):
     """This function will send an email if new files are on the import list and 
     not already in our database.
     """
-    #Fetch 'source_info' table from database to use for checks
-    import sqlite3
-    conn = sqlite3.connect("insideairbnb.db")
-    source_info = pd.read_sql_query("select * from source_info;", conn)
-    conn.close()
-
-    #split the import list in order to match columns against 'source_info'
-    from insideairbnb_tools import split_source_url    
-    import_split = split_source_url(import_list_df)
-    
-    #test for new files in the splitted up import list
-    test_for_new_files = pd.merge(import_split, source_info, on='source_url', how='left', indicator=True)
+    own_conn = conn is None
+    if own_conn:
+        conn = connect(read_only=os.path.exists(default_db_path()))
+    try:
+        new_files = find_new_files(import_list_df, conn)
+    finally:
+        if own_conn:
+            conn.close()
     
     if send_email:            
-        if any(test_for_new_files['_merge'] == 'left_only'):
-            #this block of codegives us a list of all the new city names
-            new_cities = pd.merge(import_split, source_info, on='city', how='left', indicator=True)    
-            new_cities = new_cities[new_cities['_merge'] == 'left_only'] 
-            new_cities = new_cities.sort_values(['country_x', 'city'])
-            new_cities = new_cities.city.unique()
-            new_cities = pd.DataFrame(new_cities)
-            new_cities.columns = ['cities_added']
-            new_cities_names = new_cities.to_html() # we make a separate html object here and only use this if the 'new cities' object is greater thab zero
-            
-            #this block of code gives us a list of all the new files
-            new_files = pd.merge(import_split, source_info, on=['city', 'source_url'], how='left', indicator=True)            
-            new_files = new_files[new_files['_merge'] == 'left_only'] 
-            new_files = new_files.sort_values(['country_x', 'source_url'])
-            
-            #this block of code takes the list of all new files and returns an html object with the count by country/city
-            new_files_count = new_files.groupby(['country_x', 'city'])['source_url'].count()
-            new_files_count = new_files_count.to_frame()
-            new_files_count.columns = ['total_files_added']
-            new_files_count = new_files_count.to_html() #html object to be inserted into email
-            
-            #this block of code takes the list of all new files and returns an html object with the entire list of new files
-            new_files_all = new_files[['country_x', 'city', 'source_url']]
-            new_files_all.columns = ['country', 'city', 'files_added']
-            new_files_all = new_files_all.reset_index()
-            new_files_all = new_files_all.to_html() #html object to be inserted in email
-            
-            if len(new_cities)==0:
-                send_alert_email(new_files_count, new_files_all)
+        if len(new_files):
+            if dispatcher is not None:
+                dispatcher.submit(new_files)
             else:
-                send_alert_email(new_files_count, new_files_all, new_cities_names)          
+                send_alert_email(*_alert_tables(new_files))
         
         else:
             print('The import list supplied does not contain any new files')
     
     else:        
         #return boolean, if 'send_email' argument sent to False
-        if any(test_for_new_files['_merge'] == 'left_only'):
-            return True
-        else:
-            return False
+        return len(new_files) > 0
 
 
 # =============================================================================
-# This function defines the template that will be used to send us alert emails 
-# when there is new data available on the insideairbnb site for download. A simple
-# text email template is defined, along with an html email that provides additional 
-# details on all of the new files available, as well as any new cities added that 
-# that is not alread in our database. Email recipient information must be set
-# inside the function for the time being.        
+# The following functions turn the new files returned by `find_new_files()` into
+# an alert. An alert is a dict with a 'subject', a plain 'text' body, an 'html'
+# body with the tables of new cities and files, and the list of new 'files',
+# which every sink below knows how to deliver.
 # =============================================================================
 
-def send_alert_email(new_files_count, new_files_all, new_cities_names=None):
-    """This function defines the email templates that will be sent alerting us to
-    new file uploads on the insideairbnb site"""
-    
-    import smtplib, ssl
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
+def _alert_tables(new_files):
+    #this block of code gives us a list of all the new city names
+    new_cities = new_files[new_files['new_city'] == 1].sort_values(['country', 'city'])
+    new_cities = pd.DataFrame({'cities_added': new_cities.city.unique()})
+    new_cities_names = new_cities.to_html() if len(new_cities) else None
     
-    sender_email = "sender@email.com"
-    receiver_email = "receiver@email.com"
-    #password = input("Type your password and press enter:")
-    password = 'PASSWORD'
-    
-    message = MIMEMultipart("alternative")
-    message["Subject"] = "New InsideAirBnB data available!"
-    message["From"] = sender_email
-    message["To"] = receiver_email
-    
-    # Create the plain-text and HTML version of your message
-    text = """\
-    YO!,
-    There are new files available for download on the InsideAirBnB site.
-    Have a look:
-    http://insideairbnb.com/get-the-data.html"""
+    #this block of code takes the list of all new files and returns an html object with the count by country/city
+    new_files_count = new_files.groupby(['country', 'city'])['source_url'].count()
+    new_files_count = new_files_count.to_frame()
+    new_files_count.columns = ['total_files_added']
+    new_files_count = new_files_count.to_html() #html object to be inserted into email
     
+    #this block of code takes the list of all new files and returns an html object with the entire list of new files
+    new_files_all = new_files[['country', 'city', 'source_url']]
+    new_files_all.columns = ['country', 'city', 'files_added']
+    new_files_all = new_files_all.reset_index(drop=True).reset_index()
+    new_files_all = new_files_all.to_html() #html object to be inserted in email
+
+    return new_files_count, new_files_all, new_cities_names
+
+
+def _alert_html(new_files_count, new_files_all, new_cities_names=None):
     if new_cities_names is None:
         html = """\
     <html>
@@ -155,27 +201,322 @@ def send_alert_email(new_files_count, new_files_all, new_cities_names=None):
       </body>
     </html>
     """.format(new_files_count, new_files_all, new_cities_names)     
-        
-    # Turn these into plain/html MIMEText objects
-    part1 = MIMEText(text, "plain")
-    part2 = MIMEText(html, "html")
-    
-    # Add HTML/plain-text parts to MIMEMultipart message
-    # The email client will try to render the last part first
-    message.attach(part1)
-    message.attach(part2)
-    
-    # Create secure connection with server and send email
+
+    return html
+
+
+ALERT_SUBJECT = "New InsideAirBnB data available!"
+ALERT_TEXT = """\
+    YO!,
+    There are new files available for download on the InsideAirBnB site.
+    Have a look:
+    http://insideairbnb.com/get-the-data.html"""
+
+
+def make_alert(new_files):
+    """Returns the alert dict for the dataframe of new files returned by
+    `find_new_files()`.
+    """
+    return {'subject': ALERT_SUBJECT,
+            'text': ALERT_TEXT,
+            'html': _alert_html(*_alert_tables(new_files)),
+            'files': list(new_files['source_url'])}
+
+
+# =============================================================================
+# This helper function calls `send()`, and calls it again after 1, 2, 4, ...
+# times `backoff` seconds if it fails with a network or SMTP error, up to
+# `retries` more times, before letting the error through. Authentication errors
+# are not retried.
+# =============================================================================
+
+def _with_retries(send, retries=RETRIES, backoff=BACKOFF, name='sink'):
+    for attempt in range(retries + 1):
+        try:
+            return send()
+        except smtplib.SMTPAuthenticationError:
+            raise
+        except (smtplib.SMTPException, OSError) as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print('{0} failed ({1}), retrying in {2:.1f}s'.format(name, e, delay))
+            time.sleep(delay)
+
+
+# =============================================================================
+# The following classes are the sinks alerts can be delivered to. Each has a
+# `send(alert)` method, which raises if the alert could not be delivered, and a
+# `close()` method.
+#
+# `SmtpSink` emails the alert. Its connection is opened on the first alert and
+# kept open for the next ones; it is checked with a NOOP before being reused,
+# and opened again if the server has dropped it.
+# =============================================================================
+
+class SmtpSink:
+    """Emails alerts through the SMTP server at `host`:`port`, over SSL if
+    `use_ssl` is True, or upgraded with STARTTLS if `starttls` is True.
+    Servers that need no login (such as a local test server) are used with
+    `username=None`.
+    """
+
+    def __init__(self, host='smtp.gmail.com', port=465, use_ssl=True, starttls=False,
+                 username=None, password=None, sender='sender@email.com',
+                 recipients=('receiver@email.com',), timeout=30, retries=RETRIES, backoff=BACKOFF):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.recipients = [recipients] if isinstance(recipients, str) else list(recipients)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._server = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout,
+                                      context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                server.starttls(context=ssl.create_default_context())
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    def _connection(self):
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close_server()
+        self._server = self._connect()
+        return self._server
+
+    def _close_server(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    def message(self, alert):
+        """Returns the MIME message of `alert`, with its plain-text and html
+        versions; the email client will try to render the html part first.
+        """
+        message = MIMEMultipart("alternative")
+        message["Subject"] = alert['subject']
+        message["From"] = self.sender
+        message["To"] = ', '.join(self.recipients)
+        message.attach(MIMEText(alert['text'], "plain"))
+        message.attach(MIMEText(alert['html'], "html"))
+        return message
+
+    def send(self, alert):
+        message = self.message(alert).as_string()
+
+        def attempt():
+            with self._lock:
+                try:
+                    self._connection().sendmail(self.sender, self.recipients, message)
+                except (smtplib.SMTPException, OSError):
+                    self._close_server()
+                    raise
+
+        _with_retries(attempt, self.retries, self.backoff, 'SMTP delivery')
+
+    def close(self):
+        with self._lock:
+            self._close_server()
+
+
+class WebhookSink:
+    """Posts alerts as JSON (subject, text and files) to the webhook `url`,
+    reusing one HTTP connection.
+    """
+
+    def __init__(self, url, timeout=10, retries=RETRIES, backoff=BACKOFF):
+        import requests
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session = requests.Session()
+
+    def send(self, alert):
+        payload = {key: alert[key] for key in ('subject', 'text', 'files')}
+
+        def attempt():
+            response = self._session.post(self.url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+
+        _with_retries(attempt, self.retries, self.backoff, 'Webhook delivery')
+
+    def close(self):
+        self._session.close()
+
+
+class FileSink:
+    """Appends alerts, one JSON object per line, to the local file `path`."""
+
+    def __init__(self, path='insideairbnb_alerts.jsonl'):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, alert):
+        record = dict(alert, sent_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        pass
+
+
+# =============================================================================
+# This class delivers alerts from a background thread, so that neither the
+# ingest nor the watcher waits on a mail server. `submit()` queues the new files
+# returned by `find_new_files()`; the thread waits `window` seconds after the
+# first of them for more to come in, and then sends a single digest of all the
+# files queued meanwhile to each sink. A failing sink does not stop the others:
+# its error is printed and kept in `errors`, as is any error building a digest,
+# so the thread keeps running whatever happens. Call `close()` (or use the
+# dispatcher in a `with` block) to send what is still queued and stop the
+# thread.
+# =============================================================================
+
+_STOP = object()
+
+# the columns of the dataframe returned by `find_new_files()`, which the digest
+# is built from
+ALERT_COLUMNS = ['country', 'city', 'source_url', 'new_city']
+
+
+class AlertDispatcher:
+    """Queues new files and delivers them, coalesced into one digest per
+    `window` seconds, to each of the `sinks`.
+    """
+
+    def __init__(self, sinks, window=DIGEST_WINDOW, max_queued=1000):
+        self.sinks = list(sinks)
+        self.window = window
+        self.stats = {'submitted': 0, 'digests': 0, 'delivered': 0, 'failed': 0}
+        self.errors = []
+        self._queue = queue.Queue(max_queued)
+        self._thread = threading.Thread(target=self._run, name='insideairbnb-alerts', daemon=True)
+        self._thread.start()
+
+    def submit(self, new_files):
+        """Queues the dataframe of new files returned by `find_new_files()`.
+        Raises ValueError if it lacks any of the `ALERT_COLUMNS`, and
+        RuntimeError if the dispatcher is closed.
+        """
+        missing = [c for c in ALERT_COLUMNS if c not in new_files]
+        if missing:
+            raise ValueError('the new files lack the column(s) {0}; pass the dataframe returned by '
+                             '`find_new_files()`'.format(', '.join(missing)))
+        self._put(new_files)
+        self.stats['submitted'] += 1
+
+    def _put(self, item):
+        # never block forever on a full queue if the thread has stopped
+        while True:
+            if not self._thread.is_alive():
+                raise RuntimeError('the alert dispatcher is closed')
+            try:
+                self._queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._deliver(batch)
+            except Exception as e:
+                self.stats['failed'] += 1
+                self.errors.append((type(self).__name__, e))
+                print('Alert digest not built: {0!r}'.format(e))
+
+    def _deliver(self, batch):
+        new_files = pd.concat(batch, ignore_index=True).drop_duplicates('source_url')
+        alert = make_alert(new_files.sort_values(['country', 'source_url']))
+        self.stats['digests'] += 1
+        for sink in self.sinks:
+            try:
+                sink.send(alert)
+                self.stats['delivered'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                self.errors.append((type(sink).__name__, e))
+                print('Alert not delivered by {0}: {1}'.format(type(sink).__name__, e))
+
+    def close(self, timeout=None):
+        """Sends the alerts still queued, stops the thread and closes the sinks."""
+        if self._thread.is_alive():
+            try:
+                self._put(_STOP)
+            except RuntimeError:
+                pass
+            self._thread.join(timeout)
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# =============================================================================
+# This function sends a single alert email straight away, through `sink` if one
+# is given, or otherwise through a new `SmtpSink` with the `SMTP_SETTINGS`
+# above. It returns True if the email was sent.
+# =============================================================================
+
+def send_alert_email(new_files_count, new_files_all, new_cities_names=None, sink=None):
+    """This function defines the email templates that will be sent alerting us to
+    new file uploads on the insideairbnb site"""
+    alert = {'subject': ALERT_SUBJECT,
+             'text': ALERT_TEXT,
+             'html': _alert_html(new_files_count, new_files_all, new_cities_names),
+             'files': []}
+
+    own_sink = sink is None
+    if own_sink:
+        sink = SmtpSink(**SMTP_SETTINGS)
     try:
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-            server.login(sender_email, password)
-            server.sendmail(
-                sender_email, receiver_email, message.as_string()
-            )
-            server.close() #maybe comment this out if it doesn't work? 
-        print('Email sent!')       
-             
+        sink.send(alert)
+        print('Email sent!')
+        return True
     except Exception as e:
         print(e)
-        print ('Email not sent. Something went wrong...')
\ No newline at end of file
+        print ('Email not sent. Something went wrong...')
+        return False
+    finally:
+        if own_sink:
+            sink.close()
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB BENCHMARK
+
+@author: anguyen1210
+
+This file contains a benchmark of the whole pipeline on synthetic data, so that
+changes to the 'insideairbnb_*.py' files can be checked for speed regressions
+without downloading anything from InsideAirBnb.
+
+A synthetic 'get the data' page is generated with `cities` city tables, each
+with `snapshots` dates of the usual files, along with synthetic 'listings.csv.gz'
+and 'calendar.csv.gz' files for the `download_cities` cities of France. They are
+served by a local HTTP server standing in for 'insideairbnb.com', and each stage
+is timed in turn:
+
+    page_fetch, page_parse, make_files_index, list_cities, extract_file_url,
+    download, source_tagging, load_listings, load_calendar, alert_diff, haversine
+
+Everything is written to a temporary directory, which is removed afterwards.
+Run this file to print the results as JSON, e.g.
+
+    python insideairbnb_bench.py --cities 2000 --listings 5000 --output bench.json
+
+Each stage reports its time in seconds and the number of items it processed:
+bytes for 'page_fetch' and 'download', rows for the loads, distances computed
+for 'haversine', and cities or files for the others. Stages without side effects are run `repeat` times,
+and their fastest run is reported.
+"""
+import argparse
+import contextlib
+import functools
+import http.server
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+COUNTRIES = [('Germany', 'Berlin'), ('Italy', 'Lazio'), ('Spain', 'Catalonia'),
+             ('Switzerland', 'Vaud'), ('United States', 'New York'), ('Belgium', 'Brussels')]
+
+# the files listed for every snapshot of a city, with their description
+PAGE_FILES = [('data/listings.csv.gz', 'Detailed Listings data'),
+              ('data/calendar.csv.gz', 'Detailed Calendar Data'),
+              ('data/reviews.csv.gz', 'Detailed Review Data'),
+              ('visualisations/listings.csv', 'Summary information and metrics for listings'),
+              ('visualisations/reviews.csv', 'Summary Review data'),
+              ('visualisations/neighbourhoods.csv', 'Neighbourhood list for geo filter'),
+              ('visualisations/neighbourhoods.geojson', 'GeoJSON file of neighbourhoods')]
+
+
+def _slug(name):
+    return name.lower().replace(' ', '-')
+
+
+# =============================================================================
+# These functions generate the synthetic fixtures. The page has the structure
+# of the real page: an 'h2' header ("city, region, country") followed by a
+# table of files for each city, with its links pointing at `base_url`. The
+# first `download_cities` cities are in France, the others spread over
+# `COUNTRIES`.
+# =============================================================================
+
+def _city(i, download_cities):
+    if i < download_cities:
+        return 'City {0:05d}'.format(i), 'Ile-de-France', 'France'
+    country, region = COUNTRIES[i % len(COUNTRIES)]
+    return 'City {0:05d}'.format(i), region, country
+
+
+def snapshot_dates(snapshots):
+    """Returns the `snapshots` dates of the synthetic page, most recent first."""
+    return [d.strftime('%Y-%m-%d') for d in pd.date_range(end='2020-01-31', periods=snapshots, freq='MS')[::-1]]
+
+
+def make_page(base_url, cities=2000, snapshots=3, download_cities=5):
+    """Returns the html of a synthetic 'get the data' page with `cities` city
+    tables of `snapshots` dates each.
+    """
+    dates = snapshot_dates(snapshots)
+    out = ['<html><body>']
+    for i in range(cities):
+        city, region, country = _city(i, download_cities)
+        out.append('<h2>{0}, {1}, {2}</h2>'.format(city, region, country))
+        out.append('<table class="table table-hover table-striped {0}"><thead><tr><th>Date Compiled</th>'
+                   '<th>Country/City</th><th>File Name</th><th>Description</th></tr></thead><tbody>'
+                   .format(_slug(city)))
+        for date in dates:
+            for path, description in PAGE_FILES:
+                url = '{0}/{1}/{2}/{3}/{4}/{5}'.format(base_url, _slug(country), _slug(region),
+                                                      _slug(city), date, path)
+                out.append('<tr><td>{0}</td><td>{1}</td><td><a href="{2}">{3}</a></td><td>{4}</td></tr>'
+                           .format(date, city, url, path.rsplit('/', 1)[-1], description))
+        out.append('</tbody></table>')
+    out.append('</body></html>')
+
+    return '\n'.join(out)
+
+
+def make_listings(n, seed=0):
+    """Returns a synthetic listings dataframe of `n` listings around Paris."""
+    rng = np.random.default_rng(seed)
+    price = rng.integers(20, 2000, n)
+    return pd.DataFrame({'id': np.arange(n) + (seed + 1) * 10 ** 7,
+                         'name': ['Flat {0}'.format(i) for i in range(n)],
+                         'host_id': rng.integers(1, 10 ** 6, n),
+                         'neighbourhood': rng.choice(['Louvre', 'Marais', 'Batignolles'], n),
+                         'latitude': 48.8566 + rng.normal(0, 0.03, n),
+                         'longitude': 2.3522 + rng.normal(0, 0.045, n),
+                         'room_type': rng.choice(['Entire home/apt', 'Private room', 'Shared room'], n),
+                         'accommodates': rng.integers(1, 8, n),
+                         'price': ['${0:,}.00'.format(p) for p in price],
+                         'minimum_nights': rng.integers(1, 30, n),
+                         'number_of_reviews': rng.integers(0, 300, n),
+                         'reviews_per_month': np.where(rng.random(n) < 0.2, np.nan, rng.random(n) * 5),
+                         'availability_365': rng.integers(0, 366, n)})
+
+
+def make_calendar(listing_ids, days=30, seed=0):
+    """Returns a synthetic calendar dataframe of `days` days for each of the
+    `listing_ids`.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.repeat(np.asarray(listing_ids), days)
+    dates = np.tile(pd.date_range('2020-01-01', periods=days).strftime('%Y-%m-%d'), len(listing_ids))
+    price = np.array(['${0:,}.00'.format(p) for p in rng.integers(20, 2000, len(ids))])
+    return pd.DataFrame({'listing_id': ids, 'date': dates,
+                         'available': rng.choice(['t', 'f'], len(ids)),
+                         'price': price, 'adjusted_price': price,
+                         'minimum_nights': rng.integers(1, 30, len(ids)),
+                         'maximum_nights': 1125})
+
+
+def write_fixtures(root, snapshots=3, download_cities=5, listings=2000, calendar_days=30, seed=0):
+    """Writes the data files of the most recent snapshot of the cities of
+    France under the directory `root`, at the paths of their urls, and returns
+    the number of bytes written. The page itself is generated once the server
+    address is known, see `make_page()`.
+    """
+    date = snapshot_dates(snapshots)[0]
+    written = 0
+    for i in range(download_cities):
+        city, region, country = _city(i, download_cities)
+        folder = os.path.join(root, _slug(country), _slug(region), _slug(city), date, 'data')
+        os.makedirs(folder, exist_ok=True)
+        listings_df = make_listings(listings, seed + i)
+        listings_df.to_csv(os.path.join(folder, 'listings.csv.gz'), index=False, compression='gzip')
+        make_calendar(listings_df['id'], calendar_days, seed + i).to_csv(
+            os.path.join(folder, 'calendar.csv.gz'), index=False, compression='gzip')
+        written += sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+    return written
+
+
+# =============================================================================
+# This context manager serves the directory `root` over HTTP on a free local
+# port, in a background thread, standing in for 'insideairbnb.com'.
+# =============================================================================
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serve(root):
+    """Serves the directory `root` while the block runs, and yields its base
+    url, e.g. 'http://127.0.0.1:53241'.
+    """
+    handler = functools.partial(_QuietHandler, directory=root)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://{0}:{1}'.format(*server.server_address)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# =============================================================================
+# This helper times a stage and records it in `results`. The stage is run
+# `repeat` times and the fastest run is kept, and the result of the last run is
+# returned for the next stages.
+# =============================================================================
+
+def _timed(results, stage, items, func, *args, repeat=1, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+    count = items(value) if callable(items) else items
+    results.append({'stage': stage, 'seconds': round(seconds, 6), 'runs': repeat, 'items': count,
+                    'items_per_s': round(count / seconds, 1) if seconds and count else None})
+    print('{0:<18}{1:>10.4f}s  {2:>12,} items'.format(stage, seconds, count))
+    return value
+
+
+# =============================================================================
+# This function runs the benchmark. The stages use the public functions of the
+# repo, in the order of the 'scrape_insideairbnb_01.py' script. Note, the page
+# is parsed into a new BS4 object for each run of 'page_parse', so
+# 'make_files_index' includes building the catalog of the page, while the later
+# stages reuse it (see `get_catalog()`).
+# =============================================================================
+
+def run_benchmark(cities=2000, snapshots=3, download_cities=5, listings=2000, calendar_days=30,
+                  queries=1000, radius_km=1.0, workers=4, repeat=3, seed=0):
+    """Runs every stage of the pipeline on synthetic fixtures of the given
+    sizes, and returns a dict with the parameters, the environment and the
+    timings of each stage.
+    """
+    from bs4 import BeautifulSoup
+    import requests
+
+    from insideairbnb_alert import find_new_files
+    from insideairbnb_catalog import _last_catalog
+    from insideairbnb_connection import connect
+    from insideairbnb_db import ingest_import_list
+    from insideairbnb_tools import (extract_file_url, get_local_filenames, list_cities, make_files_index,
+                                    read_csv_to_bigtable, save_insideairbnb_file)
+    from insideairbnb_tools2 import haversine
+
+    params = {'cities': cities, 'snapshots': snapshots, 'download_cities': download_cities,
+              'listings': listings, 'calendar_days': calendar_days, 'queries': queries,
+              'radius_km': radius_km, 'workers': workers, 'repeat': repeat, 'seed': seed}
+    results = []
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory(prefix='insideairbnb_bench_') as workdir:
+        site = os.path.join(workdir, 'site')
+        fixture_bytes = write_fixtures(site, snapshots, download_cities, listings, calendar_days, seed)
+
+        with serve(site) as base_url:
+            with open(os.path.join(site, 'get-the-data.html'), 'w', encoding='utf-8') as f:
+                f.write(make_page(base_url, cities, snapshots, download_cities))
+            page_url = base_url + '/get-the-data.html'
+
+            # the downloads, manifest and database are saved in the working directory
+            os.chdir(workdir)
+            try:
+                page = _timed(results, 'page_fetch', lambda r: len(r.content),
+                              requests.get, page_url, repeat=repeat)
+                page.encoding = 'utf-8'
+                content = _timed(results, 'page_parse', cities,
+                                 BeautifulSoup, page.text, 'lxml', repeat=repeat)
+
+                def files_index():
+                    _last_catalog['ref'] = None
+                    return make_files_index(content)
+
+                index = _timed(results, 'make_files_index', len, files_index, repeat=repeat)
+                france = _timed(results, 'list_cities', len(index),
+                                list_cities, index, 'france', repeat=repeat)
+                import_list = _timed(results, 'extract_file_url', len,
+                                     extract_file_url, content, 'listings.csv.gz', france, repeat=repeat)
+                calendar_list = extract_file_url(content, 'calendar.csv.gz', france)
+
+                _timed(results, 'download', fixture_bytes, save_insideairbnb_file,
+                       pd.concat([import_list, calendar_list], ignore_index=True), workers=workers)
+
+                _timed(results, 'source_tagging', len, read_csv_to_bigtable,
+                       get_local_filenames(import_list), import_list, repeat=repeat)
+
+                conn = connect(os.path.join(workdir, 'bench.db'))
+                try:
+                    _timed(results, 'load_listings', lambda s: int(s['rows'].sum()),
+                           ingest_import_list, import_list, conn, 'listings')
+                    _timed(results, 'load_calendar', lambda s: int(s['rows'].sum()),
+                           ingest_import_list, calendar_list, conn, 'calendar')
+
+                    history = extract_file_url(content, 'listings.csv.gz', current=False)
+                    _timed(results, 'alert_diff', len(history), find_new_files, history, conn, repeat=repeat)
+
+                    points = pd.read_sql_query('select latitude, longitude from listings', conn)
+                finally:
+                    conn.close()
+            finally:
+                os.chdir(cwd)
+
+    lat, lon = points['latitude'].to_numpy(), points['longitude'].to_numpy()
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(lat), queries)
+
+    def radius_counts():
+        return [int((haversine(lat[i], lon[i], lat, lon) <= radius_km).sum()) for i in picks]
+
+    _timed(results, 'haversine', queries * len(lat), radius_counts, repeat=repeat)
+
+    return {'params': params,
+            'environment': {'python': platform.python_version(), 'pandas': pd.__version__,
+                            'numpy': np.__version__, 'platform': platform.platform(),
+                            'cpu_count': os.cpu_count()},
+            'started_at': started_at,
+            'stages': results}
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Benchmark the InsideAirBnb pipeline on synthetic data.')
+    parser.add_argument('--cities', type=int, default=2000, help='city tables on the page')
+    parser.add_argument('--snapshots', type=int, default=3, help='dates listed for each city')
+    parser.add_argument('--download-cities', type=int, default=5, help='cities whose files are downloaded')
+    parser.add_argument('--listings', type=int, default=2000, help='listings in each listings file')
+    parser.add_argument('--calendar-days', type=int, default=30, help='days in each calendar file')
+    parser.add_argument('--queries', type=int, default=1000, help='haversine radius queries')
+    parser.add_argument('--workers', type=int, default=4, help='download threads')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each stage without side effects')
+    parser.add_argument('--output', help='file the JSON results are written to (default: stdout)')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _parser().parse_args()
+    # progress messages go to stderr, so that stdout only holds the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmark(cities=args.cities, snapshots=args.snapshots, download_cities=args.download_cities,
+                                listings=args.listings, calendar_days=args.calendar_days,
+                                queries=args.queries, workers=args.workers, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved to: ', args.output)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB CATALOG
+
+@author: anguyen1210
+
+This file contains the functions used to turn the parsed
+'http://insideairbnb.com/get-the-data.html' page into a catalog of all the files
+available for download. The page is walked once, and every file link becomes a
+row of a pandas dataframe with its country, region, city, city table, date
+compiled, file type, description and url. The functions in the
+'insideairbnb_tools.py' and 'insideairbnb_tools2.py' files look files up in this
+catalog instead of searching the BS4 tree again on every call.
+
+Parsed catalogs are also saved to a small SQLITE file, keyed by a hash of the
+page they were parsed from. Later runs that see the same page load the catalog
+from there without importing BS4/lxml at all, and every version seen is kept so
+that successive versions of the page can be compared with `diff_catalogs()`.
+"""
+import datetime
+import hashlib
+import re
+import weakref
+
+import pandas as pd
+
+from insideairbnb_connection import connect
+
+
+CATALOG_COLUMNS = ['country', 'region', 'city', 'table', 'table_class',
+                   'date_compiled', 'file_type', 'description', 'source_url']
+CATALOG_DB = 'insideairbnb_catalog.db'
+
+# the catalog of the last BS4 object seen, so that repeated calls on the same
+# 'content' object only walk the page once
+_last_catalog = {'ref': None, 'catalog': None, 'tables': None}
+
+
+# =============================================================================
+# This function walks the BS4 object once, in document order. Each city on the
+# page has an 'h2' header ("city, region, country") followed by a 'table' with
+# one row per file, so we keep track of the last header seen and attach it to
+# every file link in the following table.
+# =============================================================================
+
+def build_catalog(bs_object):
+    """This function accepts the BS4 object created from InsideAirBnB data and
+    returns a tuple of the catalog dataframe, with one row per file link on the
+    page, and the list of BS4 city tables that the 'table' column refers to.
+    """
+    rows = []
+    tables = []
+    city = region = country = None
+
+    for tag in bs_object.find_all(['h2', 'table']):
+        if tag.name == 'h2':
+            parts = [p.strip() for p in tag.text.rsplit(',', 2)]
+            city, region, country = parts + [None] * (3 - len(parts))
+            continue
+
+        table_no = len(tables)
+        tables.append(tag)
+        table_class = ' '.join(tag.get('class', []))
+
+        for tr in tag.find_all('tr'):
+            cells = [''.join(td.stripped_strings) for td in tr.find_all('td')]
+            for a in tr.find_all('a', href=True):
+                href = a['href']
+                rows.append((country, region, city, table_no, table_class,
+                             cells[0] if cells else None,
+                             href.rsplit('/', 1)[-1],
+                             cells[-1] if len(cells) > 1 else None,
+                             href))
+
+    catalog = pd.DataFrame(rows, columns=CATALOG_COLUMNS)
+
+    return catalog, tables
+
+
+# =============================================================================
+# This function returns the catalog for a BS4 object, building it only the first
+# time the object is seen. A catalog dataframe can be passed in place of the BS4
+# object, and is returned as is.
+# =============================================================================
+
+def get_catalog(bs_object, with_tables=False):
+    """Returns the catalog dataframe of the BS4 object `bs_object`, or
+    `bs_object` itself if it already is a catalog. With `with_tables=True`, a
+    tuple of the catalog and the list of BS4 city tables is returned instead.
+    """
+    if isinstance(bs_object, pd.DataFrame):
+        return (bs_object, None) if with_tables else bs_object
+
+    ref = _last_catalog['ref']
+    if ref is None or ref() is not bs_object:
+        catalog, tables = build_catalog(bs_object)
+        _last_catalog.update(ref=weakref.ref(bs_object), catalog=catalog, tables=tables)
+
+    if with_tables:
+        return _last_catalog['catalog'], _last_catalog['tables']
+    return _last_catalog['catalog']
+
+
+# =============================================================================
+# This function selects the rows of the catalog for the cities matching
+# `city_name`. As with the city tables on the page, `city_name` is a regular
+# expression, usually the "|"-joined string returned by `list_cities()`. The
+# expression is compiled once and only tested against each distinct city table,
+# rather than against every table of the page for every lookup.
+# =============================================================================
+
+def select_cities(catalog, city_name=None):
+    """Returns the rows of the catalog whose city table class or city name
+    matches the regular expression `city_name` (case insensitive). If no city
+    is specified, the whole catalog is returned.
+    """
+    if city_name is None:
+        return catalog
+
+    pattern = re.compile(city_name, re.IGNORECASE)
+    tables = catalog[['table', 'table_class', 'city']].drop_duplicates('table')
+    matched = [t.table for t in tables.itertuples(index=False)
+               if pattern.search(t.table_class)
+               or any(pattern.search(c) for c in t.table_class.split())
+               or (t.city and pattern.search(t.city))]
+
+    return catalog[catalog['table'].isin(matched)]
+
+
+# =============================================================================
+# The following functions keep every parsed catalog in the SQLITE file
+# `catalog_db`. The 'catalog_versions' table has one row per distinct version of
+# the page, keyed by the sha256 hash of its html, and the 'catalog' table holds
+# the rows of each version.
+# =============================================================================
+
+def _connect_catalog_db(catalog_db):
+    conn = connect(catalog_db)
+    conn.execute("""create table if not exists catalog_versions (
+                        page_hash text primary key, saved_at text, files integer)""")
+    conn.execute("""create table if not exists catalog (
+                        page_hash text, country text, region text, city text,
+                        "table" integer, table_class text, date_compiled text,
+                        file_type text, description text, source_url text)""")
+    conn.execute("create index if not exists catalog_page_hash on catalog (page_hash)")
+    return conn
+
+
+def page_hash(page):
+    """Returns the sha256 hex digest of the html text of the page."""
+    return hashlib.sha256(page.encode('utf-8')).hexdigest()
+
+
+def load_catalog(page, catalog_db=CATALOG_DB):
+    """This function accepts the html text of the InsideAirBnB 'get the data'
+    page and returns its catalog dataframe. If this exact page has been seen
+    before, the catalog is read back from `catalog_db`; otherwise the page is
+    parsed with BS4 and the new catalog version is saved.
+    """
+    key = page_hash(page)
+    conn = _connect_catalog_db(catalog_db)
+    try:
+        if conn.execute("select 1 from catalog_versions where page_hash = ?", (key,)).fetchone():
+            return load_catalog_version(key, conn=conn)
+
+        from bs4 import BeautifulSoup
+        catalog, tables = build_catalog(BeautifulSoup(page, 'lxml'))
+
+        with conn:
+            conn.execute("insert into catalog_versions values (?, ?, ?)",
+                         (key, datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                          len(catalog)))
+            conn.executemany("insert into catalog values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             ((key,) + tuple(row) for row in
+                              catalog.astype(object).where(catalog.notna(), None).itertuples(index=False)))
+    finally:
+        conn.close()
+
+    return catalog
+
+
+def load_catalog_version(key=None, catalog_db=CATALOG_DB, conn=None):
+    """Returns the saved catalog with page hash `key`, or the most recently saved
+    catalog if no key is given. No network access or html parsing is needed.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = _connect_catalog_db(catalog_db)
+    try:
+        if key is None:
+            row = conn.execute("select page_hash from catalog_versions "
+                               "order by saved_at desc, rowid desc limit 1").fetchone()
+            if row is None:
+                raise LookupError('no catalog has been saved in ' + str(catalog_db))
+            key = row[0]
+        columns = ', '.join('"{0}"'.format(c) for c in CATALOG_COLUMNS)
+        catalog = pd.read_sql_query("select {0} from catalog where page_hash = ? order by rowid".format(columns),
+                                    conn, params=(key,))
+    finally:
+        if own_conn:
+            conn.close()
+
+    return catalog
+
+
+def list_catalog_versions(catalog_db=CATALOG_DB):
+    """Returns a dataframe of the saved catalog versions, oldest first."""
+    conn = _connect_catalog_db(catalog_db)
+    try:
+        return pd.read_sql_query("select * from catalog_versions order by saved_at, rowid", conn)
+    finally:
+        conn.close()
+
+
+# =============================================================================
+# This function compares two catalogs and returns the files that were added to,
+# or removed from, the site between them.
+# =============================================================================
+
+def diff_catalogs(old_catalog, new_catalog):
+    """Returns the rows of `new_catalog` that are not in `old_catalog` with
+    'change' set to 'added', followed by the rows of `old_catalog` that are no
+    longer in `new_catalog` with 'change' set to 'removed'.
+    """
+    added = new_catalog[~new_catalog['source_url'].isin(old_catalog['source_url'])]
+    removed = old_catalog[~old_catalog['source_url'].isin(new_catalog['source_url'])]
+
+    diff = pd.concat([added.assign(change='added'), removed.assign(change='removed')],
+                     ignore_index=True)
+    return diff
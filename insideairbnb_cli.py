@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB COMMAND LINE
+
+@author: anguyen1210
+
+This file contains the 'insideairbnb' command line tool, installed with the
+package (see 'pyproject.toml'). It runs the stages of 'insideairbnb_pipeline.py'
+with the settings of a config file, which can be overridden on the command line:
+
+    insideairbnb fetch               download the files of interest
+    insideairbnb ingest              download them and load them into the database
+    insideairbnb watch               poll the site, and ingest new files as they appear
+    insideairbnb query "select ..."  run a SQL query against the database, as csv
+
+For example, `insideairbnb ingest --countries "france|switzerland"
+--file-types listings.csv,calendar.csv.gz --db paris.db`. Add `--log-file` and
+`--metrics-file` to follow a long run from its structured logs and metrics (see
+'insideairbnb_metrics.py').
+"""
+import argparse
+import csv
+import sqlite3
+import sys
+
+import insideairbnb_metrics as metrics
+import insideairbnb_pipeline as pipeline
+
+
+def _parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default=pipeline.CONFIG_FILE,
+                        help='INI config file (default: %(default)s)')
+    common.add_argument('--db', dest='db_path', help='path of the SQLITE database')
+    common.add_argument('--countries', help='"|"-separated countries of interest, e.g. "france|switzerland"')
+    common.add_argument('--file-types', help='comma-separated files of interest, e.g. "listings.csv,calendar.csv.gz"')
+    common.add_argument('--history', action='store_true', default=None,
+                        help='select every snapshot instead of only the most recent one')
+    common.add_argument('--ingest-workers', type=int, help='processes used to parse the files')
+    common.add_argument('--backend', choices=['sqlite', 'parquet'], help='where files are ingested')
+    common.add_argument('--log-file', help='file the structured JSON logs are written to')
+    common.add_argument('--metrics-file', help='file the Prometheus metrics are written to')
+    common.add_argument('--metrics-port', type=int, help='local port the Prometheus metrics are served on')
+
+    parser = argparse.ArgumentParser(prog='insideairbnb', description='Download InsideAirBnb data '
+                                     'files and load them into a local SQLITE database.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fetch = commands.add_parser('fetch', parents=[common], help='download the files of interest')
+    fetch.add_argument('--replace', action='store_true',
+                       help='download files again if they changed on the server')
+
+    ingest = commands.add_parser('ingest', parents=[common], help='download the files of interest and '
+                                 'load the new ones into the database')
+    ingest.add_argument('--reload', action='store_true',
+                        help='load the files again even if they are already in the database')
+
+    watch = commands.add_parser('watch', parents=[common], help='poll the site, and download and '
+                                'ingest new files as they appear')
+    watch.add_argument('--interval', type=float, help='seconds between polls')
+    watch.add_argument('--jitter', type=float, help='random fraction added to or removed from the interval')
+    watch.add_argument('--max-polls', type=int, help='stop after this number of polls')
+
+    query = commands.add_parser('query', parents=[common], help='run a SQL query against the database')
+    query.add_argument('sql', help='the SQL query, e.g. "select * from source_info"')
+
+    return parser
+
+
+def _config(args):
+    config = pipeline.load_config(args.config)
+    if args.db_path:
+        config['db_path'] = args.db_path
+    if args.countries is not None:
+        config['countries'] = args.countries.strip() or None
+    if args.file_types:
+        config['file_types'] = [f.strip() for f in args.file_types.split(',') if f.strip()]
+    if args.history is not None:
+        config['history'] = args.history
+    if args.ingest_workers is not None:
+        config['ingest_workers'] = args.ingest_workers
+    if args.backend:
+        config['backend'] = args.backend
+    if args.log_file:
+        config['log_file'] = args.log_file
+    if args.metrics_file:
+        config['metrics_file'] = args.metrics_file
+    if args.metrics_port is not None:
+        config['metrics_port'] = args.metrics_port
+    if getattr(args, 'interval', None) is not None:
+        config['watch_interval'] = args.interval
+    if getattr(args, 'jitter', None) is not None:
+        config['watch_jitter'] = args.jitter
+    return config
+
+
+def _query(args, config):
+    try:
+        columns, rows = pipeline.query(args.sql, config)
+    except sqlite3.Error as e:
+        print('Query failed on {0}: {1}'.format(config['db_path'], e), file=sys.stderr)
+        return 1
+    writer = csv.writer(sys.stdout)
+    if columns:
+        writer.writerow(columns)
+    writer.writerows(rows)
+    return 0
+
+
+def _run(args, config):
+    if args.command == 'watch':
+        pipeline.watch(config, max_polls=args.max_polls)
+        return
+
+    import_list = pipeline.select_files(pipeline.fetch_catalog(config), config)
+    print('{0} file(s) selected'.format(len(import_list)))
+    pipeline.download(import_list, config, replace=getattr(args, 'replace', False))
+    if args.command == 'ingest':
+        pipeline.ingest(import_list, config, reload=args.reload)
+
+
+def main(argv=None):
+    """Runs the 'insideairbnb' command line tool, and returns its exit status."""
+    args = _parser().parse_args(argv)
+    config = _config(args)
+
+    if args.command == 'query':
+        return _query(args, config)
+
+    handler = metrics.configure_logging(config['log_file']) if config['log_file'] else None
+    stop_exporter = (metrics.start_exporter(config['metrics_file'], config['metrics_interval'])
+                     if config['metrics_file'] else None)
+    server = metrics.serve_prometheus(config['metrics_port']) if config['metrics_port'] else None
+    try:
+        with metrics.span('cli_' + args.command):
+            _run(args, config)
+    finally:
+        if stop_exporter is not None:
+            stop_exporter()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if handler is not None:
+            metrics.logger.removeHandler(handler)
+            handler.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB CONNECTION
+
+@author: anguyen1210
+
+This file contains the single place where connections to the local SQLITE
+database are opened, so that the scripts, the alerts, the watcher and the
+'insideairbnb' command line tool all agree on where the database is and how it
+is accessed. It only imports the standard library.
+
+The database path is no longer hard-coded in each script: it is the 'db_path'
+given by the caller, or else the INSIDEAIRBNB_DB environment variable, or else
+'insideairbnb.db' in the current directory.
+
+Every connection is opened with a busy timeout, so that a writer waits for
+another one to finish instead of failing at once with 'database is locked', and
+the database is switched to WAL journaling, in which readers never block the
+writer and the writer never blocks readers. Readers (queries, alert checks)
+should open the database with `read_only=True`: they then cannot modify it by
+mistake, and can run while an ingest is loading files. The catalog file and the
+page cache (see 'insideairbnb_catalog.py' and 'insideairbnb_http.py') are opened
+with `connect()` too, since a watcher and an ingest can write them at once.
+
+The lookups run again and again (is a snapshot loaded, what is the id of a
+url, ...) are written once in `STATEMENTS`. SQLITE keeps the statements it has
+prepared in a per-connection cache keyed on their SQL text, so running these
+through `lookup()` on a long-lived connection (see `shared_connection()`)
+prepares each of them only once.
+"""
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+
+DB_NAME = 'insideairbnb.db'
+DB_ENV_VAR = 'INSIDEAIRBNB_DB'
+
+# seconds a connection waits for a lock held by another connection before
+# raising 'database is locked'; an ingest commits every `COMMIT_ROWS` rows, so
+# this is ample for a watcher and an ingest writing to the same database
+BUSY_TIMEOUT = 60.0
+
+# number of prepared statements kept by each connection (sqlite3 default: 128)
+CACHED_STATEMENTS = 256
+
+# PRAGMA settings applied to every connection that can write. 'synchronous =
+# NORMAL' is safe in WAL mode (a power loss can only lose the last commits, not
+# corrupt the database) and avoids an fsync on every commit.
+WRITE_PRAGMAS = {'journal_mode': 'WAL',
+                 'synchronous': 'NORMAL'}
+
+# the hot lookups, see `lookup()`
+STATEMENTS = {'source_loaded': 'select 1 from source_info where source_url = ? limit 1',
+              'source_id': 'select source_id from source_ids where source_url = ?'}
+
+
+def default_db_path():
+    """Returns the path of the database used when none is given: the value of
+    the INSIDEAIRBNB_DB environment variable, or 'insideairbnb.db'.
+    """
+    return os.environ.get(DB_ENV_VAR) or DB_NAME
+
+
+def connect(db_path=None, read_only=False, timeout=BUSY_TIMEOUT):
+    """Returns a connection to the local SQLITE database at `db_path` (see
+    `default_db_path()`). Note, SQLITE will create a new database if it does not
+    find the name entered here, unless `read_only` is set, in which case a
+    missing database raises `sqlite3.OperationalError`.
+    """
+    db_path = db_path or default_db_path()
+    if read_only:
+        uri = 'file:{0}?mode=ro'.format(urllib.parse.quote(os.path.abspath(db_path)))
+        return sqlite3.connect(uri, uri=True, timeout=timeout, cached_statements=CACHED_STATEMENTS)
+
+    conn = sqlite3.connect(db_path, timeout=timeout, cached_statements=CACHED_STATEMENTS)
+    for name, value in WRITE_PRAGMAS.items():
+        conn.execute('pragma {0} = {1}'.format(name, value))
+    return conn
+
+
+# =============================================================================
+# These functions keep one connection per thread, database and mode, for the
+# long-running processes (the watcher, the alert dispatcher) that would
+# otherwise open and close a connection at every poll. A SQLITE connection
+# cannot be shared between threads, hence one pool per thread.
+# =============================================================================
+
+_pool = threading.local()
+
+
+def shared_connection(db_path=None, read_only=False):
+    """Returns the connection of the current thread to the database at
+    `db_path`, opening it on first use. Do not close it; use
+    `close_shared_connections()` instead.
+    """
+    connections = _pool.__dict__.setdefault('connections', {})
+    key = (os.path.abspath(db_path or default_db_path()), read_only)
+    if key not in connections:
+        connections[key] = connect(db_path, read_only=read_only)
+    return connections[key]
+
+
+def close_shared_connections():
+    """Closes the shared connections of the current thread."""
+    connections = _pool.__dict__.pop('connections', {})
+    for conn in connections.values():
+        conn.close()
+
+
+def quote_identifier(name):
+    """Returns the table or column name `name` quoted for use in SQL, e.g.
+    '"availability_365"'.
+    """
+    return '"{0}"'.format(str(name).replace('"', '""'))
+
+
+def lookup(conn, name, *params):
+    """Runs the statement `name` of `STATEMENTS` with `params` and returns the
+    first row, or None if there is none, e.g.
+    `lookup(conn, 'source_loaded', url)`.
+    """
+    return conn.execute(STATEMENTS[name], params).fetchone()
+
+
+def is_loaded(conn, source_url):
+    """Returns True if the snapshot `source_url` is recorded in the
+    'source_info' table of the database `conn`.
+    """
+    try:
+        return lookup(conn, 'source_loaded', source_url) is not None
+    except sqlite3.OperationalError as e:
+        if 'no such table' not in str(e):
+            raise
+        return False
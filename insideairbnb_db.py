@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB DATABASE
+
+@author: anguyen1210
+
+This file contains the functions used to load our locally saved InsideAirBnb
+files into the local SQLITE database. Files are read in bounded chunks and
+inserted with `executemany` inside batched transactions, so the memory used by a
+load depends on the chunk size rather than on the total size of the data.
+
+The 'source_info' table doubles as the ledger of the snapshots that have been
+loaded: `ingest_import_list()` only loads the files of an import list that are
+not in it yet, so a refresh takes time proportional to the new data.
+
+The much larger calendar and reviews files are loaded with the declared types
+of the 'insideairbnb_schema.py' file (integer cents for prices, booleans for
+availability, ISO dates) into their own 'calendar' and 'reviews' tables, which
+are indexed on (listing_id, date). Rather than repeating the snapshot url on
+each of their hundreds of millions of rows, these tables refer to it through an
+integer 'source_id' (see the 'source_ids' table).
+
+On a machine with many cores, `ingest_import_list_parallel()` parses the files
+in a pool of worker processes, while the main process alone writes to SQLITE.
+
+The rows and time of every file loaded are recorded in the metrics of the
+'insideairbnb_metrics.py' file.
+
+Connections are opened with `connect()` of the 'insideairbnb_connection.py'
+file (re-exported here), which sets the database path, WAL journaling and a busy
+timeout in one place.
+
+After each load, the 'listings_summary' table is refreshed for the new
+snapshots only: it has one row per city snapshot with its number of listings,
+its median and mean price and its availability, so that dashboards read a few
+hundred rows instead of scanning 'listings'.
+"""
+import concurrent.futures
+import contextlib
+import datetime
+import multiprocessing
+import os
+import queue
+import sqlite3
+import time
+
+import pandas as pd
+
+from insideairbnb_connection import DB_NAME, connect, is_loaded, lookup, quote_identifier
+from insideairbnb_metrics import inc, log_event, observe, progress, timed
+from insideairbnb_schema import TABLE_DTYPES, apply_dtypes, canonicalize
+from insideairbnb_tools import parse_source_urls, read_local_file
+
+
+CHUNKSIZE = 50000
+COMMIT_ROWS = 500000
+
+# PRAGMA settings used for the duration of a bulk load. WAL journaling and
+# 'synchronous=OFF' avoid an fsync per transaction, and a large page cache keeps
+# the table's b-tree pages in memory while rows are appended.
+BULK_LOAD_PRAGMAS = {'journal_mode': 'WAL',
+                     'synchronous': 'OFF',
+                     'cache_size': -256000,
+                     'temp_store': 'MEMORY'}
+
+# indexes created on each table once it has been loaded, so lookups by
+# snapshot, listing id, city or date do not scan the whole table
+TABLE_INDEXES = {'listings': [('source', 'id'), ('id',)],
+                 'listings_detailed': [('source', 'id'), ('id',)],
+                 'calendar': [('listing_id', 'date'), ('source_id',)],
+                 'reviews': [('listing_id', 'date'), ('source_id',)],
+                 'source_info': [('city',), ('last_update',)]}
+
+# unique keys created on each table once it has been loaded; a table whose rows
+# are not unique on its key gets a plain index instead
+TABLE_KEYS = {'source_info': ('source_url',)}
+
+SUMMARY_TABLE = 'listings_summary'
+
+# the column that identifies the snapshot of each row: the url itself for
+# 'listings', or its integer id in 'source_ids' for the larger tables
+SOURCE_COLUMNS = {'listings': 'source',
+                  'calendar': 'source_id',
+                  'reviews': 'source_id'}
+
+
+# =============================================================================
+# This context manager applies the `BULK_LOAD_PRAGMAS` to a connection for the
+# duration of a bulk load, and restores the previous settings afterwards. The
+# journal mode is left as WAL, since it persists in the database file and also
+# lets readers query the database while a load is running.
+# =============================================================================
+
+@contextlib.contextmanager
+def bulk_load_pragmas(conn, pragmas=BULK_LOAD_PRAGMAS):
+    """Applies `pragmas` to the SQLITE connection `conn` while the block runs.
+    Any open transaction is committed first, as some pragmas cannot be changed
+    inside a transaction.
+    """
+    conn.commit()
+    previous = {name: conn.execute('pragma {0}'.format(name)).fetchone()[0]
+                for name in pragmas if name != 'journal_mode'}
+    for name, value in pragmas.items():
+        conn.execute('pragma {0} = {1}'.format(name, value))
+    try:
+        yield conn
+    finally:
+        for name, value in previous.items():
+            conn.execute('pragma {0} = {1}'.format(name, value))
+
+
+# =============================================================================
+# These helper functions create the destination table from the columns of the
+# first chunk read, add any new columns found in later files, and convert a
+# chunk to plain python tuples (with missing values as NULL and dates as ISO
+# 'YYYY-MM-DD' text) for `executemany`. Columns with a declared type in
+# `TABLE_DTYPES` get the SQL type of their declared type, whatever pandas
+# inferred for the chunk that happens to create them.
+# =============================================================================
+
+def _sql_type(dtype):
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TEXT'
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+def _declared_sql_type(dtype):
+    if dtype == 'date':
+        return 'TEXT'
+    if dtype in ('cents', 'flag'):
+        return 'INTEGER'
+    return _sql_type(pd.api.types.pandas_dtype(dtype))
+
+
+def _column_type(table, column, dtype):
+    declared = TABLE_DTYPES.get(table, {}).get(column)
+    return _declared_sql_type(declared) if declared is not None else _sql_type(dtype)
+
+
+def table_columns(conn, table):
+    """Returns the list of column names of `table`, or an empty list if the
+    table does not exist.
+    """
+    return [row[1] for row in conn.execute('pragma table_info({0})'.format(quote_identifier(table)))]
+
+
+def _ensure_columns(conn, table, chunk):
+    existing = table_columns(conn, table)
+    if not existing:
+        columns = ', '.join('{0} {1}'.format(quote_identifier(c), _column_type(table, c, t))
+                            for c, t in chunk.dtypes.items())
+        conn.execute('create table {0} ({1})'.format(quote_identifier(table), columns))
+        return
+    for column, dtype in chunk.dtypes.items():
+        if column not in existing:
+            conn.execute('alter table {0} add column {1} {2}'.format(
+                quote_identifier(table), quote_identifier(column), _column_type(table, column, dtype)))
+
+
+def _chunk_rows(chunk):
+    dates = [c for c, t in chunk.dtypes.items() if pd.api.types.is_datetime64_any_dtype(t)]
+    if dates:
+        chunk = chunk.assign(**{c: chunk[c].dt.strftime('%Y-%m-%d') for c in dates})
+    return chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+
+
+# =============================================================================
+# This function streams a list of local csv files into a table of the SQLITE
+# database. Each file is read `chunksize` rows at a time and inserted with
+# `executemany`, committing every `commit_rows` rows. With the default
+# `if_exists='append'` rows are added to any existing table; `if_exists='replace'`
+# drops the table first, as `DataFrame.to_sql()` does.
+#
+# If a list of `sources` (usually the 'source_url' column of the import list) is
+# given, the matching source is added to every row as a 'source' column (or the
+# `source_column` given) while it is loaded, so the downloaded files themselves
+# never need to be rewritten. Columns are renamed to their canonical names (see
+# `canonicalize()`) as they are read, and if a dict of declared `dtypes` is
+# given, each chunk is converted with `apply_dtypes()` before it is inserted.
+# =============================================================================
+
+def _record_load(table, filename, rows, seconds):
+    inc('insideairbnb_rows_total', rows, stage='load', table=table)
+    observe('insideairbnb_load_seconds', seconds, table=table)
+    log_event('load', table=table, local_filename=filename, rows=rows, seconds=round(seconds, 6))
+
+
+@timed('load_csv_to_sqlite')
+def load_csv_to_sqlite(filenames, conn, table='listings', if_exists='append',
+                       chunksize=CHUNKSIZE, commit_rows=COMMIT_ROWS, sources=None,
+                       dtypes=None, source_column='source'):
+    """This function takes a list of local csv filenames (for example the
+    'local_filename' column returned by `get_local_filenames`), which may be
+    compressed or converted to Parquet, and streams them
+    into `table` of the SQLITE connection `conn` in chunks of `chunksize` rows,
+    tagging each row with the matching entry of `sources`, if given. Returns a
+    dataframe with the rows loaded, the time taken and the rows per second of
+    each file.
+    """
+    summary = []
+
+    with bulk_load_pragmas(conn):
+        if if_exists == 'replace':
+            conn.execute('drop table if exists {0}'.format(quote_identifier(table)))
+            conn.commit()
+
+        if sources is None:
+            sources = [None] * len(filenames)
+
+        pending = 0
+        for filename, source in zip(filenames, sources):
+            start = time.perf_counter()
+            rows = 0
+            for chunk in read_local_file(filename, chunksize=chunksize):
+                chunk = canonicalize(chunk)
+                if source is not None:
+                    chunk[source_column] = source
+                if dtypes is not None:
+                    chunk = apply_dtypes(chunk, dtypes)
+                _ensure_columns(conn, table, chunk)
+                sql = 'insert into {0} ({1}) values ({2})'.format(
+                    quote_identifier(table), ', '.join(quote_identifier(c) for c in chunk.columns),
+                    ', '.join('?' * len(chunk.columns)))
+                conn.executemany(sql, _chunk_rows(chunk))
+                rows += len(chunk)
+                pending += len(chunk)
+                if pending >= commit_rows:
+                    conn.commit()
+                    pending = 0
+            seconds = time.perf_counter() - start
+            _record_load(table, filename, rows, seconds)
+            print('Loaded {0:,} rows from {1} into {2} ({3:,.0f} rows/s)'.format(
+                rows, filename, table, rows / seconds if seconds else 0))
+            summary.append({'local_filename': filename, 'rows': rows, 'seconds': seconds,
+                            'rows_per_s': rows / seconds if seconds else None})
+        conn.commit()
+
+    summary = pd.DataFrame(summary, columns=['local_filename', 'rows', 'seconds', 'rows_per_s'])
+    if len(summary):
+        print('Loaded {0:,} rows in total ({1:,.0f} rows/s)'.format(
+            summary['rows'].sum(), summary['rows'].sum() / max(summary['seconds'].sum(), 1e-9)))
+
+    return summary
+
+
+# =============================================================================
+# The following functions support incremental updates of the database. Every
+# snapshot loaded into 'listings' is recorded in 'source_info', and its rows
+# carry the snapshot url in their 'source' column (or its id in their
+# 'source_id' column), so a single snapshot can be found, deleted or re-loaded
+# without touching the rest of the table.
+# =============================================================================
+
+def source_id(conn, source_url):
+    """Returns the integer id of `source_url` in the 'source_ids' table, adding
+    it if it is not there yet.
+    """
+    conn.execute('create table if not exists source_ids '
+                 '(source_id integer primary key, source_url text unique)')
+    conn.execute('insert or ignore into source_ids (source_url) values (?)', (source_url,))
+    return lookup(conn, 'source_id', source_url)[0]
+
+
+def delete_snapshot(conn, source_url, table='listings'):
+    """Deletes the rows of the snapshot `source_url` from `table` and from the
+    'source_info' table. Deleting a snapshot that is not loaded does nothing.
+    """
+    columns = table_columns(conn, table)
+    if 'source' in columns:
+        conn.execute('delete from {0} where source = ?'.format(quote_identifier(table)), (source_url,))
+    if 'source_id' in columns and table_columns(conn, 'source_ids'):
+        # a url without an id has no rows, and must not be given one here
+        row = lookup(conn, 'source_id', source_url)
+        if row is not None:
+            conn.execute('delete from {0} where source_id = ?'.format(quote_identifier(table)), row)
+    if table_columns(conn, 'source_info'):
+        conn.execute('delete from source_info where source_url = ?', (source_url,))
+    if table_columns(conn, SUMMARY_TABLE):
+        conn.execute('delete from {0} where source_url = ?'.format(SUMMARY_TABLE), (source_url,))
+    conn.commit()
+
+
+def _create_index(conn, table, columns, unique=False):
+    name = '_'.join((table,) + columns) if not unique else table + '_key'
+    conn.execute('create {0}index if not exists {1} on {2} ({3})'.format(
+        'unique ' if unique else '', quote_identifier(name), quote_identifier(table),
+        ', '.join(quote_identifier(c) for c in columns)))
+
+
+def create_table_indexes(conn, table):
+    """Creates the key listed for `table` in `TABLE_KEYS` and the indexes
+    listed in `TABLE_INDEXES`, if they do not exist yet. Indexes on columns the
+    table does not have are skipped.
+    """
+    existing = set(table_columns(conn, table))
+    key = TABLE_KEYS.get(table)
+    if key and existing.issuperset(key):
+        try:
+            _create_index(conn, table, key, unique=True)
+        except sqlite3.IntegrityError:
+            print('The rows of {0} are not unique on {1}; creating a plain index instead'.format(table, key))
+            _create_index(conn, table, key)
+    for columns in TABLE_INDEXES.get(table, [('source',)]):
+        if existing.issuperset(columns):
+            _create_index(conn, table, columns)
+
+
+def _insert_dataframe(conn, table, df):
+    _ensure_columns(conn, table, df)
+    conn.executemany('insert into {0} ({1}) values ({2})'.format(
+        quote_identifier(table), ', '.join(quote_identifier(c) for c in df.columns),
+        ', '.join('?' * len(df.columns))),
+        _chunk_rows(df))
+
+
+def _record_snapshot(conn, plan, i):
+    row = plan.loc[[i], ['source_url', 'country', 'region', 'city', 'last_update']].assign(
+        loaded_at=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'))
+    _insert_dataframe(conn, 'source_info', row)
+    create_table_indexes(conn, 'source_info')
+
+
+# =============================================================================
+# This function takes the import list returned by `extract_file_url()`, whose
+# files have been saved locally with `save_insideairbnb_file()`, and loads only
+# the snapshots that are not yet recorded in 'source_info'. Any rows left over
+# from an interrupted load of a snapshot are deleted before it is loaded, and
+# its 'source_info' row is only written once all of its rows are in, so running
+# the same import list again is always safe. Use `reload=True` to re-ingest
+# snapshots that are already loaded.
+#
+# Import lists of 'calendar.csv.gz' or 'reviews.csv.gz' files should be loaded
+# with `table='calendar'` or `table='reviews'`; the declared types and indexes
+# of that table are then used.
+# =============================================================================
+
+@timed('ingest_import_list')
+def ingest_import_list(import_list_df, conn, table='listings', reload=False,
+                       chunksize=CHUNKSIZE, dtypes=None):
+    """This function loads the locally saved files of the import list
+    `import_list_df` that are not already in the database into `table`, records
+    them in 'source_info', and returns a dataframe with the rows loaded per file.
+    Files are loaded with the declared `dtypes`, which default to those of
+    `table` (see `TABLE_DTYPES`), e.g. with prices in integer cents.
+    """
+    if dtypes is None:
+        dtypes = TABLE_DTYPES.get(table)
+
+    plan = parse_source_urls(import_list_df).reset_index(drop=True)
+    todo = [i for i, url in enumerate(plan['source_url']) if reload or not is_loaded(conn, url)]
+
+    summary = []
+    for i in todo:
+        url = plan['source_url'].iloc[i]
+        delete_snapshot(conn, url, table)
+        source_column = SOURCE_COLUMNS.get(table, 'source')
+        source = source_id(conn, url) if source_column == 'source_id' else url
+        result = load_csv_to_sqlite([plan['local_filename'].iloc[i]], conn, table,
+                                    chunksize=chunksize, sources=[source], dtypes=dtypes,
+                                    source_column=source_column)
+        _record_snapshot(conn, plan, i)
+        conn.commit()
+        summary.append(result.assign(source_url=url))
+        progress('load_' + table, len(summary), len(todo))
+
+    if not summary:
+        print('The import list supplied does not contain any new files')
+        return pd.DataFrame(columns=['local_filename', 'rows', 'seconds', 'rows_per_s', 'source_url'])
+
+    # the indexes are built once all the files are in, rather than updated row
+    # by row while they are loaded
+    create_table_indexes(conn, table)
+    conn.commit()
+    summary = pd.concat(summary, ignore_index=True)
+    if table == 'listings':
+        refresh_listings_summary(conn, list(summary['source_url']))
+
+    return summary
+
+
+# =============================================================================
+# The following functions load an import list in parallel. Parsing a csv file
+# and applying the declared types is CPU-bound, while SQLITE only allows one
+# writer at a time, so the files are parsed by a pool of `workers` processes,
+# each of which sends its chunks, ready to insert, to the main process through
+# a bounded queue. The main process is the single writer: it inserts the chunks
+# as they arrive, whatever file they come from, and records each snapshot in
+# 'source_info' once its last chunk is in. When the writer falls behind, the
+# queue fills up and the workers wait, so at most `max_pending` chunks are held
+# in memory besides the one each worker is parsing.
+# =============================================================================
+
+_parse_queue = None
+
+
+def _init_parse_worker(chunk_queue):
+    global _parse_queue
+    _parse_queue = chunk_queue
+
+
+def _parse_file(i, filename, source, source_column, dtypes, chunksize):
+    start = time.perf_counter()
+    rows = 0
+    try:
+        for chunk in read_local_file(filename, chunksize=chunksize):
+            chunk = canonicalize(chunk)
+            chunk[source_column] = source
+            if dtypes is not None:
+                chunk = apply_dtypes(chunk, dtypes)
+            # an empty frame carries the column types, for `_ensure_columns()`
+            _parse_queue.put(('chunk', i, chunk.iloc[:0], list(_chunk_rows(chunk))))
+            rows += len(chunk)
+    except Exception as e:
+        _parse_queue.put(('error', i, repr(e)))
+        return
+    _parse_queue.put(('done', i, rows, time.perf_counter() - start))
+
+
+@timed('ingest_import_list_parallel')
+def ingest_import_list_parallel(import_list_df, conn, table='listings', reload=False,
+                                workers=None, chunksize=CHUNKSIZE, commit_rows=COMMIT_ROWS,
+                                dtypes=None, max_pending=None):
+    """This function loads the locally saved files of the import list
+    `import_list_df` that are not already in the database into `table`, as
+    `ingest_import_list()` does, but parses them in `workers` processes (by
+    default, one per core). Returns a dataframe with the rows loaded per file;
+    'seconds' is the time spent parsing the file.
+    """
+    if dtypes is None:
+        dtypes = TABLE_DTYPES.get(table)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    source_column = SOURCE_COLUMNS.get(table, 'source')
+
+    plan = parse_source_urls(import_list_df).reset_index(drop=True)
+    todo = [i for i, url in enumerate(plan['source_url']) if reload or not is_loaded(conn, url)]
+    if not todo:
+        print('The import list supplied does not contain any new files')
+        return pd.DataFrame(columns=['local_filename', 'rows', 'seconds', 'rows_per_s', 'source_url'])
+
+    sources = {}
+    for i in todo:
+        url = plan['source_url'].iloc[i]
+        delete_snapshot(conn, url, table)
+        sources[i] = source_id(conn, url) if source_column == 'source_id' else url
+    conn.commit()
+
+    context = multiprocessing.get_context()
+    chunk_queue = context.Queue(max_pending)
+    summary = []
+    start = time.perf_counter()
+
+    with bulk_load_pragmas(conn), concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=context, initializer=_init_parse_worker, initargs=(chunk_queue,)) as pool:
+        futures = {pool.submit(_parse_file, i, plan['local_filename'].iloc[i], sources[i],
+                               source_column, dtypes, chunksize): i for i in todo}
+        remaining = set(todo)
+        pending = 0
+        try:
+            while remaining:
+                try:
+                    message = chunk_queue.get(timeout=1.0)
+                except queue.Empty:
+                    # a worker that died (rather than raised) never reports back
+                    for future, i in futures.items():
+                        if i in remaining and future.done() and future.exception() is not None:
+                            print('Failed to parse {0}: {1!r}'.format(plan['local_filename'].iloc[i],
+                                                                     future.exception()))
+                            delete_snapshot(conn, plan['source_url'].iloc[i], table)
+                            remaining.discard(i)
+                    continue
+
+                kind, i = message[0], message[1]
+                if kind == 'chunk':
+                    columns, rows = message[2], message[3]
+                    _ensure_columns(conn, table, columns)
+                    conn.executemany('insert into {0} ({1}) values ({2})'.format(
+                        quote_identifier(table), ', '.join(quote_identifier(c) for c in columns.columns),
+                        ', '.join('?' * len(columns.columns))), rows)
+                    pending += len(rows)
+                    if pending >= commit_rows:
+                        conn.commit()
+                        pending = 0
+                elif kind == 'done':
+                    rows, seconds = message[2], message[3]
+                    _record_snapshot(conn, plan, i)
+                    conn.commit()
+                    pending = 0
+                    _record_load(table, plan['local_filename'].iloc[i], rows, seconds)
+                    print('Loaded {0:,} rows from {1} into {2} ({3:,.0f} rows/s parsed)'.format(
+                        rows, plan['local_filename'].iloc[i], table, rows / seconds if seconds else 0))
+                    summary.append({'local_filename': plan['local_filename'].iloc[i], 'rows': rows,
+                                    'seconds': seconds, 'rows_per_s': rows / seconds if seconds else None,
+                                    'source_url': plan['source_url'].iloc[i]})
+                    remaining.discard(i)
+                    progress('load_' + table, len(todo) - len(remaining), len(todo))
+                else:
+                    print('Failed to parse {0}: {1}'.format(plan['local_filename'].iloc[i], message[2]))
+                    delete_snapshot(conn, plan['source_url'].iloc[i], table)
+                    remaining.discard(i)
+                    progress('load_' + table, len(todo) - len(remaining), len(todo))
+        except BaseException:
+            # unblock the workers waiting on a full queue, so the pool can shut down
+            for future in futures:
+                future.cancel()
+            while not all(future.done() for future in futures):
+                try:
+                    chunk_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        create_table_indexes(conn, table)
+        conn.commit()
+
+    seconds = time.perf_counter() - start
+    summary = pd.DataFrame(summary, columns=['local_filename', 'rows', 'seconds', 'rows_per_s', 'source_url'])
+    if table == 'listings' and len(summary):
+        refresh_listings_summary(conn, list(summary['source_url']))
+    print('Loaded {0:,} rows in total with {1} workers ({2:,.0f} rows/s)'.format(
+        summary['rows'].sum(), workers, summary['rows'].sum() / seconds if seconds else 0))
+
+    return summary
+
+
+# =============================================================================
+# This function maintains the 'listings_summary' table: one row per snapshot
+# loaded into 'listings' (i.e. per city and date, for each listings file), with
+# the number of listings, the median and mean nightly price, the mean
+# 'availability_365' and the number of listings available at all. Only the
+# snapshots given in `sources` are recomputed, or by default those that are in
+# 'listings' but not in the summary yet, so a refresh costs time proportional to
+# the new data. The median is computed by SQLITE with window functions, in
+# dollars, from the prices stored in integer cents (or, in tables loaded before
+# prices were typed, from text such as '$1,234.00' parsed as a number).
+# =============================================================================
+
+@timed('refresh_listings_summary')
+def refresh_listings_summary(conn, sources=None):
+    """Recomputes the 'listings_summary' rows of the snapshot urls `sources` (by
+    default, of the snapshots not summarized yet), and returns the number of
+    snapshots refreshed.
+    """
+    columns = table_columns(conn, 'listings')
+    if not columns:
+        return 0
+
+    conn.execute("""create table if not exists {0} (
+                        source_url text primary key, country text, region text, city text,
+                        last_update text, listings integer, median_price real, mean_price real,
+                        mean_availability_365 real, available_listings integer,
+                        refreshed_at text)""".format(SUMMARY_TABLE))
+    conn.execute("create index if not exists {0}_city on {0} (city, last_update)".format(SUMMARY_TABLE))
+
+    if sources is None:
+        sources = [row[0] for row in conn.execute(
+            "select distinct source from listings where source not in "
+            "(select source_url from {0})".format(SUMMARY_TABLE))]
+    if not sources:
+        return 0
+
+    conn.execute("create temp table if not exists summary_sources (source_url text primary key)")
+    conn.execute("delete from temp.summary_sources")
+    conn.executemany("insert or ignore into temp.summary_sources values (?)", ((s,) for s in sources))
+    conn.execute("delete from {0} where source_url in (select source_url from temp.summary_sources)".format(
+        SUMMARY_TABLE))
+
+    price = ("case when typeof(l.price) = 'integer' then l.price / 100.0 "
+             "else cast(nullif(replace(replace(trim(l.price), '$', ''), ',', ''), '') as real) end"
+             if 'price' in columns else 'null')
+    availability = 'l.availability_365' if 'availability_365' in columns else 'null'
+    if table_columns(conn, 'source_info'):
+        info_join = 'left join source_info i on i.source_url = t.source'
+        info_columns = 'i.country, i.region, i.city, i.last_update'
+    else:
+        info_join = ''
+        info_columns = 'null, null, null, null'
+
+    conn.execute("""
+        with snapshot as (
+            select l.source, {price} as price, {availability} as availability
+            from temp.summary_sources s join listings l on l.source = s.source_url),
+        ranked as (
+            select source, price,
+                   row_number() over (partition by source order by price) as rn,
+                   count(*) over (partition by source) as n
+            from snapshot where price is not null),
+        medians as (
+            select source, avg(price) as median_price
+            from ranked where rn in ((n + 1) / 2, (n + 2) / 2) group by source),
+        totals as (
+            select source, count(*) as listings, avg(price) as mean_price,
+                   avg(availability) as mean_availability_365,
+                   sum(availability > 0) as available_listings
+            from snapshot group by source)
+        insert into {table}
+        select t.source, {info_columns}, t.listings, m.median_price, t.mean_price,
+               t.mean_availability_365, t.available_listings, ?
+        from totals t left join medians m on m.source = t.source {info_join}
+        """.format(price=price, availability=availability, table=SUMMARY_TABLE,
+                   info_columns=info_columns, info_join=info_join),
+        (datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),))
+    conn.execute("delete from temp.summary_sources")
+    conn.commit()
+
+    return len(sources)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB DIFF
+
+@author: anguyen1210
+
+This file contains tools to compare the snapshots of a city's listings taken at
+different dates, keyed on the listing id: which listings appeared, which
+disappeared, and which changed price (or room type, minimum nights, ...).
+
+Rather than loading two full snapshots into pandas and merging them, each
+snapshot is streamed a chunk at a time and reduced to a fingerprint: the
+listing id, the price in cents, and a 64-bit hash of each other compared column.
+The fingerprints of two snapshots are then compared on their sorted ids, so the
+memory used depends on the number of listings and compared columns, not on the
+width of the files: each fingerprint is held in full, at 8 bytes for the id, the
+price and each compared column, so about 100 bytes per listing with the default
+`DIFF_COLUMNS`. Diffing two snapshots of a city of 100,000 listings therefore
+takes about 20 MB, plus the same again while the diff itself is built; the
+largest cities on the site have well under a million listings per snapshot.
+
+The differences between consecutive snapshots of each city are stored in the
+compact 'listing_changes' table of the database, so that the history of a
+listing, or the churn of a city, can be queried without rescanning every
+snapshot.
+"""
+import datetime
+
+import pandas as pd
+
+from insideairbnb_connection import quote_identifier
+from insideairbnb_db import source_id, table_columns
+from insideairbnb_metrics import timed
+from insideairbnb_schema import apply_dtypes, canonicalize
+from insideairbnb_tools import parse_source_urls, read_local_file
+
+
+CHUNKSIZE = 50000
+
+# the columns compared between snapshots, besides the price
+DIFF_COLUMNS = ['name', 'host_id', 'room_type', 'property_type', 'accommodates', 'latitude',
+                'longitude', 'minimum_nights', 'availability_365', 'number_of_reviews']
+
+
+# =============================================================================
+# These functions reduce a snapshot to its fingerprint: a dataframe indexed by
+# the sorted listing ids, with a 'price' column in cents and a column of 64-bit
+# hashes for each of the compared columns the snapshot has. Numbers are hashed
+# as floats, so that a count read as 3 in one file and 3.0 in another (because
+# it has missing values) is not reported as a change.
+# =============================================================================
+
+def _fingerprint_chunk(chunk, columns):
+    chunk = canonicalize(chunk)
+    ids = pd.to_numeric(chunk['id'], errors='coerce')
+    chunk = chunk[ids.notna()]
+
+    fingerprint = {'id': ids[ids.notna()].astype('int64').to_numpy()}
+    if 'price' in chunk:
+        fingerprint['price'] = apply_dtypes(chunk[['price']], {'price': 'cents'})['price'].to_numpy()
+    for column in columns:
+        if column not in chunk:
+            continue
+        values = chunk[column]
+        if pd.api.types.is_numeric_dtype(values):
+            values = values.astype('float64')
+        else:
+            values = values.astype('string').str.strip()
+        fingerprint[column] = pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+    return pd.DataFrame(fingerprint)
+
+
+def snapshot_fingerprint(chunks, columns=DIFF_COLUMNS):
+    """Returns the fingerprint of a snapshot given as an iterable of dataframe
+    `chunks`, comparing the `columns` besides the price.
+    """
+    parts = [_fingerprint_chunk(chunk, columns) for chunk in chunks]
+    if not parts:
+        return pd.DataFrame(index=pd.Index([], dtype='int64', name='id'))
+    fingerprint = pd.concat(parts, ignore_index=True)
+    fingerprint = fingerprint.drop_duplicates('id', keep='last').set_index('id').sort_index()
+
+    return fingerprint
+
+
+def file_fingerprint(filename, columns=DIFF_COLUMNS, chunksize=CHUNKSIZE):
+    """Returns the fingerprint of the locally saved listings file `filename`."""
+    return snapshot_fingerprint(read_local_file(filename, chunksize=chunksize), columns)
+
+
+def loaded_fingerprint(conn, source_url, columns=DIFF_COLUMNS, chunksize=CHUNKSIZE):
+    """Returns the fingerprint of the snapshot `source_url` loaded into the
+    'listings' table of the database `conn`.
+    """
+    available = table_columns(conn, 'listings')
+    selected = [quote_identifier(c) for c in ['id'] + list(columns) if c in available]
+    if 'price' in available:
+        # prices are stored in integer cents, or as text in tables loaded before
+        # prices were typed; the fingerprint parses them back from dollars
+        selected.append("case when typeof(price) = 'integer' then price / 100.0 else price end as price")
+    sql = 'select {0} from listings where source = ?'.format(', '.join(selected))
+    return snapshot_fingerprint(pd.read_sql_query(sql, conn, params=(source_url,), chunksize=chunksize),
+                                columns)
+
+
+# =============================================================================
+# This function compares two fingerprints. Listings only in the new snapshot
+# are 'added', listings only in the old one are 'removed', and listings in both
+# whose price or any of the compared columns differ are 'changed', with the
+# names of the columns that changed. Columns that only one of the snapshots has
+# are not compared.
+# =============================================================================
+
+def diff_fingerprints(old, new):
+    """Returns a dataframe with the 'listing_id', the 'change' ('added',
+    'removed' or 'changed'), the 'changed_columns', and the 'old_price' and
+    'new_price' in cents of every listing that differs between the `old` and
+    `new` fingerprints.
+    """
+    empty_price = pd.Series(pd.NA, dtype='Int64')
+    old_price = old['price'].astype('Int64') if 'price' in old else empty_price.reindex(old.index)
+    new_price = new['price'].astype('Int64') if 'price' in new else empty_price.reindex(new.index)
+
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    common = old.index.intersection(new.index)
+
+    changed_columns = pd.Series('', index=common, dtype=object)
+    if 'price' in old and 'price' in new:
+        before, after = old_price.loc[common], new_price.loc[common]
+        differs = (before != after).fillna(before.isna() != after.isna()).to_numpy(dtype=bool)
+        changed_columns[differs] += 'price,'
+    for column in old.columns:
+        if column == 'price' or column not in new:
+            continue
+        differs = old[column].loc[common].to_numpy() != new[column].loc[common].to_numpy()
+        changed_columns[differs] += column + ','
+    changed = changed_columns[changed_columns != '']
+
+    diff = pd.concat([
+        pd.DataFrame({'listing_id': added, 'change': 'added', 'changed_columns': None,
+                      'old_price': empty_price.reindex(added).to_numpy(),
+                      'new_price': new_price.loc[added].to_numpy()}),
+        pd.DataFrame({'listing_id': removed, 'change': 'removed', 'changed_columns': None,
+                      'old_price': old_price.loc[removed].to_numpy(),
+                      'new_price': empty_price.reindex(removed).to_numpy()}),
+        pd.DataFrame({'listing_id': changed.index, 'change': 'changed',
+                      'changed_columns': changed.str.rstrip(',').to_numpy(),
+                      'old_price': old_price.loc[changed.index].to_numpy(),
+                      'new_price': new_price.loc[changed.index].to_numpy()}),
+    ], ignore_index=True)
+    diff['listing_id'] = diff['listing_id'].astype('int64')
+    diff[['old_price', 'new_price']] = diff[['old_price', 'new_price']].astype('Int64')
+
+    return diff.sort_values(['listing_id', 'change'], kind='stable').reset_index(drop=True)
+
+
+def diff_snapshot_files(old_filename, new_filename, columns=DIFF_COLUMNS, chunksize=CHUNKSIZE):
+    """Returns the differences between two locally saved listings files, see
+    `diff_fingerprints()`.
+    """
+    return diff_fingerprints(file_fingerprint(old_filename, columns, chunksize),
+                             file_fingerprint(new_filename, columns, chunksize))
+
+
+# =============================================================================
+# The following functions keep the change log in the database. The
+# 'listing_changes' table holds the differences between pairs of snapshots,
+# which refer to their urls through the integer ids of the 'source_ids' table,
+# and the 'snapshot_diffs' table records each pair compared, with its counts of
+# added, removed and changed listings, so no pair is ever compared twice.
+# =============================================================================
+
+def _create_change_tables(conn):
+    conn.execute('create table if not exists source_ids '
+                 '(source_id integer primary key, source_url text unique)')
+    conn.execute("""create table if not exists listing_changes (
+                        old_source_id integer, new_source_id integer, listing_id integer,
+                        change text, changed_columns text, old_price integer, new_price integer)""")
+    conn.execute("create index if not exists listing_changes_listing_id on listing_changes (listing_id)")
+    conn.execute("create index if not exists listing_changes_new_source_id on listing_changes (new_source_id)")
+    conn.execute("""create table if not exists snapshot_diffs (
+                        old_source_id integer, new_source_id integer, added integer, removed integer,
+                        changed integer, computed_at text, primary key (old_source_id, new_source_id))""")
+
+
+def store_changes(conn, old_source_url, new_source_url, diff):
+    """Stores the differences `diff` between the snapshots `old_source_url` and
+    `new_source_url` in the change log, replacing any stored before.
+    """
+    _create_change_tables(conn)
+    old_id, new_id = source_id(conn, old_source_url), source_id(conn, new_source_url)
+    conn.execute("delete from listing_changes where old_source_id = ? and new_source_id = ?", (old_id, new_id))
+    conn.executemany("insert into listing_changes values (?, ?, ?, ?, ?, ?, ?)",
+                     ((old_id, new_id, int(listing_id), change, columns,
+                       None if pd.isna(old_price) else int(old_price),
+                       None if pd.isna(new_price) else int(new_price))
+                      for listing_id, change, columns, old_price, new_price in
+                      diff[['listing_id', 'change', 'changed_columns', 'old_price', 'new_price']]
+                      .itertuples(index=False, name=None)))
+    counts = diff['change'].value_counts()
+    conn.execute("insert or replace into snapshot_diffs values (?, ?, ?, ?, ?, ?)",
+                 (old_id, new_id, int(counts.get('added', 0)), int(counts.get('removed', 0)),
+                  int(counts.get('changed', 0)),
+                  datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')))
+    conn.commit()
+
+
+# =============================================================================
+# This function brings the change log up to date. The listings snapshots
+# recorded in 'source_info' are grouped by country, region, city and file (the
+# snapshots of one file of one city are only compared with each other), ordered
+# by date, and each pair of consecutive snapshots that has not been compared yet
+# is diffed from the 'listings' table.
+# Use `city` to only update the cities matching a regular expression.
+# =============================================================================
+
+@timed('update_change_log')
+def update_change_log(conn, city=None, columns=DIFF_COLUMNS):
+    """Diffs every pair of consecutive listings snapshots of the database
+    `conn` that is not in the change log yet, stores the results, and returns a
+    dataframe with the counts of each pair diffed.
+    """
+    summary_columns = ['old_source_url', 'new_source_url', 'added', 'removed', 'changed']
+    if not table_columns(conn, 'source_info') or not table_columns(conn, 'listings'):
+        return pd.DataFrame(columns=summary_columns)
+    _create_change_tables(conn)
+
+    snapshots = pd.read_sql_query("select source_url, city, last_update from source_info "
+                                  "where exists (select 1 from listings where source = source_url)", conn)
+    if city is not None:
+        snapshots = snapshots[snapshots['city'].str.contains(city, regex=True, case=False, na=False)]
+    # cities of the same name in different countries or regions (e.g. the
+    # several 'victoria's) are different cities
+    keys = parse_source_urls(snapshots)
+    for key in ['country', 'region']:
+        snapshots[key] = keys[key]
+    snapshots['file'] = keys['source_folder'] + '/' + keys['source_filename']
+    group_keys = ['country', 'region', 'city', 'file']
+    snapshots = snapshots.sort_values(group_keys + ['last_update'], kind='stable')
+
+    done = set(conn.execute("select o.source_url, n.source_url from snapshot_diffs d "
+                            "join source_ids o on o.source_id = d.old_source_id "
+                            "join source_ids n on n.source_id = d.new_source_id").fetchall())
+    summary = []
+    for _, group in snapshots.groupby(group_keys, sort=False):
+        urls = list(group['source_url'])
+        for old_url, new_url in zip(urls[:-1], urls[1:]):
+            if (old_url, new_url) in done:
+                continue
+            diff = diff_fingerprints(loaded_fingerprint(conn, old_url, columns),
+                                     loaded_fingerprint(conn, new_url, columns))
+            store_changes(conn, old_url, new_url, diff)
+            counts = diff['change'].value_counts()
+            summary.append({'old_source_url': old_url, 'new_source_url': new_url,
+                            'added': int(counts.get('added', 0)), 'removed': int(counts.get('removed', 0)),
+                            'changed': int(counts.get('changed', 0))})
+            print('Diffed {0} -> {1}: {added} added, {removed} removed, {changed} changed'.format(
+                old_url, new_url, **summary[-1]))
+
+    return pd.DataFrame(summary, columns=summary_columns)
+
+
+def listing_history(conn, listing_id):
+    """Returns the changes of the listing `listing_id` recorded in the change
+    log, oldest first, with the city and dates of the two snapshots compared.
+    """
+    return pd.read_sql_query("""select c.listing_id, c.change, c.changed_columns, c.old_price, c.new_price,
+                                       i.city, io.last_update as old_last_update, i.last_update as new_last_update
+                                from listing_changes c
+                                join source_ids n on n.source_id = c.new_source_id
+                                join source_ids o on o.source_id = c.old_source_id
+                                left join source_info i on i.source_url = n.source_url
+                                left join source_info io on io.source_url = o.source_url
+                                where c.listing_id = ?
+                                order by i.last_update""", conn, params=(int(listing_id),))
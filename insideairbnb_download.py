@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB DOWNLOADS
+
+@author: anguyen1210
+
+This file contains the download engine used by `save_insideairbnb_file()` in the
+'insideairbnb_tools.py' file. Files are fetched concurrently over a pooled
+`requests.Session` and streamed to disk in chunks, so memory use stays flat no
+matter how large the files on the InsideAirBnb site are.
+
+Every completed download is recorded in a JSON manifest kept at the root of the
+local data tree, with the url, size, ETag/Last-Modified validators and a sha256
+hash of the file. The manifest is used to resume interrupted downloads with
+Range requests and to re-check existing files with conditional requests, so a
+refresh only transfers the files that actually changed.
+
+Each download records its latency (labelled with its city and file), its bytes
+and its status in the metrics of the 'insideairbnb_metrics.py' file, and the
+bytes received so far by the running downloads of each city and file are kept in
+a gauge, so that a stalled download can be spotted while it runs.
+"""
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from insideairbnb_metrics import add_gauge, inc, log_event, observe, progress
+
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = (10, 60)
+MANIFEST_FILENAME = 'insideairbnb_manifest.json'
+
+
+# =============================================================================
+# These functions read and write the download manifest. The manifest is a dict
+# keyed by url, and is written to a temporary file first and then renamed so
+# that a crash while saving can never corrupt it.
+# =============================================================================
+
+def load_manifest(manifest_path=MANIFEST_FILENAME):
+    """Returns the download manifest stored at `manifest_path` as a dict keyed
+    by url, or an empty dict if no manifest exists yet.
+    """
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path=MANIFEST_FILENAME):
+    """Writes the `manifest` dict to `manifest_path` atomically."""
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_sha256(filename, chunk_size=CHUNK_SIZE):
+    """Returns the sha256 hex digest of a local file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _matches_entry(filename, entry):
+    return (os.path.getsize(filename) == entry.get('size')
+            and file_sha256(filename) == entry.get('sha256'))
+
+
+# =============================================================================
+# This function re-hashes every local file listed in the manifest and returns a
+# dataframe flagging the files that are missing or no longer match the size and
+# hash recorded when they were downloaded.
+# =============================================================================
+
+def verify_manifest(manifest_path=MANIFEST_FILENAME):
+    """Checks every file in the manifest against its recorded size and sha256
+    hash, and returns a dataframe with a 'status' column of 'ok', 'missing' or
+    'corrupt' for each url.
+    """
+    results = []
+    for url, entry in load_manifest(manifest_path).items():
+        filename = entry['local_filename']
+        if not os.path.isfile(filename):
+            status = 'missing'
+        elif not _matches_entry(filename, entry):
+            status = 'corrupt'
+        else:
+            status = 'ok'
+        results.append({'source_url': url, 'local_filename': filename, 'status': status})
+
+    return pd.DataFrame(results, columns=['source_url', 'local_filename', 'status'])
+
+
+# =============================================================================
+# This function creates the `requests.Session` shared by all download workers.
+# The connection pool is sized to the number of workers so that every thread
+# can keep its own connection to 'data.insideairbnb.com' alive between files.
+# =============================================================================
+
+def make_session(workers=4):
+    """Returns a `requests.Session` with a connection pool large enough for
+    `workers` concurrent downloads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# =============================================================================
+# This function downloads a single url to a local filename. The body is streamed
+# in chunks to a temporary '.part' file next to the target, which is renamed
+# into place only once the download has completed and its size has been checked
+# against the server's Content-Length. A crash can therefore never leave a
+# half-written file under the final filename.
+#
+# If a '.part' file is left over from an earlier attempt, the download resumes
+# from where it stopped with a Range request. If a manifest `entry` is given for
+# a complete local file, the request is made conditional on its ETag or
+# Last-Modified date, and a '304 Not Modified' reply costs no body at all. A 304
+# only vouches for the file the validators were recorded for, so the local file
+# is first checked against the size and sha256 hash of the entry; a file that no
+# longer matches is downloaded again in full.
+# =============================================================================
+
+def download_file(session, url, filename, chunk_size=CHUNK_SIZE, entry=None):
+    """Streams `url` to `filename` through a temporary file, resuming or
+    revalidating with the validators in the manifest `entry` where possible.
+    Returns a dict with the download status, the bytes transferred, the time
+    taken, and the new manifest entry for the file.
+    """
+    pathlib.Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    part_filename = filename + '.part'
+    headers = {'Accept-Encoding': 'identity'}
+    digest = hashlib.sha256()
+    offset = 0
+
+    if entry and os.path.isfile(filename) and _matches_entry(filename, entry):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    elif os.path.isfile(part_filename) and os.path.isfile(part_filename + '.json'):
+        with open(part_filename + '.json', encoding='utf-8') as f:
+            validator = json.load(f).get('validator')
+        if validator:
+            offset = os.path.getsize(part_filename)
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            headers['If-Range'] = validator
+
+    start = time.perf_counter()
+    nbytes = 0
+    with session.get(url, stream=True, timeout=TIMEOUT, headers=headers) as req:
+        if req.status_code == 304:
+            return {'source_url': url, 'local_filename': filename, 'status': 'not_modified',
+                    'bytes': 0, 'seconds': time.perf_counter() - start, 'mb_per_s': None,
+                    'entry': entry}
+        if req.status_code == 416 and offset:
+            # the '.part' file is already complete, or no longer matches the server
+            os.remove(part_filename)
+            os.remove(part_filename + '.json')
+            return download_file(session, url, filename, chunk_size, entry)
+        req.raise_for_status()
+
+        if req.status_code == 206:
+            mode = 'ab'
+            with open(part_filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    digest.update(chunk)
+            expected = req.headers.get('Content-Range', '').rpartition('/')[2]
+        else:
+            mode, offset = 'wb', 0
+            expected = req.headers.get('Content-Length')
+            # remember which version of the file the '.part' belongs to, so that
+            # an interrupted download is only ever resumed against the same version
+            with open(part_filename + '.json', 'w', encoding='utf-8') as f:
+                json.dump({'validator': req.headers.get('ETag') or req.headers.get('Last-Modified')}, f)
+
+        # the gauge adds up the running downloads of the same city and file
+        # (e.g. several snapshots with 'history = true')
+        labels = _url_labels(url)
+        add_gauge('insideairbnb_download_bytes_in_progress', offset, **labels)
+        try:
+            with open(part_filename, mode) as f:
+                for chunk in req.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    nbytes += len(chunk)
+                    add_gauge('insideairbnb_download_bytes_in_progress', len(chunk), **labels)
+        finally:
+            add_gauge('insideairbnb_download_bytes_in_progress', -(offset + nbytes), **labels)
+
+        size = offset + nbytes
+        if expected and expected.isdigit() and int(expected) != size:
+            raise IOError('incomplete download of {0}: got {1} of {2} bytes, '
+                          'will resume on the next run'.format(url, size, expected))
+        new_entry = {'local_filename': filename, 'size': size, 'sha256': digest.hexdigest(),
+                     'etag': req.headers.get('ETag'),
+                     'last_modified': req.headers.get('Last-Modified'),
+                     'downloaded_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')}
+
+    os.replace(part_filename, filename)
+    os.remove(part_filename + '.json')
+    seconds = time.perf_counter() - start
+
+    return {'source_url': url, 'local_filename': filename,
+            'status': 'resumed' if offset else 'downloaded',
+            'bytes': nbytes, 'seconds': seconds,
+            'mb_per_s': nbytes / 1e6 / seconds if seconds else None,
+            'entry': new_entry}
+
+
+def _url_labels(url):
+    parts = url.rsplit('/', 6)
+    return {'city': parts[3] if len(parts) == 7 else '', 'file': parts[-1]}
+
+
+def _record_download(result, done, total):
+    inc('insideairbnb_downloads_total', status=result['status'])
+    inc('insideairbnb_bytes_total', result['bytes'], stage='download', status=result['status'])
+    if result['status'] != 'failed':
+        observe('insideairbnb_download_seconds', result['seconds'], **_url_labels(result['source_url']))
+    log_event('download', url=result['source_url'], status=result['status'], bytes=result['bytes'],
+              seconds=round(result['seconds'], 6), error=result.get('error'))
+    progress('download', done, total)
+
+
+# =============================================================================
+# This function downloads a list of urls to the matching list of local filenames
+# using a pool of worker threads, and returns a dataframe summarising the bytes,
+# time and throughput of each file. Failed downloads are reported in the summary
+# rather than stopping the other workers.
+#
+# By default, local files that match their manifest entry (or that predate the
+# manifest) are skipped, and files whose size no longer matches the manifest are
+# fetched again. With `replace=True`, every local file is revalidated against
+# the server with a conditional request and only re-downloaded if it changed.
+# =============================================================================
+
+def download_files(urls, filenames, workers=4, replace=False, chunk_size=CHUNK_SIZE,
+                   manifest_path=MANIFEST_FILENAME):
+    """Downloads every url in `urls` to the matching entry of `filenames` with
+    `workers` concurrent threads, recording each file in the manifest at
+    `manifest_path`, and returns a dataframe with one summary row per file.
+    """
+    summary = []
+    manifest = load_manifest(manifest_path)
+    session = make_session(workers)
+
+    with session, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for url, filename in zip(urls, filenames):
+            entry = manifest.get(url)
+            if entry and entry['local_filename'] != filename:
+                entry = None
+            if not replace and os.path.isfile(filename):
+                if entry is None or os.path.getsize(filename) == entry['size']:
+                    print(filename, '--this file already exists locally')
+                    summary.append({'source_url': url, 'local_filename': filename,
+                                    'status': 'skipped', 'bytes': 0, 'seconds': 0.0,
+                                    'mb_per_s': None})
+                    continue
+                print(filename, '--local file does not match the manifest, downloading again')
+                os.remove(filename)
+                entry = None
+            futures[pool.submit(download_file, session, url, filename, chunk_size, entry)] = (url, filename)
+
+        inc('insideairbnb_downloads_total', len(summary), status='skipped')
+        total = len(summary) + len(futures)
+        for future in as_completed(futures):
+            url, filename = futures[future]
+            try:
+                result = future.result()
+                if result['status'] == 'not_modified':
+                    print(filename, '--not modified on the server')
+                else:
+                    print('File saved locally to: ', filename,
+                          '({0:,} bytes, {1:.1f}s)'.format(result['bytes'], result['seconds']))
+                    manifest[url] = result['entry']
+                    save_manifest(manifest, manifest_path)
+                del result['entry']
+            except Exception as e:
+                print(filename, '--download failed:', e)
+                result = {'source_url': url, 'local_filename': filename,
+                          'status': 'failed', 'bytes': 0, 'seconds': 0.0,
+                          'mb_per_s': None, 'error': str(e)}
+            summary.append(result)
+            _record_download(result, len(summary), total)
+
+    summary = pd.DataFrame(summary, columns=['source_url', 'local_filename', 'status',
+                                             'bytes', 'seconds', 'mb_per_s', 'error'])
+
+    downloaded = summary[summary['status'].isin(['downloaded', 'resumed'])]
+    if len(downloaded):
+        total_bytes = downloaded['bytes'].sum()
+        print('Downloaded {0} file(s), {1:,} bytes, {2:.1f} MB/s per file on average'.format(
+            len(downloaded), total_bytes, downloaded['mb_per_s'].mean()))
+
+    return summary
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB HTTP
+
+@author: anguyen1210
+
+This file contains the small HTTP cache used for the InsideAirBnb 'get the data'
+page, in place of a global `requests_cache.install_cache()`. A global install
+patches every `requests` call, including the multi-hundred-MB data downloads,
+and keeps every response forever. Here, only the pages fetched with
+`fetch_page()` are cached:
+
+    - a cached page is served as is for `ttl` seconds, and then revalidated with
+      a conditional request, so a stale page costs a '304 Not Modified' reply
+      rather than the whole page;
+    - the cache file is bounded to `max_bytes`, evicting the least recently used
+      pages first;
+    - hits, misses, revalidations, evictions and bytes are counted in
+      `cache_stats` (and in the metrics of 'insideairbnb_metrics.py'), so the
+      cache can be tuned.
+
+Data files are never cached here; they are downloaded by the
+'insideairbnb_download.py' file, which keeps its own manifest.
+"""
+import time
+
+import requests
+
+from insideairbnb_connection import connect
+from insideairbnb_metrics import inc, log_event
+
+
+PAGE_URL = 'http://insideairbnb.com/get-the-data.html'
+HTTP_CACHE = 'insideairbnb_http_cache.db'
+DEFAULT_TTL = 3600
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+TIMEOUT = (10, 60)
+
+cache_stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'evictions': 0,
+               'bytes_from_cache': 0, 'bytes_downloaded': 0}
+
+
+def _connect_cache(cache_path):
+    conn = connect(cache_path)
+    conn.execute("""create table if not exists responses (
+                        url text primary key, body blob, encoding text, etag text,
+                        last_modified text, fetched_at real, accessed_at real, size integer)""")
+    return conn
+
+
+def _count(url, status, nbytes):
+    inc('insideairbnb_http_cache_total', status=status)
+    inc('insideairbnb_bytes_total', nbytes, stage='page_fetch', status=status)
+    log_event('page_fetch', url=url, cache_status=status, bytes=nbytes)
+
+
+def _cached_response(url, body, encoding, status):
+    response = requests.Response()
+    response.url = url
+    response.status_code = 200
+    response._content = body
+    response.encoding = encoding
+    response.from_cache = status != 'miss'
+    response.cache_status = status
+    return response
+
+
+# =============================================================================
+# This function evicts the least recently used pages until the cache holds at
+# most `max_bytes` of page bodies.
+# =============================================================================
+
+def _evict(conn, max_bytes):
+    total = conn.execute("select coalesce(sum(size), 0) from responses").fetchone()[0]
+    while total > max_bytes:
+        url, size = conn.execute("select url, size from responses order by accessed_at limit 1").fetchone()
+        conn.execute("delete from responses where url = ?", (url,))
+        total -= size
+        cache_stats['evictions'] += 1
+        inc('insideairbnb_http_cache_evictions_total')
+
+
+# =============================================================================
+# This function fetches a page through the cache. It returns a
+# `requests.Response`, with two extra attributes: `from_cache`, which is True
+# when the body came from the cache, and `cache_status`, which is 'hit',
+# 'revalidated' or 'miss'. Use `ttl=0` to always revalidate the page.
+# =============================================================================
+
+def fetch_page(url=PAGE_URL, ttl=DEFAULT_TTL, cache_path=HTTP_CACHE, max_bytes=MAX_CACHE_BYTES,
+               session=None):
+    """Returns the response for `url`, served from the cache at `cache_path` if
+    it was fetched less than `ttl` seconds ago or has not changed since.
+    """
+    session = session or requests
+    now = time.time()
+    conn = _connect_cache(cache_path)
+    try:
+        row = conn.execute("select body, encoding, etag, last_modified, fetched_at from responses "
+                           "where url = ?", (url,)).fetchone()
+        headers = {}
+        if row is not None:
+            body, encoding, etag, last_modified, fetched_at = row
+            if now - fetched_at < ttl:
+                with conn:
+                    conn.execute("update responses set accessed_at = ? where url = ?", (now, url))
+                cache_stats['hits'] += 1
+                cache_stats['bytes_from_cache'] += len(body)
+                _count(url, 'hit', len(body))
+                return _cached_response(url, body, encoding, 'hit')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = session.get(url, headers=headers, timeout=TIMEOUT)
+
+        if response.status_code == 304 and row is not None:
+            with conn:
+                conn.execute("update responses set fetched_at = ?, accessed_at = ? where url = ?",
+                             (now, now, url))
+            cache_stats['revalidated'] += 1
+            cache_stats['bytes_from_cache'] += len(body)
+            _count(url, 'revalidated', len(body))
+            return _cached_response(url, body, encoding, 'revalidated')
+
+        response.raise_for_status()
+        response.from_cache = False
+        response.cache_status = 'miss'
+        cache_stats['misses'] += 1
+        cache_stats['bytes_downloaded'] += len(response.content)
+        _count(url, 'miss', len(response.content))
+
+        if len(response.content) <= max_bytes:
+            with conn:
+                conn.execute("insert or replace into responses values (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (url, response.content, response.encoding,
+                              response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                              now, now, len(response.content)))
+                _evict(conn, max_bytes)
+    finally:
+        conn.close()
+
+    return response
+
+
+def get_cache_stats():
+    """Returns a copy of the cache statistics, with the hit rate (hits and
+    revalidations over all requests) added.
+    """
+    stats = dict(cache_stats)
+    requests_made = stats['hits'] + stats['revalidated'] + stats['misses']
+    stats['hit_rate'] = (stats['hits'] + stats['revalidated']) / requests_made if requests_made else None
+    return stats
+
+
+def clear_cache(cache_path=HTTP_CACHE):
+    """Deletes every page from the cache at `cache_path`."""
+    conn = _connect_cache(cache_path)
+    with conn:
+        conn.execute("delete from responses")
+    conn.close()
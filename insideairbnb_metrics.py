@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB METRICS
+
+@author: anguyen1210
+
+This file contains the instrumentation of the pipeline: timing spans around
+each stage, counters of the bytes and rows processed, histograms of latencies,
+and gauges for the downloads in progress. It only imports the standard library,
+and recording a metric costs a dict update, so the stages are always
+instrumented; nothing is output unless asked for.
+
+Metrics are output in two ways:
+
+    - as structured logs: every span, progress step and finished download is
+      logged as a line of JSON on the 'insideairbnb' logger, see
+      `configure_logging()`;
+    - in the Prometheus text format: `write_prometheus()` writes them to a file
+      (e.g. for the node exporter's textfile collector), `serve_prometheus()`
+      serves them on a local HTTP port, and `start_exporter()` rewrites the
+      file every few seconds, so a slow city or a stalled download shows up
+      while the pipeline is still running.
+
+The metrics recorded by the pipeline are:
+
+    insideairbnb_stage_seconds{stage}                    histogram of the spans
+    insideairbnb_stage_errors_total{stage}               spans that raised
+    insideairbnb_rows_total{stage, table}                rows read or loaded
+    insideairbnb_bytes_total{stage, status}              bytes downloaded or served from cache
+    insideairbnb_http_cache_total{status}                page cache hits, revalidations and misses
+    insideairbnb_download_seconds{city, file}            histogram of the download latency per url
+    insideairbnb_downloads_total{status}                 downloads per status
+    insideairbnb_download_bytes_in_progress{city, file}  bytes received by the running downloads
+    insideairbnb_progress_done{stage}                    items done, out of ...
+    insideairbnb_progress_total{stage}                   ... the items to do
+"""
+import contextlib
+import functools
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+
+# upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+logger = logging.getLogger('insideairbnb')
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+# =============================================================================
+# These functions record the metrics. Each metric is identified by its name and
+# its labels, e.g. `inc('insideairbnb_rows_total', 5000, table='listings')`.
+# =============================================================================
+
+def inc(name, value=1, **labels):
+    """Adds `value` to the counter `name` with `labels`."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Sets the gauge `name` with `labels` to `value`."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def add_gauge(name, value, **labels):
+    """Adds `value` (which may be negative) to the gauge `name` with `labels`,
+    and removes the gauge once it is back to 0.
+    """
+    key = _key(name, labels)
+    with _lock:
+        value = _gauges.get(key, 0) + value
+        if value:
+            _gauges[key] = value
+        else:
+            _gauges.pop(key, None)
+
+
+def observe(name, value, **labels):
+    """Records the observation `value` in the histogram `name` with `labels`."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+
+def reset():
+    """Clears every metric recorded so far."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def snapshot():
+    """Returns a copy of the metrics recorded so far, as a dict of 'counters',
+    'gauges' and 'histograms' keyed by (name, labels).
+    """
+    with _lock:
+        return {'counters': dict(_counters), 'gauges': dict(_gauges),
+                'histograms': {k: {'buckets': list(v['buckets']), 'count': v['count'], 'sum': v['sum']}
+                               for k, v in _histograms.items()}}
+
+
+def log_event(event, **fields):
+    """Logs `event` with `fields` as a structured log line."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(event, extra={'fields': fields})
+
+
+# =============================================================================
+# The spans time a stage of the pipeline. Each span records its duration in the
+# 'insideairbnb_stage_seconds' histogram, counts its errors, and logs its start
+# and end. `timed()` wraps a whole function in a span.
+# =============================================================================
+
+@contextlib.contextmanager
+def span(stage, **fields):
+    """Times the block as the stage `stage`, logging `fields` with it. Yields a
+    dict to which more fields can be added (e.g. the rows processed) for the
+    end log line.
+    """
+    extra = dict(fields)
+    log_event('span_start', stage=stage, **fields)
+    start = time.perf_counter()
+    try:
+        yield extra
+    except BaseException as e:
+        seconds = time.perf_counter() - start
+        observe('insideairbnb_stage_seconds', seconds, stage=stage)
+        inc('insideairbnb_stage_errors_total', stage=stage)
+        log_event('span_error', stage=stage, seconds=round(seconds, 6), error=repr(e), **extra)
+        raise
+    seconds = time.perf_counter() - start
+    observe('insideairbnb_stage_seconds', seconds, stage=stage)
+    log_event('span_end', stage=stage, seconds=round(seconds, 6), **extra)
+
+
+def timed(stage):
+    """Decorator that runs the decorated function in a span `stage`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def progress(stage, done, total, **fields):
+    """Records that `done` of the `total` items of `stage` are done, so a long
+    stage can be followed while it runs.
+    """
+    set_gauge('insideairbnb_progress_done', done, stage=stage)
+    set_gauge('insideairbnb_progress_total', total, stage=stage)
+    log_event('progress', stage=stage, done=done, total=total, **fields)
+
+
+# =============================================================================
+# This formatter writes each log record as a line of JSON with its time, level,
+# event and fields, and `configure_logging()` attaches it to the 'insideairbnb'
+# logger.
+# =============================================================================
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                + '.{0:03d}Z'.format(int(record.msecs)),
+                'level': record.levelname.lower(), 'event': record.getMessage()}
+        line.update(getattr(record, 'fields', {}))
+        return json.dumps(line, default=str)
+
+
+def configure_logging(path=None, level=logging.INFO):
+    """Writes the structured logs of the pipeline to the file at `path`, or to
+    stderr if no path is given, and returns the handler.
+    """
+    handler = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return handler
+
+
+# =============================================================================
+# These functions output the metrics in the Prometheus text format.
+# =============================================================================
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')
+                                             .replace('\n', '\\n')) for k, v in labels) + '}'
+
+
+def prometheus_text():
+    """Returns the metrics recorded so far in the Prometheus text format."""
+    metrics = snapshot()
+    lines = []
+    for kind, values in (('counter', metrics['counters']), ('gauge', metrics['gauges'])):
+        for name in sorted({name for name, _ in values}):
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append('{0}{1} {2}'.format(name, _labels(labels), value))
+    for name in sorted({name for name, _ in metrics['histograms']}):
+        lines.append('# TYPE {0} histogram'.format(name))
+        for (metric, labels), histogram in sorted(metrics['histograms'].items()):
+            if metric != name:
+                continue
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, [('le', str(bound))]), count))
+            lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), histogram['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    """Writes the metrics to the file at `path`, through a temporary file so
+    that a scraper never reads a half-written file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port, host='127.0.0.1'):
+    """Serves the metrics at 'http://<host>:<port>/' from a background thread,
+    and returns the server (call its `shutdown()` and then its `server_close()`
+    methods to stop it and free the port).
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_exporter(path, interval=15.0):
+    """Rewrites the metrics file at `path` every `interval` seconds from a
+    background thread, and returns a function that stops it (writing the file
+    one last time).
+    """
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            write_prometheus(path)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+        write_prometheus(path)
+
+    return stop
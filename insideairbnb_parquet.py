@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB PARQUET
+
+@author: anguyen1210
+
+This file contains an optional columnar storage backend, used alongside the
+SQLITE database. Each snapshot is written to a Parquet dataset partitioned by
+the same country/region/city/last_update keys that `split_source_url()` derives
+from its url, one dataset per table of `FILE_TABLES` (listings, calendar,
+reviews, ...).
+
+Queries only read the partitions that match their filters and the columns they
+ask for, instead of scanning every column of every row of one wide table. This
+requires the optional `pyarrow` package.
+"""
+import os
+import time
+
+import pandas as pd
+
+from insideairbnb_schema import LISTINGS_DTYPES, TABLE_DTYPES, apply_dtypes, canonicalize, file_table
+from insideairbnb_tools import parse_source_urls, read_local_file
+
+
+PARQUET_ROOT = 'insideairbnb_parquet'
+PARTITION_KEYS = ['country', 'region', 'city', 'last_update']
+CHUNKSIZE = 100000
+
+
+# =============================================================================
+# These helper functions map our declared pandas types to Parquet types.
+# Categoricals are stored as plain strings (Parquet dictionary-encodes them on
+# disk anyway) and turned back into categoricals when they are read, so that
+# files written with different sets of categories can be read as one dataset.
+# =============================================================================
+
+def _arrow_type(dtype):
+    import pyarrow as pa
+    types = {'Int64': pa.int64(), 'Int32': pa.int32(), 'Int16': pa.int16(),
+             'float64': pa.float64(), 'float32': pa.float32(),
+             'date': pa.timestamp('ns'), 'cents': pa.int64(), 'flag': pa.bool_()}
+    return types.get(dtype, pa.string())
+
+
+def _arrow_schema(columns, dtypes):
+    import pyarrow as pa
+    return pa.schema([(column, _arrow_type(dtypes.get(column, 'string'))) for column in columns])
+
+
+def _file_type(source_url):
+    table = file_table(source_url)
+    if table is None:
+        raise ValueError('{0} is not a table file'.format(source_url))
+    return table
+
+
+def snapshot_path(source_url, root=PARQUET_ROOT):
+    """Returns the path of the Parquet file of the snapshot `source_url`, for
+    example 'insideairbnb_parquet/listings/country=france/region=.../city=paris/
+    last_update=2019-12-07/part-0.parquet'.
+    """
+    keys = parse_source_urls(pd.DataFrame({'source_url': [source_url]})).iloc[0]
+    partitions = ['{0}={1}'.format(key, keys[key]) for key in PARTITION_KEYS]
+    return os.path.join(root, _file_type(source_url), *partitions, 'part-0.parquet')
+
+
+# =============================================================================
+# This function writes one locally saved file to its partition of the Parquet
+# dataset, a chunk at a time. The file is written to a temporary name first, so
+# that writing the same snapshot again simply replaces it. Older listings files
+# have their own 'city' and 'country' columns, which are renamed to
+# 'listing_city' and 'listing_country' so they do not clash with the partition
+# keys.
+# =============================================================================
+
+def write_snapshot_parquet(filename, source_url, root=PARQUET_ROOT, dtypes=None,
+                           chunksize=CHUNKSIZE):
+    """Streams the local file `filename`, downloaded from `source_url`, into its
+    partition of the Parquet dataset under `root`, with the declared `dtypes`
+    (by default those of its file type), and returns the path written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if dtypes is None:
+        dtypes = TABLE_DTYPES.get(_file_type(source_url), LISTINGS_DTYPES)
+
+    path = snapshot_path(source_url, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+
+    writer = None
+    try:
+        for chunk in read_local_file(filename, chunksize=chunksize):
+            chunk = canonicalize(chunk)
+            chunk['source'] = source_url
+            chunk = apply_dtypes(chunk, dtypes)
+            chunk = chunk.rename(columns={key: 'listing_' + key for key in PARTITION_KEYS})
+            if writer is None:
+                schema = _arrow_schema(chunk.columns, dtypes)
+                writer = pq.ParquetWriter(tmp_path, schema, compression='zstd')
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_path, path)
+
+    return path
+
+
+# =============================================================================
+# This function writes a whole import list to the Parquet dataset. Since every
+# snapshot has its own partition, there is no single writer to funnel the data
+# through: with `workers` > 1, the files are parsed and written concurrently by
+# a pool of processes, each holding one chunk of its file at a time. A partition
+# only appears once its file is complete, so the partitions already in the
+# dataset play the part of the 'source_info' ledger of the database: snapshots
+# that already have one are skipped, unless `reload` is True.
+# =============================================================================
+
+def _write_snapshot(filename, source_url, root, dtypes):
+    import pyarrow.parquet as pq
+
+    start = time.perf_counter()
+    path = write_snapshot_parquet(filename, source_url, root, dtypes)
+    seconds = time.perf_counter() - start
+    return path, pq.ParquetFile(path).metadata.num_rows, seconds
+
+
+def write_import_list_parquet(import_list_df, root=PARQUET_ROOT, dtypes=None, workers=1,
+                              reload=False):
+    """Writes the locally saved files of the import list returned by
+    `extract_file_url()` that are not in the Parquet dataset under `root` yet,
+    using `workers` processes, and returns a dataframe with the rows written per
+    file, like `ingest_import_list()` does.
+    """
+    parsed = parse_source_urls(import_list_df)
+    todo = [i for i, url in enumerate(parsed['source_url'])
+            if reload or not os.path.exists(snapshot_path(url, root))]
+    filenames = [parsed['local_filename'].iloc[i] for i in todo]
+    urls = [parsed['source_url'].iloc[i] for i in todo]
+
+    if not todo:
+        print('The import list supplied does not contain any new files')
+        return pd.DataFrame(columns=['local_filename', 'rows', 'seconds', 'rows_per_s', 'source_url'])
+
+    if workers > 1 and len(filenames) > 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(_write_snapshot, filenames, urls,
+                                    [root] * len(urls), [dtypes] * len(urls)))
+    else:
+        results = [_write_snapshot(filename, url, root, dtypes) for filename, url in zip(filenames, urls)]
+
+    summary = []
+    for filename, url, (path, rows, seconds) in zip(filenames, urls, results):
+        print('Snapshot saved to: ', path)
+        summary.append({'local_filename': filename, 'rows': rows, 'seconds': seconds,
+                        'rows_per_s': rows / seconds if seconds else None, 'source_url': url})
+
+    return pd.DataFrame(summary, columns=['local_filename', 'rows', 'seconds', 'rows_per_s', 'source_url'])
+
+
+# =============================================================================
+# This function queries the Parquet dataset of one file type. Only the requested
+# `columns` are read, and `filters` are pushed down to the dataset so that only
+# the matching partitions (and row groups) are read. Filters can be given as a
+# dict, e.g. {'country': 'france', 'city': ['paris', 'lyon']}, or as a list of
+# (column, operator, value) tuples, e.g. [('availability_365', '>', 0)].
+# =============================================================================
+
+def query_parquet(columns=None, filters=None, file_type='listings', root=PARQUET_ROOT,
+                  dtypes=None):
+    """Returns a dataframe with the `columns` (all columns if None) of the rows
+    of the `file_type` dataset under `root` that match `filters`.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    if dtypes is None:
+        dtypes = TABLE_DTYPES.get(file_type, LISTINGS_DTYPES)
+    partitioning = ds.partitioning(pa.schema([(key, pa.string()) for key in PARTITION_KEYS]),
+                                   flavor='hive')
+    dataset = ds.dataset(os.path.join(root, file_type), format='parquet', partitioning=partitioning)
+    # columns have changed over the years, so the dataset has the union of the
+    # columns of all its files
+    schema = pa.unify_schemas([pq.read_schema(f) for f in dataset.files] + [partitioning.schema])
+    dataset = ds.dataset(os.path.join(root, file_type), format='parquet',
+                         partitioning=partitioning, schema=schema)
+
+    if isinstance(filters, dict):
+        filters = [(key, 'in', list(value)) if isinstance(value, (list, tuple, set))
+                   else (key, '=', value) for key, value in filters.items()]
+    expression = pq.filters_to_expression(filters) if filters else None
+
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    for column in df.columns:
+        if dtypes.get(column) == 'category':
+            df[column] = df[column].astype('category')
+
+    return df
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB PIPELINE
+
+@author: anguyen1210
+
+This file contains the stages of the pipeline that the 'scrape_insideairbnb_01.py'
+and 'scrape_insideairbnb_02.py' scripts walk through, as functions that can be
+imported and composed without side effects:
+
+    fetch_catalog -> select_files -> download -> ingest
+
+Each stage takes the settings returned by `load_config()`, which reads the
+database path, the countries and the file types of interest (among others) from
+an INI file instead of having them hard-coded. This file only imports the
+standard library, 'insideairbnb_connection.py' and 'insideairbnb_metrics.py',
+which only import the standard library too; pandas, BS4 and the other modules
+of the repo are imported by the stages that need them, so that quick commands of
+the 'insideairbnb' command line tool (see 'insideairbnb_cli.py') start fast.
+
+When 'db_path' is not set, the database is the one given by the INSIDEAIRBNB_DB
+environment variable, or 'insideairbnb.db' (see 'insideairbnb_connection.py').
+
+An example config file, 'insideairbnb.ini':
+
+    [insideairbnb]
+    db_path = insideairbnb.db
+    countries = france|switzerland
+    file_types = listings.csv, calendar.csv.gz
+    history = false
+"""
+import configparser
+
+from insideairbnb_connection import close_shared_connections, connect, default_db_path, shared_connection
+from insideairbnb_metrics import timed
+
+
+CONFIG_FILE = 'insideairbnb.ini'
+CONFIG_SECTION = 'insideairbnb'
+
+# the settings used when they are missing from the config file. An empty
+# 'countries' selects every country; 'history = true' selects every snapshot
+# of each file rather than only the most recent one. With 'ingest_workers' > 1,
+# files are parsed in that many processes; 'backend = parquet' ingests them into
+# the Parquet dataset under 'parquet_root' instead of the SQLITE database. The
+# structured logs of 'insideairbnb_metrics.py' are written to 'log_file', and
+# the metrics to 'metrics_file' every 'metrics_interval' seconds and/or served
+# on 'metrics_port' (0 for none).
+DEFAULT_CONFIG = {'db_path': '',
+                  'countries': '',
+                  'file_types': 'listings.csv',
+                  'history': 'false',
+                  'workers': '4',
+                  'ingest_workers': '1',
+                  'backend': 'sqlite',
+                  'parquet_root': 'insideairbnb_parquet',
+                  'page_url': 'http://insideairbnb.com/get-the-data.html',
+                  'page_ttl': '3600',
+                  'http_cache': 'insideairbnb_http_cache.db',
+                  'catalog_db': 'insideairbnb_catalog.db',
+                  'watch_interval': '21600',
+                  'watch_jitter': '0.1',
+                  'log_file': '',
+                  'metrics_file': '',
+                  'metrics_port': '0',
+                  'metrics_interval': '15'}
+
+
+def load_config(path=CONFIG_FILE, section=CONFIG_SECTION):
+    """Returns a dict of the settings in `section` of the INI file at `path`,
+    with `DEFAULT_CONFIG` used for the missing ones (or for all of them, if the
+    file does not exist).
+    """
+    parser = configparser.ConfigParser()
+    parser.read_dict({section: DEFAULT_CONFIG})
+    parser.read(path)
+    settings = parser[section]
+
+    return {'db_path': settings.get('db_path') or default_db_path(),
+            'countries': settings.get('countries').strip() or None,
+            'file_types': [f.strip() for f in settings.get('file_types').split(',') if f.strip()],
+            'history': settings.getboolean('history'),
+            'workers': settings.getint('workers'),
+            'ingest_workers': settings.getint('ingest_workers'),
+            'backend': settings.get('backend'),
+            'parquet_root': settings.get('parquet_root'),
+            'page_url': settings.get('page_url'),
+            'page_ttl': settings.getfloat('page_ttl'),
+            'http_cache': settings.get('http_cache'),
+            'catalog_db': settings.get('catalog_db'),
+            'watch_interval': settings.getfloat('watch_interval'),
+            'watch_jitter': settings.getfloat('watch_jitter'),
+            'log_file': settings.get('log_file') or None,
+            'metrics_file': settings.get('metrics_file') or None,
+            'metrics_port': settings.getint('metrics_port'),
+            'metrics_interval': settings.getfloat('metrics_interval')}
+
+
+def table_name(source_url):
+    """Returns the name of the database table the file at `source_url` is
+    loaded into, e.g. 'calendar' for a 'calendar.csv.gz' file, or None for
+    files that are not tables (see `FILE_TABLES` in 'insideairbnb_schema.py').
+    """
+    from insideairbnb_schema import file_table
+    return file_table(source_url)
+
+
+# =============================================================================
+# The stages of the pipeline.
+# =============================================================================
+
+@timed('fetch_catalog')
+def fetch_catalog(config):
+    """Returns the catalog of the files listed on the InsideAirBnb page, which
+    is only downloaded again once the cached copy is older than 'page_ttl'.
+    """
+    from insideairbnb_catalog import load_catalog
+    from insideairbnb_http import fetch_page
+
+    source = fetch_page(config['page_url'], ttl=config['page_ttl'], cache_path=config['http_cache'])
+    print('Retrieved from cache' if source.from_cache else 'Retrieved from website')
+    source.encoding = 'utf-8'
+
+    return load_catalog(source.text, config['catalog_db'])
+
+
+@timed('select_files')
+def select_files(catalog, config):
+    """Returns the import list of the 'file_types' files of the cities of the
+    'countries' of interest: only their most recent snapshot, unless 'history'
+    is set.
+    """
+    import pandas as pd
+    from insideairbnb_tools import extract_file_url, list_cities
+
+    cities = None
+    if config['countries']:
+        cities = list_cities(catalog, config['countries'])
+        if not cities:
+            print('No cities found for: ', config['countries'])
+            return pd.DataFrame({'source_url': []})
+
+    import_list = pd.concat([extract_file_url(catalog, file_type, cities, current=not config['history'])
+                             for file_type in config['file_types']], ignore_index=True)
+    return import_list
+
+
+@timed('download')
+def download(import_list, config, replace=False):
+    """Downloads the files of the import list that are not saved locally yet,
+    and returns the download summary of `save_insideairbnb_file()`.
+    """
+    from insideairbnb_tools import save_insideairbnb_file
+
+    return save_insideairbnb_file(import_list, replace=replace, workers=config['workers'])
+
+
+@timed('ingest')
+def ingest(import_list, config, conn=None, reload=False):
+    """Loads the downloaded files of the import list that are not in the
+    database yet (all of them if `reload` is True), each file type into its own
+    table (see `table_name()`; files that are not tables are skipped), brings
+    the listings change log up to date (see 'insideairbnb_diff.py'), and
+    returns the load summary of `ingest_import_list()` with the table of each
+    file. An open connection to the database can be passed as `conn`. With
+    'backend = parquet', the files are written to the Parquet dataset instead,
+    skipping the snapshots already in it, and a summary of the same shape is
+    returned.
+    """
+    import pandas as pd
+
+    columns = ['local_filename', 'rows', 'seconds', 'rows_per_s', 'source_url', 'table']
+    tables = import_list['source_url'].map(table_name)
+    ingestible = tables.notna()
+    for url in import_list.loc[~ingestible, 'source_url']:
+        print('Skipping {0}: not a table file'.format(url))
+
+    if config['backend'] == 'parquet':
+        from insideairbnb_parquet import write_import_list_parquet
+        summary = write_import_list_parquet(import_list[ingestible], config['parquet_root'],
+                                            workers=config['ingest_workers'], reload=reload)
+        return summary.assign(table=summary['source_url'].map(table_name))[columns]
+
+    from insideairbnb_db import ingest_import_list, ingest_import_list_parallel
+
+    summaries = []
+    own_conn = conn is None
+    if own_conn:
+        conn = connect(config['db_path'])
+    try:
+        for table, files in import_list[ingestible].groupby(tables[ingestible], sort=False):
+            files = files.reset_index(drop=True)
+            if config['ingest_workers'] > 1:
+                summary = ingest_import_list_parallel(files, conn, table, reload=reload,
+                                                      workers=config['ingest_workers'])
+            else:
+                summary = ingest_import_list(files, conn, table, reload=reload)
+            summaries.append(summary.assign(table=table))
+            if table == 'listings' and len(summary):
+                from insideairbnb_diff import update_change_log
+                update_change_log(conn)
+    finally:
+        if own_conn:
+            conn.close()
+
+    if not summaries:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(summaries, ignore_index=True)
+
+
+def watch(config, max_polls=None):
+    """Watches the InsideAirBnb page for new 'file_types' files of the
+    'countries' of interest, and downloads and ingests them as they appear,
+    through a single connection kept open between polls and closed when the
+    watcher stops. Files whose download or load fails are retried at the next
+    poll.
+    """
+    from insideairbnb_watch import print_new_files, watch as watch_page
+
+    def download_and_ingest(import_list):
+        summary = download(import_list, config)
+        failed = summary[summary['status'] == 'failed']
+        if len(failed):
+            raise IOError('{0} download(s) failed: {1}'.format(len(failed), ', '.join(failed['source_url'])))
+        ingest(import_list, config, conn=shared_connection(config['db_path']))
+
+    try:
+        return watch_page(filename=tuple(config['file_types']), country_name=config['countries'],
+                          actions=(print_new_files, download_and_ingest),
+                          interval=config['watch_interval'], jitter=config['watch_jitter'],
+                          max_polls=max_polls, url=config['page_url'],
+                          cache_path=config['http_cache'], catalog_db=config['catalog_db'])
+    finally:
+        close_shared_connections()
+
+
+# =============================================================================
+# This function runs a read-only SQL query against the database, with the
+# standard library only. Opening the database read-only means a mistyped path
+# raises an error instead of creating an empty database, and that the query can
+# run while an ingest is writing to the database.
+# =============================================================================
+
+def query(sql, config, params=()):
+    """Returns a tuple of the column names and the list of rows returned by the
+    query `sql` against the database at 'db_path'.
+    """
+    conn = connect(config['db_path'], read_only=True)
+    try:
+        cursor = conn.execute(sql, params)
+        columns = [d[0] for d in cursor.description or []]
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    return columns, rows
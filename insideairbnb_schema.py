@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB SCHEMA
+
+@author: anguyen1210
+
+This file declares the types of the known columns of the InsideAirBnb files.
+Reading everything as pandas' default int64/float64/object wastes a lot of
+memory on a table of this width: ids fit in nullable integers, counts and
+availabilities in small integers, and the handful of repeated labels (room
+type, property type, neighbourhood, ...) in categoricals. Dates are parsed,
+and columns we do not know about are kept as strings.
+
+This matters most for 'calendar.csv.gz', which has a row per listing per day
+for the year ahead: there, the 't'/'f' availability flags are parsed into
+booleans. Prices, in the calendar and in the listings files, are parsed into
+integer cents, so they can be compared and aggregated as numbers.
+
+The columns of the files have also changed over the years. Column names are
+mapped to a canonical name (see `COLUMN_ALIASES`) as each chunk is read, and
+`schema_drift()` reports, from the header of each file only, the columns each
+snapshot renames, adds or drops, before any data is loaded.
+"""
+import pandas as pd
+
+
+# 'date' columns are parsed with `pd.to_datetime()`, 'cents' columns from prices
+# such as '$1,234.00' into integer cents, and 'flag' columns from 't'/'f' into
+# booleans; every other value is a pandas dtype
+LISTINGS_DTYPES = {
+    'id': 'Int64',
+    'listing_url': 'string',
+    'scrape_id': 'Int64',
+    'last_scraped': 'date',
+    'name': 'string',
+    'description': 'string',
+    'host_id': 'Int64',
+    'host_name': 'string',
+    'host_since': 'date',
+    'host_response_time': 'category',
+    'host_is_superhost': 'category',
+    'host_listings_count': 'Int32',
+    'host_total_listings_count': 'Int32',
+    'host_identity_verified': 'category',
+    'neighbourhood': 'category',
+    'neighbourhood_cleansed': 'category',
+    'neighbourhood_group': 'category',
+    'neighbourhood_group_cleansed': 'category',
+    'city': 'category',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'property_type': 'category',
+    'room_type': 'category',
+    'accommodates': 'Int16',
+    'bathrooms': 'float32',
+    'bathrooms_text': 'category',
+    'bedrooms': 'Int16',
+    'beds': 'Int16',
+    'price': 'cents',
+    'minimum_nights': 'Int32',
+    'maximum_nights': 'Int32',
+    'has_availability': 'category',
+    'availability_30': 'Int16',
+    'availability_60': 'Int16',
+    'availability_90': 'Int16',
+    'availability_365': 'Int16',
+    'calendar_last_scraped': 'date',
+    'number_of_reviews': 'Int32',
+    'number_of_reviews_ltm': 'Int32',
+    'number_of_reviews_l30d': 'Int32',
+    'first_review': 'date',
+    'last_review': 'date',
+    'review_scores_rating': 'float32',
+    'review_scores_accuracy': 'float32',
+    'review_scores_cleanliness': 'float32',
+    'review_scores_checkin': 'float32',
+    'review_scores_communication': 'float32',
+    'review_scores_location': 'float32',
+    'review_scores_value': 'float32',
+    'instant_bookable': 'category',
+    'license': 'string',
+    'calculated_host_listings_count': 'Int32',
+    'calculated_host_listings_count_entire_homes': 'Int32',
+    'calculated_host_listings_count_private_rooms': 'Int32',
+    'calculated_host_listings_count_shared_rooms': 'Int32',
+    'reviews_per_month': 'float32',
+    'source': 'string',
+}
+
+# listing ids no longer fit in 32 bits since InsideAirBnb switched to Airbnb's
+# 64-bit ids, so ids are Int64 throughout
+CALENDAR_DTYPES = {
+    'listing_id': 'Int64',
+    'date': 'date',
+    'available': 'flag',
+    'price': 'cents',
+    'adjusted_price': 'cents',
+    'minimum_nights': 'Int32',
+    'maximum_nights': 'Int32',
+    'source': 'string',
+    'source_id': 'Int64',
+}
+
+REVIEWS_DTYPES = {
+    'listing_id': 'Int64',
+    'id': 'Int64',
+    'date': 'date',
+    'reviewer_id': 'Int64',
+    'reviewer_name': 'string',
+    'comments': 'string',
+    'source': 'string',
+    'source_id': 'Int64',
+}
+
+# the declared types of each table, by name
+TABLE_DTYPES = {'listings': LISTINGS_DTYPES,
+                'listings_detailed': LISTINGS_DTYPES,
+                'calendar': CALENDAR_DTYPES,
+                'reviews': REVIEWS_DTYPES}
+
+# the table each InsideAirBnb file is loaded into, by file name. The summary
+# 'listings.csv' files, which the scripts have always loaded, go into
+# 'listings', and the detailed 'listings.csv.gz' files, which have many more
+# columns, into their own 'listings_detailed' table. Other files (such as the
+# 'neighbourhoods.geojson' maps) are not tables, and are not loaded.
+FILE_TABLES = {'listings.csv': 'listings',
+               'listings.csv.gz': 'listings_detailed',
+               'calendar.csv.gz': 'calendar',
+               'reviews.csv.gz': 'reviews',
+               'reviews.csv': 'reviews_summary',
+               'neighbourhoods.csv': 'neighbourhoods'}
+
+
+def file_table(source_url):
+    """Returns the name of the table the file at `source_url` is loaded into,
+    e.g. 'calendar' for a 'calendar.csv.gz' file, or None if it cannot be
+    loaded.
+    """
+    return FILE_TABLES.get(source_url.rsplit('/', 1)[-1])
+
+# other spellings of the canonical column names. Names are also stripped,
+# lower-cased and have their spaces replaced with underscores before being
+# looked up here.
+COLUMN_ALIASES = {
+    'neighborhood': 'neighbourhood',
+    'neighborhood_cleansed': 'neighbourhood_cleansed',
+    'neighborhood_group': 'neighbourhood_group',
+    'neighborhood_group_cleansed': 'neighbourhood_group_cleansed',
+    'neighborhood_overview': 'neighbourhood_overview',
+    'host_neighborhood': 'host_neighbourhood',
+    'licence': 'license',
+    'listingid': 'listing_id',
+    'reviewerid': 'reviewer_id',
+}
+
+
+# =============================================================================
+# These functions map the columns of a file to their canonical names. A column
+# is only renamed if the file does not also have a column with the canonical
+# name, so that no two columns of a file ever end up with the same name.
+# =============================================================================
+
+def canonical_name(column):
+    """Returns the canonical name of the column `column`."""
+    name = str(column).strip().lower().replace(' ', '_')
+    return COLUMN_ALIASES.get(name, name)
+
+
+def canonical_columns(columns):
+    """Returns a dict mapping each of the `columns` of a file to its canonical
+    name.
+    """
+    columns = list(columns)
+    mapping = {}
+    for column in columns:
+        name = canonical_name(column)
+        mapping[column] = column if (name != column and name in columns) else name
+    return mapping
+
+
+def canonicalize(df):
+    """Returns `df` with its columns renamed to their canonical names."""
+    mapping = canonical_columns(df.columns)
+    if all(column == name for column, name in mapping.items()):
+        return df
+    return df.rename(columns=mapping)
+
+
+# =============================================================================
+# This function applies a dict of declared types, such as `LISTINGS_DTYPES`, to
+# a dataframe read from an InsideAirBnb file. Values that cannot be converted
+# become missing values rather than raising, and columns without a declared type
+# are converted to strings, so every chunk of every file ends up with the same
+# types whatever pandas inferred for it.
+# =============================================================================
+
+def apply_dtypes(df, dtypes=LISTINGS_DTYPES):
+    """Returns a copy of `df` with the declared `dtypes` applied to its known
+    columns and its other columns converted to strings.
+    """
+    converted = {}
+    for column in df.columns:
+        values = df[column]
+        dtype = dtypes.get(column, 'string')
+        if dtype == 'date':
+            converted[column] = pd.to_datetime(values, errors='coerce')
+        elif dtype == 'cents':
+            if not pd.api.types.is_numeric_dtype(values):
+                values = values.astype('string').str.replace(r'[$,\s]', '', regex=True)
+            converted[column] = (pd.to_numeric(values, errors='coerce') * 100).round().astype('Int64')
+        elif dtype == 'flag':
+            converted[column] = values.map({'t': True, 'f': False, True: True, False: False}).astype('boolean')
+        elif dtype.startswith(('Int', 'int')):
+            converted[column] = pd.to_numeric(values, errors='coerce').round().astype(dtype)
+        elif dtype.startswith('float'):
+            converted[column] = pd.to_numeric(values, errors='coerce').astype(dtype)
+        else:
+            converted[column] = values.astype(dtype)
+
+    return pd.DataFrame(converted, index=df.index)
+
+
+# =============================================================================
+# This function reports the schema drift of the snapshots of an import list. It
+# only reads the header of each file, so it can be run on years of snapshots
+# before any of them is loaded. Snapshots are compared in date order: for each
+# of them, the report lists the columns it renames to their canonical name, the
+# columns not seen before in any earlier snapshot (or in the table `table` of
+# the database `conn`, if given, where they would be added by 'ALTER TABLE'),
+# the columns of the previous snapshot that it no longer has, and its columns
+# that have no declared type.
+# =============================================================================
+
+def schema_drift(import_list_df, table='listings', conn=None):
+    """Returns a dataframe with one row per snapshot of the import list, in date
+    order, describing how its columns differ from the previous snapshots and
+    from the declared types of `table`.
+    """
+    from insideairbnb_tools import parse_source_urls, read_header
+
+    declared = TABLE_DTYPES.get(table, {})
+    seen = set()
+    if conn is not None:
+        seen.update(row[1] for row in conn.execute('pragma table_info("{0}")'.format(table.replace('"', '""'))))
+
+    plan = parse_source_urls(import_list_df).sort_values('last_update', kind='stable')
+    report = []
+    previous = None
+    for filename, url in zip(plan['local_filename'], plan['source_url']):
+        row = {'source_url': url, 'local_filename': filename}
+        try:
+            mapping = canonical_columns(read_header(filename))
+        except (OSError, ValueError) as e:
+            report.append(dict(row, error=repr(e)))
+            continue
+        columns = list(mapping.values())
+        row.update({'columns': len(columns),
+                    'renamed': ', '.join('{0} -> {1}'.format(c, n) for c, n in mapping.items() if c != n),
+                    'new_columns': ', '.join(c for c in columns if c not in seen),
+                    'dropped_columns': ', '.join(c for c in previous if c not in mapping.values())
+                    if previous is not None else '',
+                    'undeclared_columns': ', '.join(c for c in columns if c not in declared),
+                    'error': None})
+        report.append(row)
+        seen.update(columns)
+        previous = columns
+
+    return pd.DataFrame(report, columns=['source_url', 'local_filename', 'columns', 'renamed', 'new_columns',
+                                         'dropped_columns', 'undeclared_columns', 'error'])
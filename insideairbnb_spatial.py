@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB SPATIAL
+
+@author: anguyen1210
+
+This file contains tools to find the listings near a point, or the nearest
+competitors of every listing, without computing the distance between every pair
+of listings. Listings are bucketed into a grid of cells of a few hundred metres,
+so that each query only measures the distance (with `haversine()` from the
+'insideairbnb_tools2.py' file) to the listings in the nearby cells. Queries are
+processed in chunks, so memory use is bounded by the chunk size rather than by
+the square of the number of listings.
+
+The grid does not wrap around the antimeridian, which is fine at city scale.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from insideairbnb_tools2 import haversine
+
+
+KM_PER_DEGREE = 2 * np.pi * 6371 / 360
+CHUNK_SIZE = 4096
+BRUTE_FORCE_PAIRS = 4000000
+
+
+# =============================================================================
+# This function buckets a set of points into a grid of square cells of
+# `cell_km` kilometres. Cells are `cell_km` high everywhere and at least
+# `cell_km` wide (their width in degrees is set at the highest latitude of the
+# points). The points are sorted by cell, so the points of a run of adjacent
+# cells in the same grid row are a contiguous slice of the sorted arrays.
+# =============================================================================
+
+def build_grid_index(lat, lon, cell_km=0.5):
+    """Returns a dict holding the grid index of the points given in latitude
+    and longitude, for use with `radius_neighbors()` and `knn_neighbors()`.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    max_lat = min(np.abs(lat).max() if len(lat) else 0.0, 89.0)
+    dlat = cell_km / KM_PER_DEGREE
+    dlon = cell_km / (KM_PER_DEGREE * np.cos(np.radians(max_lat)))
+
+    rows = np.floor(lat / dlat).astype(np.int64)
+    cols = np.floor(lon / dlon).astype(np.int64)
+    row_min, col_min = (rows.min(), cols.min()) if len(lat) else (0, 0)
+    col_span = (cols.max() - col_min + 1) if len(lat) else 1
+    keys = (rows - row_min) * col_span + (cols - col_min)
+    order = np.argsort(keys, kind='stable')
+
+    return {'lat': lat, 'lon': lon, 'cell_km': cell_km, 'dlat': dlat, 'dlon': dlon,
+            'row_min': row_min, 'col_min': col_min, 'col_span': col_span,
+            'n_rows': (rows.max() - row_min + 1) if len(lat) else 0,
+            'keys': keys[order], 'order': order}
+
+
+# =============================================================================
+# This helper function returns all the (query, point, distance) triples within
+# `radius_km` of a chunk of query points. For each grid row within reach, the
+# cells within reach form one slice of the sorted points, found with two binary
+# searches; the slices are then expanded into candidate pairs and measured.
+# =============================================================================
+
+def _radius_pairs(index, qlat, qlon, radius_km):
+    reach_lat = min(np.abs(qlat).max() + radius_km / KM_PER_DEGREE, 89.0)
+    m_lat = int(np.ceil(radius_km / index['cell_km']))
+    m_lon = int(np.ceil(radius_km / (KM_PER_DEGREE * np.cos(np.radians(reach_lat))) / index['dlon']))
+
+    qrow = np.floor(qlat / index['dlat']).astype(np.int64) - index['row_min']
+    qcol = np.floor(qlon / index['dlon']).astype(np.int64) - index['col_min']
+    col_lo = np.clip(qcol - m_lon, 0, index['col_span'] - 1)
+    col_hi = np.clip(qcol + m_lon, 0, index['col_span'] - 1)
+    col_ok = (qcol + m_lon >= 0) & (qcol - m_lon < index['col_span'])
+
+    q_parts, p_parts, d_parts = [], [], []
+    for dr in range(-m_lat, m_lat + 1):
+        row = qrow + dr
+        ok = col_ok & (row >= 0) & (row < index['n_rows'])
+        start = np.searchsorted(index['keys'], row * index['col_span'] + col_lo, side='left')
+        end = np.searchsorted(index['keys'], row * index['col_span'] + col_hi, side='right')
+        counts = np.where(ok, end - start, 0)
+        total = counts.sum()
+        if total == 0:
+            continue
+        q = np.repeat(np.arange(len(qlat)), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        p = index['order'][np.repeat(start, counts) + offsets]
+        d = haversine(qlat[q], qlon[q], index['lat'][p], index['lon'][p])
+        keep = d <= radius_km
+        q_parts.append(q[keep])
+        p_parts.append(p[keep])
+        d_parts.append(d[keep])
+
+    if not q_parts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+    return np.concatenate(q_parts), np.concatenate(p_parts), np.concatenate(d_parts)
+
+
+def _brute_force_pairs(index, qlat, qlon, radius_km=np.inf):
+    n = len(index['lat'])
+    step = max(1, BRUTE_FORCE_PAIRS // max(n, 1))
+    q_parts, p_parts, d_parts = [], [], []
+    for i in range(0, len(qlat), step):
+        d = haversine(qlat[i:i + step, None], qlon[i:i + step, None], index['lat'][None, :], index['lon'][None, :])
+        q, p = np.nonzero(d <= radius_km)
+        q_parts.append(q + i)
+        p_parts.append(p)
+        d_parts.append(d[q, p])
+
+    if not q_parts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+    return np.concatenate(q_parts), np.concatenate(p_parts), np.concatenate(d_parts)
+
+
+def _pairs_frame(q, p, d, exclude_self):
+    if exclude_self:
+        keep = q != p
+        q, p, d = q[keep], p[keep], d[keep]
+    return pd.DataFrame({'query': q, 'neighbor': p, 'distance_km': d})
+
+
+# =============================================================================
+# These functions find the points of the index within `radius_km` of each query
+# point. `iter_radius_neighbors()` yields one dataframe per chunk of
+# `chunk_size` query points, so that very large results can be written out or
+# aggregated as they are produced; `radius_neighbors()` returns them all at
+# once. When the queries are the indexed points themselves (e.g. every listing
+# of a city), `exclude_self=True` drops each point's match with itself.
+# =============================================================================
+
+def iter_radius_neighbors(index, lat, lon, radius_km, chunk_size=CHUNK_SIZE, exclude_self=False):
+    """Yields, for each chunk of query points, a dataframe with the 'query'
+    position, the 'neighbor' position in the index, and the 'distance_km' of
+    every indexed point within `radius_km` of a query point.
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    for i in range(0, len(lat), chunk_size):
+        q, p, d = _radius_pairs(index, lat[i:i + chunk_size], lon[i:i + chunk_size], radius_km)
+        yield _pairs_frame(q + i, p, d, exclude_self)
+
+
+def radius_neighbors(index, lat, lon, radius_km, chunk_size=CHUNK_SIZE, exclude_self=False):
+    """Returns a dataframe with the 'query' position, the 'neighbor' position in
+    the index, and the 'distance_km' of every indexed point within `radius_km`
+    of each query point.
+    """
+    return pd.concat(list(iter_radius_neighbors(index, lat, lon, radius_km, chunk_size, exclude_self)),
+                     ignore_index=True)
+
+
+# =============================================================================
+# This function finds the `k` nearest indexed points of each query point. Each
+# chunk of queries starts with a radius that should hold about `k` points given
+# the average density of the index, and the radius is doubled for the queries
+# that have not found `k` points yet. Since every point within the radius is
+# found, the `k` closest of them are the exact `k` nearest neighbours. Isolated
+# queries that would need a very wide search fall back to a chunked brute force.
+# =============================================================================
+
+def knn_neighbors(index, lat, lon, k=5, chunk_size=CHUNK_SIZE, exclude_self=False):
+    """Returns a dataframe with the 'query' position, the 'neighbor' position in
+    the index, the 'distance_km' and the 'rank' (starting at 1) of the `k`
+    nearest indexed points of each query point.
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    n = len(index['lat'])
+    wanted = min(k + int(exclude_self), n)
+
+    lat_km = max(np.ptp(index['lat']) * KM_PER_DEGREE, index['cell_km']) if n else 1.0
+    lon_km = max(np.ptp(index['lon']) * KM_PER_DEGREE * index['dlat'] / index['dlon'], index['cell_km']) if n else 1.0
+    start_radius = max(np.sqrt(2 * wanted * lat_km * lon_km / (np.pi * max(n, 1))), index['cell_km'])
+    max_radius = 32 * index['cell_km']
+
+    results = []
+    for i in range(0, len(lat), chunk_size):
+        qlat, qlon = lat[i:i + chunk_size], lon[i:i + chunk_size]
+        pending = np.arange(len(qlat))
+        radius = start_radius
+        while len(pending) and wanted:
+            if radius > max_radius:
+                q, p, d = _brute_force_pairs(index, qlat[pending], qlon[pending])
+            else:
+                q, p, d = _radius_pairs(index, qlat[pending], qlon[pending], radius)
+            done = np.bincount(q, minlength=len(pending)) >= wanted
+            keep = done[q]
+            results.append(_pairs_frame(pending[q[keep]] + i, p[keep], d[keep], exclude_self))
+            pending = pending[~done]
+            radius *= 2
+
+    if not results:
+        return pd.DataFrame({'query': [], 'neighbor': [], 'distance_km': [], 'rank': []})
+
+    neighbors = pd.concat(results, ignore_index=True)
+    neighbors = neighbors.sort_values(['query', 'distance_km'], kind='stable')
+    neighbors['rank'] = neighbors.groupby('query').cumcount() + 1
+    neighbors = neighbors[neighbors['rank'] <= k].reset_index(drop=True)
+
+    return neighbors
+
+
+# =============================================================================
+# This function compares the grid index against a chunked brute-force search
+# with `haversine()` on a synthetic city of `n` listings, checks that both find
+# the same neighbours, and returns the timings. Run this file to print them.
+# =============================================================================
+
+def benchmark(n=20000, radius_km=0.5, k=5, seed=0):
+    """Returns a dict with the time taken by the brute-force and grid radius
+    searches, and by the grid k-nearest search, over `n` synthetic listings.
+    """
+    rng = np.random.default_rng(seed)
+    lat = 48.8566 + rng.normal(0, 0.03, n)
+    lon = 2.3522 + rng.normal(0, 0.045, n)
+
+    start = time.perf_counter()
+    index = build_grid_index(lat, lon, cell_km=radius_km)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    brute = _brute_force_pairs(index, lat, lon, radius_km)
+    brute_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = radius_neighbors(index, lat, lon, radius_km)
+    grid_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    knn_neighbors(index, lat, lon, k, exclude_self=True)
+    knn_seconds = time.perf_counter() - start
+
+    same = (set(zip(brute[0].tolist(), brute[1].tolist()))
+            == set(zip(grid['query'].tolist(), grid['neighbor'].tolist())))
+
+    return {'listings': n, 'radius_km': radius_km, 'pairs': len(grid), 'same_result': same,
+            'build_seconds': build_seconds, 'brute_force_seconds': brute_seconds,
+            'grid_radius_seconds': grid_seconds, 'grid_knn_seconds': knn_seconds}
+
+
+if __name__ == '__main__':
+    print(benchmark())
@@ -7,13 +7,16 @@ Created on Mon Nov 11 09:00:00 2019
 @author: GROUP (Anthony & Idy)
 
 Here we define some custom functions that will be used for our work with
-'http://insideairbnb.com/get-the-data.html'.
+'http://insideairbnb.com/get-the-data.html'. Each of them runs in a timing span
+of the same name, see the 'insideairbnb_metrics.py' file.
 """
+import os
+import warnings
+
 import pandas as pd
-import requests
-import re
-import pathlib
-import os.path
+
+from insideairbnb_catalog import get_catalog, select_cities
+from insideairbnb_metrics import inc, progress, timed
 
 
 # =============================================================================
@@ -22,22 +25,16 @@ import os.path
 # extract the names of cities in countries we are intersted in.
 # =============================================================================
 
+@timed('make_files_index')
 def make_files_index(bs_object):
     """This function accepts the BS4 object created from InsideAirBnB data and
     returns a pandas dataframe with rows listing all of the files available for
     download on the site.
     """
-    regions = bs_object.find_all('h2')
+    catalog = get_catalog(bs_object)
     
-    all_files_index = []   
-    
-    for r in regions:
-        all_files_index.append(r.text)
-
-    all_files_index = pd.DataFrame(all_files_index)
-    all_files_index = all_files_index[0].str.rsplit(',', n = 2, expand = True)
-    all_files_index.columns = ['city', 'region', 'country']
-    all_files_index = all_files_index.sort_values('country')
+    all_files_index = catalog.drop_duplicates('table')[['city', 'region', 'country']]
+    all_files_index = all_files_index.sort_values('country', kind='stable')
     all_files_index.reset_index(drop=True, inplace=True)
     
     return all_files_index
@@ -51,13 +48,18 @@ def make_files_index(bs_object):
 # the '|' operator.
 # =============================================================================
 
+@timed('list_cities')
 def list_cities(files_index, country_name=None, as_list = True):
     """This function takes as input the dataframe index of all files from InsideAirBnB
     along with the countrynames of interest (separated with "|") and returns a
     list of all cities for which there is data available. If no country is 
     specified, all cities are returned. When default value `as_list` is changed 
-    to False, a pandas series is returned instead.
+    to False, a pandas series is returned instead. The catalog returned by
+    `get_catalog()` can also be used in place of the files index.
     """
+    if 'table' in files_index:
+        files_index = files_index.drop_duplicates('table')
+        
     if country_name is None:
         target = files_index.city.str.lower()
         target_list = list(target)
@@ -83,6 +85,7 @@ def list_cities(files_index, country_name=None, as_list = True):
 # set the argument 'current=False'.
 # =============================================================================
 
+@timed('extract_file_url')
 def extract_file_url(bs_object, filename, city_name=None, current=True):
     """
     This function extracts the specified filename from the BS4 'content' object 
@@ -90,82 +93,76 @@ def extract_file_url(bs_object, filename, city_name=None, current=True):
     the function will return all cities with the most current listings urls. 
     Otherwise, specific city names can be entered as strings. Default is to 
     return the most current listing, otherwise, all listings can be returned by 
-    setting 'current=False'
+    setting 'current=False'. A catalog dataframe returned by `get_catalog()`
+    can be used in place of the BS4 object.
     """  
-    links = []
+    catalog = select_cities(get_catalog(bs_object), city_name)
     
-    if city_name is None:     
-        if current:
-            for table in bs_object.find_all('table'):
-                a_tag = table.find('a', href=re.compile("{filename}$".format(filename=filename)))
-                if a_tag:
-                    listings_link = a_tag.attrs['href']
-                    links.append(listings_link)
-            links = pd.DataFrame(links)            
-        else:
-            for table in bs_object.find_all('table'):
-                a_tag = table.find_all('a', href=re.compile("{filename}$".format(filename=filename)))
-                for a in a_tag:
-                    listings_link = a['href']
-                    links.append(listings_link)
-            links = pd.DataFrame(links)
-    else:         
-        if current:
-            for table in bs_object.find_all('table', class_=re.compile(city_name, re.IGNORECASE)):
-                a_tag = table.find('a', href=re.compile("{filename}$".format(filename=filename)))
-                if a_tag:
-                    listings_link = a_tag.attrs['href']
-                    links.append(listings_link)
-            links = pd.DataFrame(links)
-        else:
-            for table in bs_object.find_all('table', class_=re.compile(city_name, re.IGNORECASE)):
-                a_tag = table.find_all('a', href=re.compile("{filename}$".format(filename=filename)))
-                for a in a_tag:
-                    listings_link = a['href']
-                    links.append(listings_link)
-            links = pd.DataFrame(links)            
+    links = catalog[catalog['source_url'].str.contains("{filename}$".format(filename=filename))]
+    if current:
+        links = links.drop_duplicates('table')
     
-    links.columns = ['source_url']
+    links = links[['source_url']].reset_index(drop=True)
     return links
 
 
+# =============================================================================
+# This function parses the urls of the dataframe created by `extract_file_url()`
+# in a single vectorized pass. Every url has the form
+# 'http://data.insideairbnb.com/<country>/<region>/<city>/<date>/<folder>/<file>',
+# from which we derive the source meta information and the local filename where
+# the file is saved ('<country>/<region>/<city>/<date>_<file>'). The functions
+# below all reuse this parsing instead of splitting each url themselves.
+# =============================================================================
+
+SOURCE_URL_PARTS = ['source', 'country', 'region', 'city', 'last_update', 'source_folder', 'source_filename']
+
+
+@timed('parse_source_urls')
+def parse_source_urls(import_list_df):
+    """This function takes as an input the df returned by `extract_file_url` and
+    returns a df with the 'source_url' column along with its 'country', 'region',
+    'city', 'last_update', 'source_folder' and 'source_filename', and the
+    'local_path' and 'local_filename' where the file is saved.
+    """
+    urls = import_list_df['source_url']
+    
+    parts = urls.astype(str).str.rsplit('/', n=6, expand=True).reindex(columns=range(7), fill_value='')
+    parts.columns = SOURCE_URL_PARTS
+    parts = parts.drop(columns='source')
+    parts.insert(0, 'source_url', urls)
+    parts['local_path'] = parts['country'] + '/' + parts['region'] + '/' + parts['city']
+    parts['local_filename'] = parts['local_path'] + '/' + parts['last_update'] + '_' + parts['source_filename']
+    
+    return parts
+
+
 # =============================================================================
 # This function takes as an input the dataframe created by `extract_file_url()` 
 # and downloads and saves locally all of the files specificed in the 'source_url'
 # column. The default behavior is to preserve existing local files. To overwrite
-# local files, change the default argument to `replace=True`.
+# local files, change the default argument to `replace=True`; files that have not
+# changed on the server since they were downloaded are not fetched again. Files
+# are downloaded concurrently by `workers` threads, streamed to disk, and recorded
+# in a download manifest, see the 'insideairbnb_download.py' file.
 # =============================================================================
 
-def save_insideairbnb_file(extract_file_df, replace=False):
+@timed('save_insideairbnb_file')
+def save_insideairbnb_file(extract_file_df, replace=False, workers=4):
     """
     This function takes as an input, the dataframe created by the extract_file_url() 
-    function and downloadsthe file(s) from each row in the 'source_url' column, 
+    function and downloads the file(s) from each row in the 'source_url' column, 
     and saves it locally. Locally saved files will not be overwritten unless
-    the 'replace' argument is changed to 'replace=True'.
+    the 'replace' argument is changed to 'replace=True', in which case they are
+    only downloaded again if they changed on the server. Returns a dataframe
+    summarising the bytes and throughput of each file.
     """
-    for i in range(len(extract_file_df)):
-        url = extract_file_df.iloc[i,0]
-        localpath = "/".join(url.split("/")[3:-3])
-        date = url.split("/")[6] 
-        file = url.split("/")[-1]
-        filename = localpath + "/" + date + "_" + file
-  
-        if replace:       
-            pathlib.Path(localpath).mkdir(parents=True, exist_ok=True)        
-            with open(filename, "wb") as f:
-                req = requests.get(url)
-                f.write(req.content)        
-            print('File saved locally to: ', filename)
-        
-        else: 
-            if os.path.isfile(filename):
-                print(filename, '--this file already exists locally')
-            else:
-                pathlib.Path(localpath).mkdir(parents=True, exist_ok=True)        
-                with open(filename, "wb") as f:
-                    req = requests.get(url)
-                    f.write(req.content)        
-                print('File saved locally to: ', filename)
+    from insideairbnb_download import download_files
+
+    parsed = parse_source_urls(extract_file_df)
+    
+    return download_files(parsed['source_url'], parsed['local_filename'],
+                          workers=workers, replace=replace)
 
 
 # =============================================================================
@@ -178,56 +175,182 @@ def get_local_filenames(extract_file_df):
     """This helper function takes as input the df returned by `extract_file_url` and 
     returns a df with the local filenames where these url's are saved.
     """
-    list_files = []
-            
-    for i in range(len(extract_file_df)):
-            url = extract_file_df.iloc[i,0]
-            localpath = "/".join(url.split("/")[3:-3])
-            date = url.split("/")[6] 
-            file = url.split("/")[-1]
-            filename = localpath + "/" + date + "_" + file
-            list_files.append(filename)
-    
-    list_files = pd.DataFrame(list_files)
-    list_files.columns = ['local_filename']
+    list_files = parse_source_urls(extract_file_df)[['local_filename']]
+    list_files = list_files.reset_index(drop=True)
     return list_files
 
 
 # =============================================================================
-# This is another helper function that reads in our locally saved csv files, adds
-# a column with the source information, and then re-saves the csv file to the same
-# location.
+# These helper functions read our locally saved files, whatever their format. The
+# detailed InsideAirBnb files ('listings.csv.gz', 'calendar.csv.gz', ...) are kept
+# gzip compressed on disk and decompressed on the fly as they are read, so no
+# uncompressed copy is ever written. The compression is detected from the first
+# bytes of the file rather than from its extension. Files converted to Parquet
+# with `convert_csv_to_parquet()` are read with pyarrow.
 # =============================================================================
 
-def add_source_info(filename, source_info): 
-    """This is helper function that reads in our locally saved csv files, adds 
-    a column with the source information, and then re-saves the csv file to the 
-    same location.
+_MAGIC_NUMBERS = [(b'\x1f\x8b', 'gzip'), (b'PK\x03\x04', 'zip'), (b'BZh', 'bz2'),
+                  (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+
+def file_compression(filename):
+    """Returns the compression of a local file ('gzip', 'zip', 'bz2', 'xz' or
+    'zstd') as expected by `pd.read_csv()`, or None if it is not compressed.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    for prefix, compression in _MAGIC_NUMBERS:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def read_local_file(filename, chunksize=None, usecols=None):
+    """Reads a locally saved csv file (compressed or not) or Parquet file into
+    a dataframe. If `chunksize` is given, an iterator of dataframes of at most
+    `chunksize` rows is returned instead.
     """
-    df = pd.read_csv(filename, encoding='utf-8-sig')
-    df['source'] = source_info
-    df.to_csv(filename, encoding='utf-8-sig', index=False)
-  
+    if str(filename).endswith('.parquet'):
+        import pyarrow.parquet as pq
+        if chunksize is None:
+            return pd.read_parquet(filename, columns=usecols)
+        batches = pq.ParquetFile(filename).iter_batches(batch_size=chunksize, columns=usecols)
+        return (batch.to_pandas() for batch in batches)
+
+    return pd.read_csv(filename, index_col=None, header=0, usecols=usecols,
+                       compression=file_compression(filename), chunksize=chunksize)
+
+
+def read_header(filename):
+    """Returns the list of column names of a locally saved csv or Parquet file,
+    without reading any of its rows.
+    """
+    if str(filename).endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_schema(filename).names
+
+    return list(pd.read_csv(filename, nrows=0, compression=file_compression(filename)).columns)
+
+
+# =============================================================================
+# This function converts a locally saved csv file (compressed or not) into a
+# Parquet file, which is several times smaller and much faster to read back. The
+# file is streamed through twice, a chunk at a time: once to find a type that
+# fits every value of each column, and once to write the Parquet file. This
+# requires the optional `pyarrow` package.
+# =============================================================================
+
+@timed('convert_csv_to_parquet')
+def convert_csv_to_parquet(filename, parquet_filename=None, chunksize=100000, remove=False):
+    """Converts the local csv file `filename` to Parquet, saved next to it as
+    '<filename>.parquet' unless `parquet_filename` is given, and returns the new
+    filename. With `remove=True` the csv file is deleted afterwards.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if parquet_filename is None:
+        parquet_filename = str(filename) + '.parquet'
+
+    kinds = {}
+    for chunk in read_local_file(filename, chunksize=chunksize):
+        for column in chunk.columns:
+            values = chunk[column]
+            if values.isna().all():
+                kind = None
+            elif pd.api.types.is_bool_dtype(values):
+                kind = 'bool'
+            elif pd.api.types.is_integer_dtype(values):
+                kind = 'int'
+            elif pd.api.types.is_float_dtype(values):
+                # integer columns with missing values are read in as floats
+                kind = 'int' if (values.dropna() % 1 == 0).all() else 'float'
+            else:
+                kind = 'str'
+            previous = kinds.get(column)
+            if previous is None or kind is None or previous == kind:
+                kinds[column] = previous if kind is None else kind
+            elif {previous, kind} <= {'int', 'float'}:
+                kinds[column] = 'float'
+            else:
+                kinds[column] = 'str'
+
+    arrow_types = {'bool': pa.bool_(), 'int': pa.int64(), 'float': pa.float64(), 'str': pa.string(), None: pa.string()}
+    pandas_types = {'bool': 'boolean', 'int': 'Int64', 'float': 'float64', 'str': 'string', None: 'string'}
+    schema = pa.schema([(column, arrow_types[kind]) for column, kind in kinds.items()])
+
+    with pq.ParquetWriter(parquet_filename, schema, compression='zstd') as writer:
+        for chunk in read_local_file(filename, chunksize=chunksize):
+            chunk = chunk.astype({column: pandas_types[kind] for column, kind in kinds.items()})
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+    if remove:
+        os.remove(filename)
+
+    return parquet_filename
+
+
+# =============================================================================
+# This helper function used to read in our locally saved csv files, add a column
+# with the source information, and re-save them to the same location. Downloaded
+# files are now never rewritten: the source information is added while the files
+# are loaded instead, through the `sources` argument of `load_csv_to_sqlite()` in
+# the 'insideairbnb_db.py' file (or the `import_list_df` argument of
+# `read_csv_to_bigtable()` below). The function is kept so that old scripts still
+# run, and does nothing.
+# =============================================================================
+
+def add_source_info(filename, source_info):
+    """Deprecated: does nothing. Tag the rows with their source when loading
+    the file instead, with the `sources` argument of `load_csv_to_sqlite()`.
+    """
+    warnings.warn('add_source_info() no longer rewrites downloaded files and does nothing; pass '
+                  'sources= to load_csv_to_sqlite() to tag the rows with their source instead',
+                  DeprecationWarning, stacklevel=2)
+
 
 # =============================================================================
 # This function can be used to read in multiple csv files stored locally into 
 # one big pandas dataframe that can be uploaded into the SQLITE database. In 
 # takes the df of local filenames returned by `get_local_filenames()` as an 
-# input, and returns one large pandas df.
+# input, and returns one large pandas df. If the import list returned by 
+# `extract_file_url()` is also given, a 'source' column with the url of each 
+# file is added as it is read. The columns of each file are renamed to their
+# canonical names first, so the same column spelled differently in different
+# years ends up in a single column, and a dict of declared `dtypes` (such as
+# `LISTINGS_DTYPES`) can be applied to each file so the columns keep their types.
 # =============================================================================
 
-def read_csv_to_bigtable(local_filenames_df):
+@timed('read_csv_to_bigtable')
+def read_csv_to_bigtable(local_filenames_df, import_list_df=None, dtypes=None):
     """
     This function takes a dataframe returned from `get_local_filenames`, iterates
     over each row to read in the different csv files, and then saves all of these 
-    csv files as one large dataframe.
+    csv files as one large dataframe. If `import_list_df` is given, each row is
+    tagged with the 'source_url' of its file in a 'source' column.
     """
+    from insideairbnb_schema import apply_dtypes, canonicalize
+
+    filenames = local_filenames_df.iloc[:, 0]
+    sources = [None] * len(filenames) if import_list_df is None else import_list_df['source_url']
+    
     big_table = []  
-    for i in range(len(local_filenames_df)):
-        df = pd.read_csv(local_filenames_df.iloc[i,0], index_col=None, header=0)
+    for filename, source in zip(filenames, sources):
+        df = canonicalize(read_local_file(filename))
+        if source is not None:
+            df['source'] = source
+        if dtypes is not None:
+            df = apply_dtypes(df, dtypes)
         big_table.append(df)
+        inc('insideairbnb_rows_total', len(df), stage='read_csv_to_bigtable', table='bigtable')
+        progress('read_csv_to_bigtable', len(big_table), len(filenames), local_filename=filename, rows=len(df))
 
     big_table = pd.concat(big_table, axis = 0, ignore_index=True)
+    if dtypes is not None:
+        # categoricals with different categories are concatenated as strings
+        for column in big_table.columns:
+            if dtypes.get(column) == 'category':
+                big_table[column] = big_table[column].astype('category')
     
     return big_table
 
@@ -243,9 +366,7 @@ def split_source_url(import_list_df):
     containing the relevant source meta information (country, region, city, last_update)     
     """
     
-    split_columns = import_list_df['source_url'].str.rsplit('/', 6 ,expand=True)
-    split_columns.columns = ['source', 'country', 'region', 'city','last_update', 'source_folder', 'source_filename']
-    split_columns = split_columns.drop(columns = ['source', 'source_folder', 'source_filename'])
+    split_columns = parse_source_urls(import_list_df)[['country', 'region', 'city', 'last_update']]
     split_columns = pd.merge(import_list_df, split_columns, left_index=True, right_index=True)    
     
     return split_columns
\ No newline at end of file
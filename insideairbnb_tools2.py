@@ -5,9 +5,10 @@ Created on Thu Dec  5 16:01:31 2019
 @author: anguyen1210
 """
 import pandas as pd
-import re
 import numpy as np
 
+from insideairbnb_catalog import get_catalog, select_cities
+
 
 # =============================================================================
 # This function returns the distance in kilometers between two points given in 
@@ -25,38 +26,66 @@ latitude and longitude"""
 
 
 
+# =============================================================================
+# This function extracts the tables listing all available files for every city
+# on the InsideAirBnb database in one call. The row values are taken from the
+# catalog built in a single pass over the page (see 'insideairbnb_catalog.py'),
+# and each column is built and typed in one go: 'Date Compiled' is parsed into
+# dates, and the city and file type columns are categoricals. Only the tables
+# of the cities matching `city_name` are returned, if it is given.
+# =============================================================================
+
+TABLE_COLUMNS = ['Date Compiled', 'Country/City', 'File Name', 'Description']
+
+
+def extract_tables(bs_object, city_name=None):
+    """This function accepts the BS4 object containing the InsideAirBnB html, or
+    the catalog built from it, and returns one dataframe with the rows of all 
+    the city tables (or of those matching `city_name`), along with the 'table' 
+    each row comes from and the 'file_type' of its file."""
+    
+    catalog = select_cities(get_catalog(bs_object), city_name)
+    
+    dates = pd.to_datetime(catalog['date_compiled'], format='%d %B, %Y', errors='coerce')
+    if dates.isna().all() and catalog['date_compiled'].notna().any():
+        dates = pd.to_datetime(catalog['date_compiled'], errors='coerce')
+    
+    results = pd.DataFrame({'Date Compiled': dates.to_numpy(),
+                            'Country/City': pd.Categorical(catalog['city']),
+                            'File Name': catalog['source_url'].to_numpy(),
+                            'Description': catalog['description'].to_numpy(),
+                            'table': catalog['table'].to_numpy(),
+                            'file_type': pd.Categorical(catalog['file_type'])})
+    
+    return results
+
+
 # =============================================================================
 # This function extracts the entire table listings all available files for each
 # city on the InsideAirBnb database. It takes the BS4 object as an input and
-# returns a pandas dataframe (df) as a default.
+# returns the BS4 table as a default. The catalog returned by `load_catalog()`
+# (as used by the scrape scripts) can be given instead, but it does not hold the
+# BS4 tables of the page, so only `df=True` works with it.
 # =============================================================================
 
 def extract_table(bs_object, city_name, df=False):
     """This function accepts the city name as a string and extracts the entire 
     city table from the BS4 object `html` containing the InsideAirBnB html.
-    df=False returns a BS4 object. ds=True returns a pandas dataframe"""
+    df=False returns a BS4 object. df=True returns a pandas dataframe, and is
+    required when a catalog dataframe is given in place of the BS4 object."""
     
-    table_city = bs_object.find('table', class_=re.compile(city_name, re.IGNORECASE))
-    results = pd.DataFrame()
-    rows = table_city.find_all('tr')
-
-    for row in rows:        
-        row_data = [td.a['href'] if td.find('a') else 
-                 ''.join(td.stripped_strings)
-                 for td in row.find_all('td')]
-        temp_df = pd.DataFrame([row_data])
-        results = results.append(temp_df)
-
-    cols = table_city.find_all('th')
-    col_names = [c.text for c in cols]
-    col_names = [x.strip() for x in col_names]
-
-    results.columns = col_names
-    results = results.dropna(how = 'all')    
-    results = results.reset_index(drop = True)
+    catalog, tables = get_catalog(bs_object, with_tables=True)
+    if tables is None and not df:
+        raise TypeError('extract_table() needs the BS4 object of the page to return a BS4 table; '
+                        'use df=True with a catalog dataframe')
+    matches = select_cities(catalog, city_name)
+    if matches.empty:
+        raise ValueError('no city table matches {0!r}'.format(city_name))
+    table_no = matches['table'].iloc[0]
     
     if df:
+        results = extract_tables(catalog[catalog['table'] == table_no])
+        results = results[TABLE_COLUMNS].reset_index(drop = True)
         return results
     else:
-        return table_city
-   
+        return tables[table_no]
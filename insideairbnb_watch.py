@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+INSIDEAIRBNB WATCH
+
+@author: anguyen1210
+
+This file contains a long-running watcher that detects new snapshots on the
+InsideAirBnb site, instead of re-running 'scrape_insideairbnb_02.py' by hand.
+Every `interval` seconds (plus or minus a random `jitter`), the 'get the data'
+page is revalidated with a conditional request through `fetch_page()`. When the
+page has not changed, a poll costs a single '304 Not Modified' round trip and
+nothing is parsed. When it has changed, its catalog is compared with the last
+one seen, and only the files that were added are passed on to the actions
+(download and ingest, alert, ...).
+
+The files found are first recorded as pending in the 'watch_pending' table of
+`catalog_db`, and only cleared once every action has succeeded on them. A file
+whose download or load failed is therefore passed on again at the next poll,
+even after a restart, although the catalog it was found in is already saved.
+
+Run this file to watch for new 'listings.csv' files of every city, downloading
+and loading them into the local database as they appear.
+"""
+import datetime
+import random
+import time
+
+import pandas as pd
+
+from insideairbnb_catalog import (CATALOG_DB, diff_catalogs, load_catalog, load_catalog_version,
+                                  page_hash, select_cities)
+from insideairbnb_connection import connect
+from insideairbnb_http import HTTP_CACHE, PAGE_URL, fetch_page
+from insideairbnb_metrics import timed
+
+
+POLL_INTERVAL = 6 * 3600
+JITTER = 0.1
+
+
+# =============================================================================
+# These functions are the actions the watcher can take on the new files it
+# finds. Each takes an import list, with the same 'source_url' column as the
+# dataframe returned by `extract_file_url()`, so that any of the functions of
+# the 'insideairbnb_tools.py' file can also be used as an action.
+# =============================================================================
+
+def print_new_files(import_list_df):
+    """Prints the urls of the new files."""
+    for url in import_list_df['source_url']:
+        print('New file available: ', url)
+
+
+def download_and_ingest(import_list_df, db_path=None, table='listings'):
+    """Downloads the new files and loads them into `table` of the database at
+    `db_path` (see `default_db_path()`). The connection is kept open between
+    polls.
+    """
+    from insideairbnb_connection import shared_connection
+    from insideairbnb_db import ingest_import_list
+    from insideairbnb_tools import save_insideairbnb_file
+
+    summary = save_insideairbnb_file(import_list_df)
+    failed = summary[summary['status'] == 'failed']
+    if len(failed):
+        raise IOError('{0} download(s) failed: {1}'.format(len(failed), ', '.join(failed['source_url'])))
+    ingest_import_list(import_list_df, shared_connection(db_path), table)
+
+
+# =============================================================================
+# This function runs a single poll. `state` holds the hash and catalog of the
+# last page seen, and is updated in place. It returns the catalog rows that were
+# added to or removed from the site since the last poll (see `diff_catalogs()`),
+# restricted to the `filename` (or tuple of filenames), `city_name` and
+# `country_name` we are interested in; the result is empty when the page has not
+# changed.
+# =============================================================================
+
+@timed('poll_once')
+def poll_once(state, filename='listings.csv', city_name=None, url=PAGE_URL,
+              cache_path=HTTP_CACHE, catalog_db=CATALOG_DB, country_name=None):
+    """Revalidates the page at `url` and returns a dataframe of the `filename`
+    files of the cities matching `city_name` (and countries matching
+    `country_name`) that were added or removed since the catalog held in
+    `state`.
+    """
+    response = fetch_page(url, ttl=0, cache_path=cache_path)
+    response.encoding = 'utf-8'
+    page = response.text
+
+    # a page revalidated from the cache may still be one the watcher has not
+    # seen, so unchanged pages are recognised by their hash
+    key = page_hash(page)
+    if key == state.get('page_hash'):
+        return diff_catalogs(state['catalog'], state['catalog'])
+
+    catalog = load_catalog(page, catalog_db)
+    previous = state.get('catalog')
+    if previous is None:
+        previous = catalog
+    state['page_hash'] = key
+    state['catalog'] = catalog
+
+    return _select(diff_catalogs(previous, catalog), filename, city_name, country_name)
+
+
+def _select(catalog, filename, city_name=None, country_name=None):
+    catalog = select_cities(catalog, city_name)
+    if country_name is not None:
+        catalog = catalog[catalog['country'].str.contains(country_name, regex=True, case=False, na=False)]
+    return catalog[catalog['source_url'].str.endswith(filename)].reset_index(drop=True)
+
+
+# =============================================================================
+# These functions keep the files found by the watcher that the actions have not
+# all succeeded on yet, in the 'watch_pending' table of `catalog_db`.
+# =============================================================================
+
+def _connect_pending(catalog_db):
+    conn = connect(catalog_db)
+    conn.execute("create table if not exists watch_pending (source_url text primary key, found_at text)")
+    return conn
+
+
+def add_pending(urls, catalog_db=CATALOG_DB):
+    """Records the files at `urls` as pending."""
+    found_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    conn = _connect_pending(catalog_db)
+    try:
+        with conn:
+            conn.executemany("insert or ignore into watch_pending values (?, ?)",
+                             ((url, found_at) for url in urls))
+    finally:
+        conn.close()
+
+
+def list_pending(catalog_db=CATALOG_DB):
+    """Returns the set of urls of the pending files."""
+    conn = _connect_pending(catalog_db)
+    try:
+        return {row[0] for row in conn.execute("select source_url from watch_pending")}
+    finally:
+        conn.close()
+
+
+def clear_pending(urls, catalog_db=CATALOG_DB):
+    """Removes the files at `urls` from the pending files."""
+    conn = _connect_pending(catalog_db)
+    try:
+        with conn:
+            conn.executemany("delete from watch_pending where source_url = ?", ((url,) for url in urls))
+    finally:
+        conn.close()
+
+
+# =============================================================================
+# This function runs the watcher. It starts from the last catalog saved in
+# `catalog_db`, so files that appeared while the watcher was stopped are picked
+# up by the first poll; on the very first run, the current page becomes the
+# starting point and nothing is acted on. Errors during a poll (e.g. the site
+# being down) are printed, and the watcher carries on at the next poll. The
+# actions are called with the new files and with the pending files of earlier
+# polls still listed on the site; if any of them fails, all of these files stay
+# pending and are passed on again at the next poll. Use
+# `max_polls` to stop after a number of polls; otherwise stop it with Ctrl-C.
+# =============================================================================
+
+def watch(filename='listings.csv', city_name=None, actions=(print_new_files,),
+          interval=POLL_INTERVAL, jitter=JITTER, max_polls=None, url=PAGE_URL,
+          cache_path=HTTP_CACHE, catalog_db=CATALOG_DB, country_name=None):
+    """Polls the InsideAirBnb page every `interval` seconds, give or take a
+    `jitter` fraction of it, and calls each of the `actions` with the import
+    list of the new `filename` files of the cities matching `city_name` and
+    the countries matching `country_name`. Returns the number of polls made.
+    """
+    state = {}
+    try:
+        state['catalog'] = load_catalog_version(catalog_db=catalog_db)
+    except LookupError:
+        print('No saved catalog: the current page will be the starting point')
+
+    polls = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                diff = poll_once(state, filename, city_name, url, cache_path, catalog_db, country_name)
+            except Exception as e:
+                print('Poll failed: ', e)
+                diff = None
+
+            if diff is not None:
+                new_urls = list(diff.loc[diff['change'] == 'added', 'source_url'])
+                removed = diff[diff['change'] == 'removed']
+                add_pending(new_urls, catalog_db)
+
+                # pending files no longer listed on the site are dropped
+                pending = list_pending(catalog_db)
+                listed = set(state['catalog']['source_url'])
+                clear_pending(pending - listed, catalog_db)
+                selected = _select(state['catalog'], filename, city_name, country_name)
+                todo = selected.loc[selected['source_url'].isin(pending), 'source_url'].drop_duplicates()
+                added = pd.DataFrame({'source_url': todo.tolist()})
+
+                print('Poll done in {0:.2f}s: {1} new file(s), {2} to retry, {3} removed file(s)'.format(
+                    time.perf_counter() - started, len(new_urls), len(added) - len(set(new_urls)),
+                    len(removed)))
+                for url_removed in removed['source_url']:
+                    print('File no longer listed: ', url_removed)
+                if len(added):
+                    succeeded = True
+                    for action in actions:
+                        try:
+                            action(added)
+                        except Exception as e:
+                            succeeded = False
+                            print('Action {0} failed: {1}'.format(getattr(action, '__name__', action), e))
+                    if succeeded:
+                        clear_pending(added['source_url'], catalog_db)
+
+            polls += 1
+            if max_polls is not None and polls >= max_polls:
+                break
+            time.sleep(max(0.0, interval * (1 + random.uniform(-jitter, jitter))))
+    except KeyboardInterrupt:
+        print('Watcher stopped')
+
+    return polls
+
+
+if __name__ == '__main__':
+    watch(actions=(print_new_files, download_and_ingest))
@@ -10,18 +10,13 @@ This script, the first of two parts, will automatically extract specified files
 site (http://insideairbnb.com/get-the-data.html), transform, and upload it to a
 locally saved SQLITE database. Exact file names can be specified. All cities 
 from specified countries will automatically be extracted.
+
+This script walks through the steps one at a time, and is meant to be run rather
+than imported. The same steps can be run with the 'insideairbnb' command line
+tool, e.g. `insideairbnb ingest --countries "france|switzerland"`, or imported
+from the 'insideairbnb_pipeline.py' file.
 """
 import pandas as pd
-from bs4 import BeautifulSoup
-import requests
-import requests_cache
-import sqlite3
-
-# =============================================================================
-# Set-up cache
-# =============================================================================
-
-requests_cache.install_cache('insideairbnb')
 
 # =============================================================================
 # Scrape InsideAirBnb: 
@@ -32,12 +27,17 @@ requests_cache.install_cache('insideairbnb')
 
 """
 Here we download the raw html from Inside AirBnB and then parse it
-into text that we can work with. The final saved object, `html` will be a special
-BeautifulSoup object, from which we can 'scrape' or extract the relevant 
-information we are looking for.
+into text that we can work with. The final saved object, `content` will be a
+catalog of all the files listed on the page, from which we can extract the 
+relevant information we are looking for. The page is only parsed with 
+BeautifulSoup the first time it is seen; afterwards its catalog is loaded from
+the local 'insideairbnb_catalog.db' file. The page itself is cached for an hour
+in 'insideairbnb_http_cache.db', and then revalidated with the website; the
+data files we download below are never cached.
 """
+from insideairbnb_http import fetch_page
 
-source = requests.get('http://insideairbnb.com/get-the-data.html')
+source = fetch_page('http://insideairbnb.com/get-the-data.html')
 
 if source.from_cache:
     print("Retrieved from cache")
@@ -52,8 +52,9 @@ print("The url has",len(source.text),"characters")
 source.encoding = 'utf-8'
 source = source.text
 
-content = BeautifulSoup(source, 'lxml')
-#print(content.prettify())
+from insideairbnb_catalog import load_catalog
+
+content = load_catalog(source)
 
 # regions = content.find_all('h2')
 # for name in regions: print(name.text)
@@ -107,60 +108,41 @@ save_insideairbnb_file(import_list)
 
 # =============================================================================
 # Transform locally saved .csv files: 
-#     input downloaded listings.csv filename, 
-#     opens the csv file, 
-#     makes the necessary modifications (adding the source, date, region, etc), 
-#     saves the content into a new, transformed csv file in the same directory)
+#     the downloaded files are left untouched, 
+#     the source info (url, date, region, etc) is added to each row as it is 
+#     loaded into the database below
 # =============================================================================
 
-"""First we create a list of all the local filenames that we want to update"""
+"""We can create a list of all the local filenames where our files are saved"""
 from insideairbnb_tools import get_local_filenames
 
 local_files = get_local_filenames(import_list)
 
-"""Next we combine our `local_files` with our `import_list`, and iterate over 
-all the rows to update, where the first column is the file we will update, and 
-the second column is the source info"""    
-
-from insideairbnb_tools import add_source_info
-
-filename_source = pd.DataFrame.merge(local_files, import_list, left_index=True, right_index=True)
-  
-filename_source.apply(lambda filename_source: add_source_info(filename_source['local_filename'], filename_source['source_url']), axis=1)
-
 
 # =============================================================================
-# Load tranformed data into local database: 
-#     input transformed table from D5, 
+# Load data into local database: 
+#     input downloaded files, tagged with their source as they are read, 
 #     insert into SQLITE database
 #     (#first create the SQLITE database)
 # =============================================================================
 
-"""First we read all of our downloaded listings.csv files into one big table"""
-
-from insideairbnb_tools import read_csv_to_bigtable
-
-listings = read_csv_to_bigtable(local_files)
-
-"""Additionally, we can convert our `import_list` file as a separate `source_info`
-table that we can reference later."""
+"""Next we create the SQLITE file and load our downloaded listings.csv files
+into the 'listings' table. Files are streamed in a chunk at a time, so that we 
+never need to hold all of the listings in memory at once. Each file loaded is 
+recorded, along with its source info (country, region, city, last_update), in 
+a separate `source_info` table that we can reference later. Files that are 
+already recorded in `source_info` are not loaded again, so re-running this 
+script only loads the new snapshots."""
 
-from insideairbnb_tools import split_source_url
+from insideairbnb_db import connect, ingest_import_list
 
-source_info = split_source_url(import_list)
-
-
-"""Next we create the SQLITE file and insert the table"""
-
-#connect to the new database
+#connect to the database: 'insideairbnb.db', unless the INSIDEAIRBNB_DB
+#environment variable gives another path
 #note, python will create a new database if it does not find the name entered here
-conn = sqlite3.connect('insideairbnb.db') 
-
-#insert the data frames of the latest listings of the 5 cities in the database
-listings.to_sql("listings", conn, index=False, if_exists="replace")
+conn = connect()
 
-#insert the data frame with the source info on these listings into the database
-source_info.to_sql("source_info", conn, index=False, if_exists="replace")
+#insert the latest listings of the cities, and their source info, into the database
+ingest_import_list(import_list, conn)
 
 
 # =============================================================================
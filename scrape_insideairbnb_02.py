@@ -8,11 +8,12 @@ This script, the second of two parts, extends our InsideAirBnB (http://insideair
 webscraper to extract the complete historical listings of the specified files 
 of interest. Additionally, we implement an email alert system that will notify
 us when new cities and/or new data is made available on the InsideAirBnb site.
+
+Like the first part, this script is meant to be run rather than imported; to
+keep watching the site for new data, use `insideairbnb watch` instead.
 """
 
-from bs4 import BeautifulSoup
-import requests
-import requests_cache
+from insideairbnb_http import fetch_page
 
 
 # =============================================================================
@@ -21,9 +22,7 @@ import requests_cache
 #     Make eventual changes in the database
 # =============================================================================
 
-requests_cache.install_cache('insideairbnb')
-
-source = requests.get('http://insideairbnb.com/get-the-data.html')
+source = fetch_page('http://insideairbnb.com/get-the-data.html')
 
 if source.from_cache:
     print("Retrieved from cache")
@@ -33,7 +32,9 @@ else:
 source.encoding = 'utf-8'
 source = source.text
 
-content = BeautifulSoup(source, 'lxml')
+from insideairbnb_catalog import load_catalog
+
+content = load_catalog(source)
 
 # -----------------------------------------------------------------------------
 
@@ -55,9 +56,9 @@ import_historical_listings =  extract_file_url(content, 'listings.csv', target_c
 
 #Finally, we can save these historical listings
 
-from insideairbnb_tools import save_inside_airbnb
+from insideairbnb_tools import save_insideairbnb_file
 
-save_inside_airbnb(import_historical_listings) #We don't actually save all of these here, because it's alot
+save_insideairbnb_file(import_historical_listings) #We don't actually save all of these here, because it's alot
 
 
 # =============================================================================
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the new file check and of the alert dispatcher of
+'insideairbnb_alert.py', against a local debugging SMTP server and against
+failing sinks.
+"""
+import smtplib
+import socketserver
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import insideairbnb_alert as alert
+from insideairbnb_connection import connect
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """A minimal SMTP server that keeps the messages it receives."""
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.reply('220 localhost test SMTP server')
+        while True:
+            line = self.rfile.readline().decode('utf-8', 'replace').rstrip('\r\n')
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250 localhost')
+            elif command in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    data = self.rfile.readline().decode('utf-8', 'replace').rstrip('\r\n')
+                    if data == '.':
+                        break
+                    lines.append(data[1:] if data.startswith('..') else data)
+                self.server.messages.append('\n'.join(lines))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SmtpHandler)
+    server.daemon_threads = True
+    server.messages = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _new_files(*cities):
+    return pd.DataFrame({'country': 'france', 'city': list(cities),
+                         'source_url': ['http://data.insideairbnb.com/france/idf/{0}/2020-01-01/data/'
+                                        'listings.csv.gz'.format(city) for city in cities],
+                         'new_city': 1})
+
+
+@pytest.mark.parametrize('read_only', [False, True])
+def test_find_new_files_anti_joins_source_info(tmp_path, read_only):
+    db_path = str(tmp_path / 'test.db')
+    loaded = _new_files('paris')
+    conn = sqlite3.connect(db_path)
+    loaded[['country', 'city', 'source_url']].to_sql('source_info', conn, index=False)
+    conn.close()
+
+    urls = list(_new_files('paris', 'lyon')['source_url'])
+    urls.append(urls[0].replace('2020-01-01', '2020-02-01'))
+    conn = connect(db_path, read_only=read_only)
+    try:
+        new_files = alert.find_new_files(pd.DataFrame({'source_url': urls}), conn)
+        indexes = {row[0] for row in conn.execute("select name from sqlite_master where type = 'index'")}
+    finally:
+        conn.close()
+
+    assert list(new_files['city']) == ['lyon', 'paris']
+    assert list(new_files['new_city']) == [1, 0]
+    assert ('source_info_key' in indexes) != read_only
+
+
+class _FailingSink:
+    """A sink that fails `failures` times with a network error before working."""
+
+    def __init__(self, failures, retries=3, backoff=0.5):
+        self.failures = failures
+        self.retries = retries
+        self.backoff = backoff
+        self.attempts = 0
+        self.sent = []
+
+    def send(self, message):
+        def attempt():
+            self.attempts += 1
+            if self.attempts <= self.failures:
+                raise OSError('connection refused')
+            self.sent.append(message)
+
+        alert._with_retries(attempt, self.retries, self.backoff, 'test delivery')
+
+    def close(self):
+        pass
+
+
+def test_one_digest_for_several_submits(smtp_server):
+    sink = alert.SmtpSink(host='127.0.0.1', port=smtp_server.server_address[1], use_ssl=False,
+                          sender='watcher@localhost', recipients=['me@localhost'])
+    with alert.AlertDispatcher([sink], window=0.5) as dispatcher:
+        dispatcher.submit(_new_files('paris'))
+        dispatcher.submit(_new_files('lyon'))
+        dispatcher.submit(_new_files('paris', 'bordeaux'))
+
+    assert dispatcher.stats == {'submitted': 3, 'digests': 1, 'delivered': 1, 'failed': 0}
+    assert len(smtp_server.messages) == 1
+    message = smtp_server.messages[0]
+    assert 'Subject: ' + alert.ALERT_SUBJECT in message
+    for city in ('paris', 'lyon', 'bordeaux'):
+        assert '/idf/{0}/'.format(city) in message
+
+
+def test_retries_with_exponential_backoff(monkeypatch):
+    delays = []
+    monkeypatch.setattr(alert.time, 'sleep', delays.append)
+    sink = _FailingSink(failures=2, backoff=0.5)
+
+    with alert.AlertDispatcher([sink], window=0) as dispatcher:
+        dispatcher.submit(_new_files('paris'))
+
+    assert sink.attempts == 3
+    assert delays == [0.5, 1.0]
+    assert len(sink.sent) == 1
+    assert dispatcher.stats['delivered'] == 1 and not dispatcher.errors
+
+
+def test_failing_sink_does_not_stop_the_others(monkeypatch):
+    monkeypatch.setattr(alert.time, 'sleep', lambda seconds: None)
+    failing, working = _FailingSink(failures=10, retries=2), _FailingSink(failures=0)
+
+    with alert.AlertDispatcher([failing, working], window=0) as dispatcher:
+        dispatcher.submit(_new_files('paris'))
+
+    assert failing.attempts == 3
+    assert len(working.sent) == 1
+    assert dispatcher.stats['failed'] == 1 and dispatcher.stats['delivered'] == 1
+    assert isinstance(dispatcher.errors[0][1], OSError)
+
+
+def test_submit_rejects_frames_without_alert_columns():
+    with alert.AlertDispatcher([_FailingSink(failures=0)], window=0) as dispatcher:
+        with pytest.raises(ValueError):
+            dispatcher.submit(pd.DataFrame({'source_url': ['http://example.com/listings.csv']}))
+    assert dispatcher.stats['submitted'] == 0
+
+
+def test_digest_error_does_not_stop_the_thread(monkeypatch):
+    sink = _FailingSink(failures=0)
+    make_alert = alert.make_alert
+    calls = []
+
+    def broken_once(new_files):
+        calls.append(new_files)
+        if len(calls) == 1:
+            raise KeyError('country')
+        return make_alert(new_files)
+
+    monkeypatch.setattr(alert, 'make_alert', broken_once)
+    dispatcher = alert.AlertDispatcher([sink], window=0)
+    dispatcher.submit(_new_files('paris'))
+    deadline = time.monotonic() + 5
+    while not dispatcher.errors and time.monotonic() < deadline:
+        time.sleep(0.01)
+    dispatcher.submit(_new_files('lyon'))
+    dispatcher.close()
+
+    assert isinstance(dispatcher.errors[0][1], KeyError)
+    assert len(sink.sent) == 1
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(_new_files('nice'))
+
+
+def test_smtp_sink_reuses_its_connection(smtp_server):
+    sink = alert.SmtpSink(host='127.0.0.1', port=smtp_server.server_address[1], use_ssl=False,
+                          sender='watcher@localhost', recipients=['me@localhost'])
+    try:
+        sink.send(alert.make_alert(_new_files('paris')))
+        server = sink._server
+        sink.send(alert.make_alert(_new_files('lyon')))
+        assert sink._server is server
+    finally:
+        sink.close()
+    assert len(smtp_server.messages) == 2
+    assert isinstance(server, smtplib.SMTP)
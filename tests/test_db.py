@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the typed loading of the listings files by 'insideairbnb_db.py' and
+'insideairbnb_parquet.py'.
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from insideairbnb_connection import connect
+from insideairbnb_db import ingest_import_list
+from insideairbnb_tools import parse_source_urls
+
+
+URL = 'http://data.insideairbnb.com/france/ile-de-france/paris/2020-01-01/visualisations/listings.csv'
+
+
+@pytest.fixture
+def import_list(tmp_path, monkeypatch):
+    # summary files have plain numeric prices, detailed ones '$1,500.00'
+    monkeypatch.chdir(tmp_path)
+    import_list = pd.DataFrame({'source_url': [URL]})
+    filename = parse_source_urls(import_list)['local_filename'].iloc[0]
+    os.makedirs(os.path.dirname(filename))
+    pd.DataFrame({'id': [1, 2, 3, 4], 'name': ['a', 'b', 'c', 'd'],
+                  'price': ['100', '9', '1500', '$1,234.50']}).to_csv(filename, index=False)
+    return import_list
+
+
+def test_listings_prices_are_compared_as_numbers(import_list):
+    conn = connect('test.db')
+    try:
+        ingest_import_list(import_list, conn)
+        assert conn.execute('select id from listings where price > 5000 order by id').fetchall() == \
+            [(1,), (3,), (4,)]
+        assert conn.execute('select max(price) from listings').fetchone() == (150000,)
+        assert conn.execute('select median_price from listings_summary').fetchone() == (667.25,)
+    finally:
+        conn.close()
+
+
+def test_parquet_prices_are_compared_as_numbers(import_list):
+    pytest.importorskip('pyarrow')
+    from insideairbnb_parquet import query_parquet, write_import_list_parquet
+
+    write_import_list_parquet(import_list, root='parquet')
+    df = query_parquet(['id', 'price'], [('price', '>', 5000)], root='parquet')
+    assert sorted(df['id']) == [1, 3, 4]
+    assert df['price'].max() == 150000
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the resumable, conditional downloads of 'insideairbnb_download.py',
+against a local HTTP server that supports Range requests.
+"""
+import hashlib
+import http.server
+import json
+import re
+import threading
+
+import pytest
+
+import insideairbnb_download as download
+
+
+BODY = bytes(range(256)) * 400
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.body` with an ETag, answering If-None-Match, and Range
+    requests whose If-Range matches the ETag.
+    """
+
+    def do_GET(self):
+        body, etag = self.server.body, '"{0}"'.format(hashlib.sha256(self.server.body).hexdigest()[:16])
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range') in (None, etag):
+            start = int(match.group(1))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, len(body) - 1, len(body)))
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    server.body = BODY
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetch(server, tmp_path):
+    url = 'http://127.0.0.1:{0}/listings.csv.gz'.format(server.server_address[1])
+    filename = str(tmp_path / 'listings.csv.gz')
+
+    def fetch(entry=None):
+        with download.make_session(1) as session:
+            return download.download_file(session, url, filename, chunk_size=4096, entry=entry)
+
+    fetch.filename = filename
+    return fetch
+
+
+def _read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def _leave_part(filename, data, validator):
+    with open(filename + '.part', 'wb') as f:
+        f.write(data)
+    with open(filename + '.part.json', 'w', encoding='utf-8') as f:
+        json.dump({'validator': validator}, f)
+
+
+def test_download_records_size_and_hash(fetch):
+    result = fetch()
+
+    assert result['status'] == 'downloaded' and result['bytes'] == len(BODY)
+    assert _read(fetch.filename) == BODY
+    assert result['entry']['size'] == len(BODY)
+    assert result['entry']['sha256'] == hashlib.sha256(BODY).hexdigest()
+
+
+def test_interrupted_download_resumes_with_range(fetch, server):
+    etag = fetch()['entry']['etag']
+    _leave_part(fetch.filename, BODY[:10000], etag)
+
+    result = fetch()
+
+    assert result['status'] == 'resumed' and result['bytes'] == len(BODY) - 10000
+    assert server.requests[-1]['Range'] == 'bytes=10000-'
+    assert _read(fetch.filename) == BODY
+    assert result['entry']['sha256'] == hashlib.sha256(BODY).hexdigest()
+
+
+def test_resume_restarts_when_the_file_changed_on_the_server(fetch, server):
+    etag = fetch()['entry']['etag']
+    _leave_part(fetch.filename, BODY[:10000], etag)
+    server.body = BODY[::-1]
+
+    result = fetch()
+
+    assert result['status'] == 'downloaded'
+    assert _read(fetch.filename) == BODY[::-1]
+
+
+def test_complete_part_file_is_downloaded_again_after_416(fetch, server):
+    etag = fetch()['entry']['etag']
+    _leave_part(fetch.filename, BODY, etag)
+
+    result = fetch()
+
+    assert [r.get('Range') for r in server.requests[-2:]] == ['bytes={0}-'.format(len(BODY)), None]
+    assert result['status'] == 'downloaded'
+    assert _read(fetch.filename) == BODY
+
+
+def test_unchanged_file_is_revalidated_with_304(fetch, server):
+    entry = fetch()['entry']
+
+    result = fetch(entry)
+
+    assert result['status'] == 'not_modified' and result['bytes'] == 0
+    assert server.requests[-1]['If-None-Match'] == entry['etag']
+    assert _read(fetch.filename) == BODY
+
+
+def test_corrupt_local_file_is_not_trusted_on_304(fetch, server):
+    entry = fetch()['entry']
+    with open(fetch.filename, 'r+b') as f:
+        f.write(b'corrupt')
+
+    result = fetch(entry)
+
+    assert 'If-None-Match' not in server.requests[-1]
+    assert result['status'] == 'downloaded'
+    assert _read(fetch.filename) == BODY
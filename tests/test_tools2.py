@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of `extract_table()` of 'insideairbnb_tools2.py', given the BS4 object of
+the page or the catalog built from it.
+"""
+import pytest
+
+from insideairbnb_catalog import build_catalog
+from insideairbnb_tools2 import extract_table
+
+bs4 = pytest.importorskip('bs4')
+
+PAGE = """<html><body>
+<h2>Paris, Ile-de-France, France</h2>
+<table class="table table-hover table-striped paris"><tbody>
+<tr><td>07 December, 2019</td><td>Paris</td>
+<td><a href="http://data.insideairbnb.com/france/ile-de-france/paris/2019-12-07/data/listings.csv.gz">listings.csv.gz</a></td>
+<td>Detailed Listings data for Paris</td></tr>
+</tbody></table>
+</body></html>"""
+
+
+@pytest.fixture
+def content():
+    return bs4.BeautifulSoup(PAGE, 'lxml')
+
+
+def test_extract_table_from_page(content):
+    assert extract_table(content, 'paris').name == 'table'
+    assert list(extract_table(content, 'paris', df=True)['Country/City']) == ['Paris']
+
+
+def test_extract_table_from_catalog(content):
+    catalog, _ = build_catalog(content)
+    assert len(extract_table(catalog, 'paris', df=True)) == 1
+    with pytest.raises(TypeError):
+        extract_table(catalog, 'paris')
+
+
+def test_extract_table_unknown_city(content):
+    with pytest.raises(ValueError):
+        extract_table(content, 'lyon')